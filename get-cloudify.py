@@ -44,17 +44,37 @@
 
 import sys
 import subprocess
+import select
+import errno
 import argparse
+import base64
 import platform
 import os
-import urllib
+import urllib2
+import urlparse
 import struct
 import tempfile
 import logging
 import shutil
-import time
+import signal
 import tarfile
-from threading import Thread
+import collections
+import contextlib
+import distutils.spawn
+import multiprocessing
+import multiprocessing.pool
+import zipfile
+import glob
+import re
+import Queue
+import socket
+import httplib
+import hashlib
+import itertools
+import math
+import json
+import time
+from threading import Thread, Lock, Event, current_thread
 
 
 DESCRIPTION = '''This script attempts(!) to install Cloudify's CLI on Linux,
@@ -82,7 +102,54 @@ Passing the --wheelspath allows for an offline installation of Cloudify
 from predownloaded Cloudify dependency wheels. Note that if wheels are found
 within the default wheels directory or within --wheelspath, they will (unless
 the --forceonline flag is set) be used instead of performing an online
-installation.
+installation. Such a wheels directory can be created by running the script
+with --buildwheels on a machine with network access.
+
+Passing --cachedir keeps a local cache of downloaded files (e.g. get-pip.py
+and --source archives) which are revalidated against the server instead of
+being downloaded again on every run. When installing a specific --version or
+--source archive into a new --virtualenv, the installed virtualenv is kept
+there as a template as well and later installations with the same inputs
+(including the contents of the archive) clone it instead of installing
+Cloudify again. The requirements listed in --withrequirements of such
+installations are resolved once and locked there (pinned to the exact
+distributions chosen, along with their hashes), so that later installations
+of the same requirements install the locked distributions instead of
+resolving them again.
+
+Passing --precompile compiles all installed modules to bytecode once Cloudify
+is installed, so that the first cfy command doesn't have to (nor does every
+one of them when the installation isn't writable by the user running cfy).
+
+Passing --probestartup runs "cfy --version" from the installation a number of
+times once it's installed and reports the median and 95th percentile of its
+startup latency, along with the modules which took longest to import. Use
+--probereport to keep the full report as JSON (e.g. to compare versions).
+
+The output of the commands the script runs (e.g. pip) is written in full to
+a log file in the temporary directory (or to --logfile), while only progress
+lines and warnings (or, with --verbose, all lines) are shown, at up to a few
+lines per second, along with the last lines of any command that fails.
+
+Everything the installation is going to download (get-pip.py, the --source
+archive, --withrequirements files and the distributions to install) starts
+downloading concurrently as soon as the script starts, while prerequisites
+are installed and the virtualenv is created.
+
+Components such as get-pip.py which have several mirrors (see --mirrors) are
+downloaded from whichever of them responds fastest, falling back to the next
+one if a download fails. The ranking of the mirrors is reused for --mirrorttl
+seconds.
+
+Commands which run for longer than --timeout seconds or which don't output
+anything for --stalltimeout seconds (e.g. pip waiting on a dead connection)
+are killed along with the processes they started. Commands which are safe
+to repeat (e.g. pip installs and downloads) are retried up to --retries times
+after failing, waiting longer before each retry.
+
+Passing --trace writes the duration of every installation phase and of every
+command the script runs (with its exit code and output size) to a file in the
+Chrome trace event format, which can be viewed in chrome://tracing.
 
 The script will attempt to install all necessary requirements including
 python-dev and gcc (for Fabric on Linux), pycrypto (for Fabric on Windows),
@@ -113,16 +180,370 @@ REQUIREMENT_FILE_NAMES = ['dev-requirements.txt', 'requirements.txt']
 PIP_URL = 'http://repository.cloudifysource.org/org/cloudify3/components/get-pip.py'  # NOQA
 PYCR64_URL = 'http://repository.cloudifysource.org/org/cloudify3/components/pycrypto-2.6.win-amd64-py2.7.exe'  # NOQA
 PYCR32_URL = 'http://repository.cloudifysource.org/org/cloudify3/components/pycrypto-2.6.win32-py2.7.exe'  # NOQA
+# the mirrors each component can be downloaded from (see Mirrors and
+# --mirrors). Components with a single mirror are never probed.
+COMPONENT_MIRRORS = {
+    'pip': [PIP_URL],
+    'pycrypto64': [PYCR64_URL],
+    'pycrypto32': [PYCR32_URL],
+}
+# seconds to wait for a mirror to connect and to start responding
+MIRROR_PROBE_TIMEOUT = 5
+# number of mirrors probed concurrently
+MIRROR_PROBE_WORKERS = 8
+# seconds for which a ranking of mirrors is reused (see --mirrorttl)
+MIRROR_RANKING_TTL = 3600
 
 PLATFORM = sys.platform
 IS_WIN = (PLATFORM == 'win32')
 IS_DARWIN = (PLATFORM == 'darwin')
 IS_LINUX = (PLATFORM == 'linux2')
 
+# files identifying the Linux distribution (see get_os_props)
+OS_RELEASE_PATHS = ('/etc/os-release', '/usr/lib/os-release')
+LSB_RELEASE_PATH = '/etc/lsb-release'
+REDHAT_RELEASE_PATH = '/etc/redhat-release'
+ARCH_RELEASE_PATH = '/etc/arch-release'
+# distributions install_pythondev knows about, and what they may be called
+SUPPORTED_DISTROS = ('ubuntu', 'debian', 'centos', 'redhat', 'fedora', 'arch')
+DISTRO_ALIASES = {'rhel': 'redhat', 'red': 'redhat', 'archlinux': 'arch'}
+
+# package manager databases queried before installing system packages
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+PACMAN_LOCAL_DB_PATH = '/var/lib/pacman/local'
+# commands installing system packages, by package manager
+SYSTEM_PACKAGE_INSTALL_COMMANDS = {
+    'apt': 'apt-get install -y {0}',
+    'yum': 'yum -y install {0}',
+    'pacman': 'pacman -S --needed --noconfirm {0}',
+}
+
 PROCESS_POLLING_INTERVAL = 0.1
+PIPE_READ_SIZE = 65536
+# seconds after which a command is killed along with the processes it
+# started (see --timeout, 0 means no limit)
+COMMAND_TIMEOUT = 3600
+# seconds without any output after which a command is considered stalled
+# and killed (see --stalltimeout, 0 means no limit)
+COMMAND_STALL_TIMEOUT = 600
+# number of times commands which are safe to repeat (e.g. pip installs) are
+# retried after failing (see --retries)
+COMMAND_RETRIES = 2
+# seconds to wait before the first retry, doubled for every following one
+COMMAND_RETRY_BACKOFF = 5
+# seconds a killed command is given to exit before being killed forcibly
+COMMAND_KILL_GRACE_PERIOD = 5
+# command output kept in memory before spilling to a temporary log file
+OUTPUT_CAPTURE_LIMIT = 1024 * 1024
+# head and tail of spilled output kept in memory for error reporting
+OUTPUT_CAPTURE_HEAD_SIZE = 4 * 1024
+OUTPUT_CAPTURE_TAIL_SIZE = 64 * 1024
+# number of installation phases which may run concurrently
+EXECUTE_WORKERS = 4
+# seconds between checks for a KeyboardInterrupt while waiting for tasks, as
+# blocking waits can't be interrupted on Python 2
+TASK_POLLING_INTERVAL = 0.5
+# number of artifacts fetched concurrently ahead of the installation
+PREFETCH_WORKERS = 4
+# lines of command output logged to the console per second (across all
+# commands). The rest are only written to the transcript (see --logfile).
+CONSOLE_LINES_PER_SECOND = 10
+# number of the last output lines of a failed command logged as errors
+CONSOLE_ERROR_TAIL_LINES = 20
+# command output logged at INFO level (other output is logged at DEBUG)
+PROGRESS_LINE = re.compile(
+    r'\s*(Collecting|Downloading|Processing|Building wheels? for|'
+    r'Installing collected packages|Successfully)')
+# command output logged at WARNING level
+WARNING_LINE = re.compile(r'\b(warning|deprecat\w*)\b', re.IGNORECASE)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# times an interrupted download is resumed before giving up
+DOWNLOAD_RETRIES = 3
+# seconds to wait before resuming an interrupted download, doubled for every
+# following attempt
+DOWNLOAD_RETRY_BACKOFF = 1
+# seconds without receiving data after which a download is interrupted
+DOWNLOAD_TIMEOUT = 60
+# default maximum size (in MB) of the download cache (see --cachedir)
+DOWNLOAD_CACHE_SIZE = 512
+
+# number of processes used to build wheels (see --buildwheels)
+WHEEL_BUILD_WORKERS = multiprocessing.cpu_count()
+
+WHEELHOUSE_INDEX_NAME = 'index.json'
+# a plain requirement (see merge_requirements)
+REQUIREMENT_LINE = re.compile(
+    r'^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[(?P<extras>[^\]]*)\])?'
+    r'\s*(?P<specifiers>[^;]*?)\s*(;(?P<marker>.*))?$')
+# archives of source distributions, as downloaded by pip
+SDIST_FILENAME = re.compile(
+    r'^(?P<name>.+)-(?P<version>\d[^-]*)\.(tar\.gz|tar\.bz2|tgz|zip)$')
+# the name of a project, in its PKG-INFO or setup.py (see read_project_name)
+PKG_INFO_NAME = re.compile(r'^Name:\s*(\S+)\s*$', re.MULTILINE)
+PKG_INFO_VERSION = re.compile(r'^Version:\s*(\S+)\s*$', re.MULTILINE)
+SETUP_PY_NAME = re.compile(r'\bname\s*=\s*[\'"]([^\'"]+)[\'"]')
+# number of concurrent installations in fleet mode (see --manifest)
+FLEET_WORKERS = 4
+# number of threads used to hash and verify wheels
+WHEEL_VERIFY_WORKERS = 8
+
+# ioctl which creates a copy-on-write clone of a file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+
+# written to the INSTALLER file of distributions installed by install_wheels
+WHEEL_INSTALLER_NAME = 'get-cloudify'
+# number of threads used to install wheels (see install_wheels)
+WHEEL_INSTALL_WORKERS = multiprocessing.cpu_count()
+# wheel .data directories install_wheels knows where to install
+WHEEL_DATA_SCHEMES = ('purelib', 'platlib', 'scripts', 'data')
+# generated for the console_scripts and gui_scripts entry points of wheels
+ENTRY_POINT_SCRIPT = '''#!{python}
+# -*- coding: utf-8 -*-
+import re
+import sys
+
+from {module} import {name}
+
+if __name__ == '__main__':
+    sys.argv[0] = re.sub(r'(-script\\.pyw?|\\.exe)?$', '', sys.argv[0])
+    sys.exit({func}())
+'''
+
+# number of processes compiling bytecode (see --precompile)
+PRECOMPILE_WORKERS = multiprocessing.cpu_count()
+# compiles the modules in the directories it is given (or in site-packages)
+# on a process pool and prints how many were compiled (see precompile)
+PRECOMPILE_SCRIPT = r'''
+import compileall
+import json
+import multiprocessing
+import os
+import sys
+import time
+try:
+    from importlib.util import cache_from_source
+except ImportError:
+    def cache_from_source(path):
+        return path + ('c' if __debug__ else 'o')
+
+
+def stat(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_mtime, info.st_size, info.st_ino
+
+
+def compile_file(path):
+    cache = cache_from_source(path)
+    before = stat(cache)
+    if not compileall.compile_file(path, quiet=1):
+        return 'failed'
+    # up to date bytecode is left as is
+    return 'skipped' if stat(cache) == before else 'compiled'
+
+
+if __name__ == '__main__':
+    start = time.time()
+    workers = int(sys.argv[1])
+    paths = sys.argv[2:]
+    if not paths:
+        from distutils.sysconfig import get_python_lib
+        paths = sorted(set([get_python_lib(), get_python_lib(True)]))
+    files = [os.path.join(root, name)
+             for path in paths for root, _, names in os.walk(path)
+             for name in names if name.endswith('.py')]
+    if workers > 1 and len(files) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.map(compile_file, files, 64)
+        pool.close()
+        pool.join()
+    else:
+        results = [compile_file(path) for path in files]
+    print(json.dumps({
+        'files': len(files),
+        'compiled': results.count('compiled'),
+        'failed': results.count('failed'),
+        'seconds': time.time() - start,
+    }))
+'''
+
+# default number of times cfy --version is run by --probestartup
+STARTUP_PROBE_RUNS = 10
+# number of the heaviest imports reported by probe_startup
+STARTUP_PROBE_TOP = 10
+# runs a console script (e.g. cfy) with the arguments it is given and writes
+# the time spent importing each module to the path it is given, much like
+# python -X importtime (which older interpreters don't have)
+IMPORT_PROFILE_SCRIPT = r'''
+import json
+import runpy
+import sys
+import time
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+clock = time.perf_counter if hasattr(time, 'perf_counter') else time.time
+original_import = builtins.__import__
+timings = {}
+order = []
+nested = []
+
+
+def candidates(name, globals, level, fromlist):
+    """Lists the modules an import statement may load, in order of
+    preference.
+    """
+    names = [name]
+    if level and globals and '__name__' in globals:
+        package = globals.get('__package__') or (
+            globals['__name__'] if '__path__' in globals
+            else globals['__name__'].rpartition('.')[0])
+        if level < 0:
+            # python 2 implicit relative imports
+            names = ['{0}.{1}'.format(package, name), name]
+        else:
+            for _ in range(level - 1):
+                package = package.rpartition('.')[0]
+            names = ['{0}.{1}'.format(package, name) if name else package]
+    return names + ['{0}.{1}'.format(names[0], item)
+                    for item in fromlist or () if item != '*']
+
+
+def timed_import(name, globals=None, locals=None, fromlist=(),
+                 level=0 if sys.version_info[0] > 2 else -1):
+    missing = [module for module in candidates(name, globals, level, fromlist)
+               if module not in sys.modules]
+    nested.append(0.0)
+    start = clock()
+    try:
+        return original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = clock() - start
+        children = nested.pop()
+        loaded = [module for module in missing
+                  if sys.modules.get(module) is not None]
+        if loaded:
+            module = loaded[0]
+            if module not in timings:
+                timings[module] = [0.0, 0.0]
+                order.append(module)
+            timings[module][0] += elapsed - children
+            timings[module][1] += elapsed
+            if nested:
+                nested[-1] += elapsed
+
+
+if __name__ == '__main__':
+    output_path, script_path = sys.argv[1:3]
+    sys.argv = [script_path] + sys.argv[3:]
+    builtins.__import__ = timed_import
+    try:
+        runpy.run_path(script_path, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        builtins.__import__ = original_import
+        with open(output_path, 'w') as f:
+            json.dump([{'module': module,
+                        'self': timings[module][0],
+                        'cumulative': timings[module][1]}
+                       for module in order], f)
+'''
+
+# prints the wheel tags and environment markers of the interpreter running it
+# (see get_interpreter_tags)
+INTERPRETER_PROBE = r'''
+import json
+import os
+import platform
+import sys
+import sysconfig
+
+major, minor = sys.version_info[:2]
+impl = {'CPython': 'cp', 'PyPy': 'pp'}.get(
+    platform.python_implementation(), 'py')
+pythons = ['{0}{1}{2}'.format(impl, major, minor),
+           'py{0}{1}'.format(major, minor), 'py{0}'.format(major)]
+pythons.extend('py{0}{1}'.format(major, m) for m in range(minor - 1, -1, -1))
+abis = ['none']
+soabi = sysconfig.get_config_var('SOABI')
+if soabi:
+    parts = soabi.split('-')
+    abis.append('cp' + parts[1] if parts[0] == 'cpython'
+                else '_'.join(parts[:2]).replace('.', '_'))
+elif impl == 'cp':
+    abi = 'cp{0}{1}'.format(major, minor)
+    if sysconfig.get_config_var('Py_DEBUG'):
+        abi += 'd'
+    if sysconfig.get_config_var('WITH_PYMALLOC') and (major, minor) < (3, 8):
+        abi += 'm'
+    if major == 2 and sys.maxunicode == 0x10ffff:
+        abi += 'u'
+    abis.append(abi)
+if impl == 'cp' and major == 3:
+    abis.append('abi3')
+    pythons.extend('cp3{0}'.format(m) for m in range(minor - 1, 1, -1))
+print(json.dumps({
+    'python': pythons,
+    'abi': abis,
+    'platform': sysconfig.get_platform().replace(
+        '-', '_').replace('.', '_'),
+    'environment': {
+        'implementation_name': sys.implementation.name
+        if hasattr(sys, 'implementation')
+        else platform.python_implementation().lower(),
+        'os_name': os.name,
+        'platform_machine': platform.machine(),
+        'platform_python_implementation': platform.python_implementation(),
+        'platform_release': platform.release(),
+        'platform_system': platform.system(),
+        'platform_version': platform.version(),
+        'python_full_version': platform.python_version(),
+        'python_version': '{0}.{1}'.format(major, minor),
+        'sys_platform': sys.platform,
+    },
+}))
+'''
 
 # defined below
 lgr = None
+# installed distribution versions by site-packages paths, along with the
+# mtimes of those paths when they were looked up.
+_installed_versions = {}
+# set to the DownloadCache of the installer running, when it has one
+# (see --cachedir and CloudifyInstaller._scope)
+download_cache = None
+# set to a Tracer when --trace is used.
+tracer = None
+# the limits applied to commands by run (see --timeout, --stalltimeout and
+# --retries), replaced by those of the installer running
+# (see CloudifyInstaller._scope)
+command_limits = {
+    'timeout': COMMAND_TIMEOUT,
+    'stall_timeout': COMMAND_STALL_TIMEOUT,
+    'retries': COMMAND_RETRIES,
+}
+# set to a Transcript receiving the full output of the commands run
+# (see --logfile)
+transcript = None
+# limits the command output logged to the console (see RateLimiter)
+console_limiter = None
+# the commands started by run which are still running, along with the
+# threads which started them, so that they can be killed from other threads
+# (see kill_commands)
+_running_commands = {}
+_running_commands_lock = Lock()
+# set by kill_commands, after which run doesn't start any more commands
+_commands_killed = Event()
+# threads whose commands were killed by kill_commands, which may not start
+# any more commands either
+_killed_threads = set()
+# the (distro, release) found by get_os_props
+_os_props = None
 
 if not (IS_LINUX or IS_DARWIN or IS_WIN):
     sys.exit('Platform {0} not supported.'.format(PLATFORM))
@@ -140,32 +561,247 @@ def init_logger(logger_name):
     return logger
 
 
-def run(cmd, suppress_errors=False):
+def run(cmd, suppress_errors=False, capture_limit=OUTPUT_CAPTURE_LIMIT,
+        retry=False, timeout=None, stall_timeout=None):
     """Executes a command
+
+    The command's stdout and stderr are drained as data arrives and are
+    aggregated into `aggr_stdout` and `aggr_stderr` on the returned process.
+    Output exceeding `capture_limit` bytes per pipe is spilled to a
+    temporary log file (kept only if the command fails) and the aggregates
+    are reduced to its head and tail.
+
+    The command is killed along with the processes it started if it runs for
+    longer than `timeout` seconds or doesn't output anything for
+    `stall_timeout` seconds (defaulting to the --timeout and --stalltimeout
+    limits). Commands which are safe to repeat (`retry`) are retried up to
+    --retries times, with an exponential backoff. Each attempt is traced and
+    recorded in `attempts` on the returned process.
     """
-    lgr.debug('Executing: {0}...'.format(cmd))
+    if timeout is None:
+        timeout = command_limits['timeout']
+    if stall_timeout is None:
+        stall_timeout = command_limits['stall_timeout']
+    retries = command_limits['retries'] if retry else 0
+    attempts = []
+    while True:
+        if _commands_killed_in_thread():
+            sys.exit('Not running {0}, the installation was '
+                     'interrupted.'.format(cmd))
+        lgr.debug('Executing: {0}...'.format(cmd))
+        with trace('run {0}'.format(os.path.basename(cmd.split()[0])),
+                   'run', cmd=cmd, attempt=len(attempts) + 1) as span:
+            start = time.time()
+            proc = _run(cmd, suppress_errors, capture_limit, timeout,
+                        stall_timeout)
+            span.update(returncode=proc.returncode,
+                        stdout_bytes=proc.stdout_bytes,
+                        stderr_bytes=proc.stderr_bytes,
+                        timed_out=proc.timed_out)
+        attempts.append({'returncode': proc.returncode,
+                         'timed_out': proc.timed_out,
+                         'seconds': time.time() - start})
+        proc.attempts = attempts
+        if proc.returncode == 0 or len(attempts) > retries or \
+                _commands_killed_in_thread():
+            break
+        delay = COMMAND_RETRY_BACKOFF * 2 ** (len(attempts) - 1)
+        lgr.warning('{0}, retrying in {1} seconds (retry {2} of {3}): '
+                    '{4}'.format(_describe_failure(
+                        proc, timeout, stall_timeout), delay, len(attempts),
+                        retries, cmd))
+        for line in proc.tail:
+            lgr.warning(line)
+        with trace('backoff', 'run', cmd=cmd, seconds=delay):
+            deadline = time.time() + delay
+            while time.time() < deadline and \
+                    not _commands_killed_in_thread():
+                time.sleep(PROCESS_POLLING_INTERVAL)
+
+    if proc.returncode != 0 and not suppress_errors:
+        lgr.error('{0}: {1}'.format(
+            _describe_failure(proc, timeout, stall_timeout), cmd))
+        for line in proc.tail:
+            lgr.error(line)
+    elif proc.omitted:
+        lgr.debug('{0} line(s) of output were not logged.'.format(
+            proc.omitted))
+    if transcript is not None and (proc.omitted or (
+            proc.returncode != 0 and not suppress_errors)):
+        lgr.info('The full output is in {0}'.format(transcript.path))
+    return proc
+
+
+def _describe_failure(proc, timeout, stall_timeout):
+    if proc.timed_out == 'timeout':
+        return 'Command timed out after {0} seconds'.format(timeout)
+    elif proc.timed_out == 'stall':
+        return 'Command stalled (no output for {0} seconds)'.format(
+            stall_timeout)
+    return 'Command failed with exit code {0}'.format(proc.returncode)
+
+
+def _run(cmd, suppress_errors, capture_limit, timeout=0, stall_timeout=0):
     pipe = subprocess.PIPE
+    # the command gets its own process group so that it can be killed
+    # along with everything it started.
     proc = subprocess.Popen(
-        cmd, shell=True, stdout=pipe, stderr=pipe)
+        cmd, shell=True, stdout=pipe, stderr=pipe,
+        preexec_fn=None if IS_WIN else os.setpgrp)
+    proc.timed_out = None
+    with _running_commands_lock:
+        _running_commands[proc] = current_thread()
+        killed = _commands_killed_in_thread()
 
     stderr_log_level = logging.NOTSET if suppress_errors else logging.ERROR
+    # the last lines of both pipes, in the order they were read
+    tail = collections.deque(maxlen=CONSOLE_ERROR_TAIL_LINES)
+    source = '[{0}] {1}'.format(proc.pid, cmd)
 
-    stdout_thread = PipeReader(proc.stdout, proc, lgr, logging.DEBUG)
-    stderr_thread = PipeReader(proc.stderr, proc, lgr, stderr_log_level)
+    stdout_reader = PipeReader(
+        proc.stdout, proc, lgr, logging.DEBUG, capture_limit,
+        source=source + ' (stdout)', tail=tail)
+    stderr_reader = PipeReader(
+        proc.stderr, proc, lgr, stderr_log_level, capture_limit,
+        source=source + ' (stderr)', tail=tail)
+    readers = (stdout_reader, stderr_reader)
+    watchdog = Watchdog(proc, readers, timeout, stall_timeout)
 
-    stdout_thread.start()
-    stderr_thread.start()
+    try:
+        if killed:
+            # started while kill_commands was running
+            kill_process_group(proc)
+        if IS_WIN:
+            # select() only works on sockets on Windows so each pipe is
+            # drained by its own (blocking) reader thread.
+            stdout_reader.start()
+            stderr_reader.start()
+            while proc.poll() is None:
+                time.sleep(PROCESS_POLLING_INTERVAL)
+                watchdog.check()
+            stdout_reader.join()
+            stderr_reader.join()
+        else:
+            multiplex_output(proc, readers, watchdog)
+            proc.wait()
+    except BaseException:
+        # e.g. KeyboardInterrupt, which the command's process group doesn't
+        # receive. This only happens when run is called from the main
+        # thread, see kill_commands for the others.
+        kill_process_group(proc)
+        raise
+    finally:
+        with _running_commands_lock:
+            del _running_commands[proc]
+
+    for reader in readers:
+        reader.capture.close()
+        if proc.returncode == 0:
+            reader.capture.discard()
+    proc.aggr_stdout = stdout_reader.aggr
+    proc.aggr_stderr = stderr_reader.aggr
+    proc.stdout_bytes = stdout_reader.capture.size
+    proc.stderr_bytes = stderr_reader.capture.size
+    proc.tail = list(tail)
+    proc.omitted = stdout_reader.omitted + stderr_reader.omitted
+
+    if transcript is not None:
+        transcript.write(source, 'exited with {0}{1}\n'.format(
+            proc.returncode, ' (killed: {0})'.format(proc.timed_out)
+            if proc.timed_out else ''))
+    return proc
+
+
+def multiplex_output(proc, readers, watchdog=None):
+    """Drains the pipes of `readers` from a single thread using select().
 
-    while proc.poll() is None:
+    Returns once all pipes reached EOF. If the process exited but its pipes
+    are still held open (e.g. by a daemonized grandchild), whatever is
+    already buffered is drained and the function returns without waiting
+    for the pipes to close.
+    """
+    pending = dict((reader.fd.fileno(), reader) for reader in readers)
+    while pending:
+        try:
+            ready, _, _ = select.select(
+                list(pending), [], [], PROCESS_POLLING_INTERVAL)
+        except select.error as ex:
+            if ex.args[0] == errno.EINTR:
+                continue
+            raise
+        if not ready and proc.poll() is not None:
+            break
+        for fd in ready:
+            output = os.read(fd, PIPE_READ_SIZE)
+            if output:
+                pending[fd].feed(output)
+            else:
+                del pending[fd]
+        if watchdog is not None:
+            watchdog.check()
+    for reader in readers:
+        reader.flush()
+
+
+def kill_process_group(proc, reap=True):
+    """Terminates a process started by `run` and the processes it started.
+
+    On Linux and OS X the process group is sent SIGTERM and, after
+    COMMAND_KILL_GRACE_PERIOD seconds (or once the command exited), SIGKILL.
+    Unless `reap` is set, the process isn't waited for, as it must only be
+    waited for by the thread which started it: on Python 2, the returncode
+    of a process waited for by two threads may be overwritten with 0.
+    """
+    if IS_WIN:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call('taskkill /F /T /PID {0}'.format(proc.pid),
+                            stdout=devnull, stderr=devnull)
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + COMMAND_KILL_GRACE_PERIOD
+    while time.time() < deadline:
+        if reap and proc.poll() is not None:
+            break
+        try:
+            os.killpg(proc.pid, 0)
+        except OSError:
+            # the whole group exited
+            break
         time.sleep(PROCESS_POLLING_INTERVAL)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
 
-    stdout_thread.join()
-    stderr_thread.join()
 
-    proc.aggr_stdout = stdout_thread.aggr
-    proc.aggr_stderr = stderr_thread.aggr
+def kill_commands(threads=None):
+    """Kills the commands started by `run` which are still running and
+    prevents any more commands from being started.
 
-    return proc
+    As commands run in their own process groups, they don't receive the
+    SIGINT sent by the terminal on Ctrl-C. The KeyboardInterrupt is only
+    raised in the main thread, which must then kill the commands started
+    by other threads.
+    If `threads` are given, only the commands they started are killed and
+    only they are prevented from starting commands.
+    """
+    with _running_commands_lock:
+        if threads is None:
+            _commands_killed.set()
+        else:
+            _killed_threads.update(threads)
+        procs = [proc for proc, thread in _running_commands.items()
+                 if threads is None or thread in threads]
+    for proc in procs:
+        lgr.debug('Killing {0}...'.format(proc.pid))
+        kill_process_group(proc, reap=False)
+
+
+def _commands_killed_in_thread():
+    return _commands_killed.is_set() or current_thread() in _killed_threads
 
 
 def drop_root_privileges():
@@ -185,6 +821,21 @@ def drop_root_privileges():
     os.seteuid(int(os.environ.get('SUDO_UID', 0)))
 
 
+def give_to_sudo_user(path):
+    """Makes the user who ran sudo the owner of `path` and of everything in
+    it, so that it can still be written to (and removed) once root
+    privileges are dropped. Does nothing unless running as root under sudo.
+    """
+    if IS_WIN or os.geteuid() != 0 or 'SUDO_UID' not in os.environ:
+        return
+    uid = int(os.environ['SUDO_UID'])
+    gid = int(os.environ.get('SUDO_GID', -1))
+    os.chown(path, uid, gid)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+
+
 def make_virtualenv(virtualenv_dir, python_path):
     """This will create a virtualenv. If no `python_path` is supplied,
     will assume that `python` is in path. This default assumption is provided
@@ -196,99 +847,2248 @@ def make_virtualenv(virtualenv_dir, python_path):
         sys.exit('Could not create virtualenv: {0}'.format(virtualenv_dir))
 
 
-def install_module(module, version=False, pre=False, virtualenv_path=False,
-                   wheelspath=False, requirement_files=None, upgrade=False):
-    """This will install a Python module.
+def get_interpreter_id(python_path):
+    """Returns a string identifying the interpreter found at `python_path`.
+    """
+    result = run('{0} -c "import sys; print(sys.executable); '
+                 'print(sys.version)"'.format(python_path))
+    if not result.returncode == 0:
+        sys.exit('Could not run Python: {0}'.format(python_path))
+    return result.aggr_stdout.strip()
+
+
+def precompile(python_path, paths=(), workers=PRECOMPILE_WORKERS):
+    """Compiles the modules in `paths` to bytecode using the interpreter found
+    at `python_path`, on a pool of `workers` processes.
+
+    If no paths are provided, the interpreter's site-packages are compiled.
+    Modules which are already compiled are skipped and modules which cannot
+    be compiled (e.g. written for another Python version) are only counted.
+    Returns the number of modules found, of modules which were compiled and
+    of modules which failed.
+    """
+    with trace('precompile', paths=list(paths)) as span:
+        fd, script_path = tempfile.mkstemp(suffix='.py')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(PRECOMPILE_SCRIPT)
+            result = run('{0} {1} {2} {3}'.format(
+                python_path, script_path, workers, ' '.join(
+                    '"{0}"'.format(path) for path in paths)),
+                suppress_errors=True)
+        finally:
+            os.remove(script_path)
+        if not result.returncode == 0:
+            lgr.error(result.aggr_stderr)
+            sys.exit('Could not compile modules using {0}.'.format(
+                python_path))
+        report = json.loads(result.aggr_stdout.strip().splitlines()[-1])
+        span.update(report)
+    lgr.info('Compiled {0} of {1} module(s) in {2:.1f} seconds ({3} could '
+             'not be compiled).'.format(
+                 report['compiled'], report['files'], report['seconds'],
+                 report['failed']))
+    return report['files'], report['compiled'], report['failed']
+
+
+def probe_startup(cfy_path, python_path, runs=STARTUP_PROBE_RUNS,
+                  top=STARTUP_PROBE_TOP):
+    """Measures how long `cfy --version` takes to start.
+
+    `cfy_path` is run `runs` times and then once more by the interpreter
+    found at `python_path` with its imports being timed.
+    Returns a report with the latency of each run, their median and 95th
+    percentile (in seconds) and the time spent importing each module, along
+    with the `top` heaviest ones.
+    """
+    with trace('probe_startup', runs=runs) as span:
+        latencies = []
+        for _ in range(runs):
+            start = time.time()
+            result = run('{0} --version'.format(cfy_path),
+                         suppress_errors=True)
+            latencies.append(time.time() - start)
+            if not result.returncode == 0:
+                lgr.error(result.aggr_stderr)
+                sys.exit('Could not run: {0} --version'.format(cfy_path))
+        script_path = cfy_path
+        if IS_WIN:
+            # console scripts are launchers running <name>-script.py
+            script_path = os.path.splitext(cfy_path)[0] + '-script.py'
+        if os.path.isfile(script_path):
+            imports = _profile_imports(python_path, script_path, '--version')
+        else:
+            lgr.warning('Could not find {0}, not profiling imports.'.format(
+                script_path))
+            imports = []
+        latencies.sort()
+        report = {
+            'command': '{0} --version'.format(cfy_path),
+            'version': result.aggr_stdout.strip(),
+            'runs': runs,
+            'latencies': latencies,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'imports': imports,
+            'heaviest': sorted(
+                imports, key=lambda i: i['self'], reverse=True)[:top],
+        }
+        span.update(p50=report['p50'], p95=report['p95'])
+    lgr.info('cfy --version took {0:.0f}ms (p50) and {1:.0f}ms (p95) over {2} '
+             'run(s).'.format(report['p50'] * 1000, report['p95'] * 1000,
+                              runs))
+    for entry in report['heaviest']:
+        lgr.info('Importing {0} took {1:.1f}ms ({2:.1f}ms including its '
+                 'imports).'.format(entry['module'], entry['self'] * 1000,
+                                    entry['cumulative'] * 1000))
+    return report
+
+
+def _profile_imports(python_path, script_path, *args):
+    """Runs a Python script using the interpreter found at `python_path` and
+    returns the time spent importing each module, in the order their imports
+    completed.
+    """
+    fd, profiler_path = tempfile.mkstemp(suffix='.py')
+    output_path = profiler_path + '.json'
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(IMPORT_PROFILE_SCRIPT)
+        result = run('{0} {1} {2} {3} {4}'.format(
+            python_path, profiler_path, output_path, script_path,
+            ' '.join(args)), suppress_errors=True)
+        if not os.path.isfile(output_path):
+            lgr.error(result.aggr_stderr)
+            sys.exit('Could not profile the imports of {0}.'.format(
+                script_path))
+        with open(output_path) as f:
+            return json.load(f)
+    finally:
+        for path in (profiler_path, output_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+def _percentile(values, percent):
+    """Returns the nearest-rank percentile of sorted `values`.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def get_interpreter_tags(python_path):
+    """Describes which wheels the interpreter found at `python_path` supports.
+
+    Returns a dict with the `python` and `abi` tags and the `platform` of
+    the interpreter, along with the `environment` for evaluating
+    requirement markers. Raises ValueError if the interpreter cannot be
+    probed.
+    """
+    fd, probe_path = tempfile.mkstemp(suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(INTERPRETER_PROBE)
+        result = run('{0} {1}'.format(python_path, probe_path))
+    finally:
+        os.remove(probe_path)
+    if not result.returncode == 0:
+        raise ValueError('could not probe {0}: {1}'.format(
+            python_path, result.aggr_stderr.strip()))
+    return json.loads(result.aggr_stdout)
+
+
+def wheel_compatible(tags, interpreter):
+    """Returns True if a wheel with `tags` ([python, abi, platform], each
+    possibly compressed, e.g. `py2.py3`) can be installed by `interpreter`
+    (see get_interpreter_tags).
+    """
+    pythons, abis, platforms = (set(tag.split('.')) for tag in tags)
+    return bool(pythons & set(interpreter['python'])) \
+        and bool(abis & set(interpreter['abi'])) \
+        and any(_platform_compatible(wheel_platform, interpreter['platform'])
+                for wheel_platform in platforms)
+
+
+def _platform_compatible(wheel_platform, platform):
+    if wheel_platform in ('any', platform):
+        return True
+    if platform.startswith('linux_'):
+        # manylinux wheels target any (glibc based) linux of the same arch
+        return wheel_platform.startswith('manylinux') and \
+            wheel_platform.endswith(platform[len('linux'):])
+    if platform.startswith('macosx_') and wheel_platform.startswith('macosx_'):
+        _, major, minor, arch = platform.split('_', 3)
+        _, wheel_major, wheel_minor, wheel_arch = wheel_platform.split('_', 3)
+        return wheel_arch in (arch, 'intel', 'universal', 'universal2') and \
+            (int(wheel_major), int(wheel_minor)) <= (int(major), int(minor))
+    return False
+
+
+def install_module(module, version=False, pre=False, virtualenv_path=False,
+                   wheelspath=False, requirement_files=None, upgrade=False):
+    """This will install a Python module.
+
+    Can specify a specific version.
+    Can specify a prerelease.
+    Can specify a virtualenv to install in.
+    Can specify a list of paths or urls to requirement txt files.
+    Can specify a local wheelspath (or a list of them) to use for offline
+    installation.
+    Can request an upgrade.
+    """
+    with trace('install_module', module=module, version=version,
+               offline=bool(wheelspath)):
+        _install_module(module, version, pre, virtualenv_path, wheelspath,
+                        requirement_files, upgrade)
+
+
+def _install_module(module, version, pre, virtualenv_path, wheelspath,
+                    requirement_files, upgrade):
+    lgr.info('Installing {0}...'.format(module))
+    pip_cmd = ['pip', 'install']
+    if virtualenv_path:
+        pip_cmd[0] = os.path.join(
+            _get_env_bin_path(virtualenv_path), pip_cmd[0])
+    if requirement_files:
+        for req_file in requirement_files:
+            pip_cmd.extend(['-r', req_file])
+    module = '{0}=={1}'.format(module, version) if version else module
+    pip_cmd.append(module)
+    if wheelspath:
+        # wheels are used by default since pip 7 and --use-wheel was
+        # removed in pip 10.
+        pip_cmd.append('--no-index')
+        for path in wheelspath if isinstance(wheelspath, list) \
+                else [wheelspath]:
+            pip_cmd.extend(['--find-links', path])
+    if pre:
+        pip_cmd.append('--pre')
+    if upgrade:
+        pip_cmd.append('--upgrade')
+    if IS_VIRTUALENV and not virtualenv_path:
+        lgr.info('Installing within current virtualenv: {0}...'.format(
+            IS_VIRTUALENV))
+    # offline installations fail the same way every time, e.g. because of a
+    # missing wheel, so only the online ones are retried.
+    result = run(' '.join(pip_cmd), retry=not wheelspath)
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        sys.exit('Could not install module: {0}.'.format(module))
+
+
+def install_resolved_wheels(wheels, virtualenv_path=False, upgrade=False):
+    """Installs the exact wheels resolved from a wheelhouse (see
+    WheelhouseIndex.resolve) using pip.
+
+    pip is given the wheels' paths rather than the wheelhouse, so it neither
+    lists the wheelhouse nor chooses other wheels from it.
+    """
+    lgr.info('Installing {0} wheel(s)...'.format(len(wheels)))
+    pip = os.path.join(_get_env_bin_path(virtualenv_path), 'pip') \
+        if virtualenv_path else 'pip'
+    pip_cmd = [pip, 'install', '--no-index']
+    if upgrade:
+        pip_cmd.append('--upgrade')
+    pip_cmd.extend('"{0}"'.format(wheel) for wheel in wheels)
+    result = run(' '.join(pip_cmd))
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        sys.exit('Could not install the wheels resolved from the '
+                 'wheelhouse.')
+
+
+def install_wheels(wheels, virtualenv_path, workers=WHEEL_INSTALL_WORKERS):
+    """Installs wheels into a virtualenv without running pip.
+
+    The wheels must already be resolved: they are installed as they are,
+    without looking at their requirements. Each one is unpacked into
+    site-packages (its .data scripts into the virtualenv's bin directory
+    and its .data data into the virtualenv itself), scripts are generated
+    for its console and gui entry points and INSTALLER and RECORD files
+    are written to its dist-info directory, as pip does.
+    Wheels are unpacked concurrently on a pool of `workers` threads into a
+    staging directory within the virtualenv and each distribution is then
+    moved into place as a whole (its dist-info last), so a failure never
+    leaves a partially installed distribution behind. The first failure is
+    raised once all wheels were processed.
+    Returns False, without installing anything, if a wheel cannot be
+    installed this way (e.g. it has headers), in which case pip should be
+    used instead.
+    """
+    if not wheels:
+        return True
+    site_packages = _get_site_packages(virtualenv_path)
+    if IS_WIN or len(site_packages) != 1:
+        return False
+    pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(wheels))))
+    try:
+        layouts = pool.map(_read_wheel_layout, wheels)
+        for wheel_path, layout in zip(wheels, layouts):
+            if layout is None:
+                lgr.debug('Cannot install {0} directly.'.format(wheel_path))
+                return False
+        bin_path = _get_env_bin_path(virtualenv_path)
+        roots = {
+            'purelib': site_packages[0],
+            'platlib': site_packages[0],
+            'scripts': bin_path,
+            'data': virtualenv_path,
+        }
+        python = os.path.join(os.path.abspath(bin_path), 'python')
+        staging_path = tempfile.mkdtemp(
+            prefix='.get-cloudify-', dir=virtualenv_path)
+        commit_lock = Lock()
+        try:
+            results = pool.map(_install_wheel, [
+                (wheel_path, layout, roots, python, staging_path, commit_lock)
+                for wheel_path, layout in zip(wheels, layouts)])
+        finally:
+            shutil.rmtree(staging_path, ignore_errors=True)
+    finally:
+        pool.close()
+        pool.join()
+    for wheel_path, error in zip(wheels, results):
+        if error is not None:
+            lgr.error('Could not install {0} ({1}).'.format(
+                os.path.basename(wheel_path), error))
+    errors = [error for error in results if error is not None]
+    if errors:
+        raise errors[0]
+    return True
+
+
+def _read_wheel_layout(wheel_path):
+    """Returns the dist-info directory of a wheel and where each of its
+    files is installed ([(member, scheme, path)]), or None if the wheel
+    cannot be installed by install_wheels.
+    """
+    with zipfile.ZipFile(wheel_path) as wheel:
+        names = wheel.namelist()
+        dist_infos = [name[:-len('/WHEEL')] for name in names
+                      if name.count('/') == 1 and
+                      name.endswith('.dist-info/WHEEL')]
+        if len(dist_infos) != 1:
+            return None
+        dist_info = dist_infos[0]
+        metadata = wheel.read(dist_info + '/WHEEL')
+        if not re.search(r'^Wheel-Version: *1\.', metadata, re.MULTILINE):
+            return None
+    data_dir = dist_info[:-len('.dist-info')] + '.data'
+    files = []
+    for name in names:
+        if name.endswith('/') or name == dist_info + '/RECORD':
+            continue
+        scheme, path = 'purelib', name
+        if name.startswith(data_dir + '/'):
+            scheme, _, path = name[len(data_dir) + 1:].partition('/')
+            if scheme not in WHEEL_DATA_SCHEMES:
+                return None
+        parts = path.split('/')
+        if not path or path.startswith('/') or '..' in parts:
+            return None
+        files.append((name, scheme, parts))
+    return dist_info, files
+
+
+def _install_wheel(args):
+    """Stages and then commits a single wheel (in a pool thread).
+
+    Returns the exception which failed the installation, if any.
+    """
+    wheel_path, (dist_info, files), roots, python, staging_path, \
+        commit_lock = args
+    site_packages = roots['purelib']
+    lgr.debug('Installing {0}...'.format(os.path.basename(wheel_path)))
+    stage = tempfile.mkdtemp(dir=staging_path)
+    staged_roots = {
+        'purelib': os.path.join(stage, 'lib'),
+        'platlib': os.path.join(stage, 'lib'),
+        'scripts': os.path.join(stage, 'scripts'),
+        'data': os.path.join(stage, 'data'),
+    }
+    record = []
+
+    def write(scheme, parts, data, executable=False):
+        destination = os.path.join(staged_roots[scheme], *parts)
+        parent = os.path.dirname(destination)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(destination, 'wb') as f:
+            f.write(data)
+        if executable:
+            os.chmod(destination, 0o755)
+        record.append('{0},sha256={1},{2}'.format(
+            os.path.relpath(os.path.join(roots[scheme], *parts),
+                            site_packages).replace(os.sep, '/'),
+            base64.urlsafe_b64encode(
+                hashlib.sha256(data).digest()).rstrip('='),
+            len(data)))
+
+    try:
+        with zipfile.ZipFile(wheel_path) as wheel:
+            for name, scheme, parts in files:
+                data = wheel.read(name)
+                executable = scheme == 'scripts' or \
+                    bool((wheel.getinfo(name).external_attr >> 16) & 0o111)
+                if scheme == 'scripts' and data.startswith('#!python'):
+                    data = '#!' + python + data[len('#!python'):].lstrip('w')
+                write(scheme, parts, data, executable)
+            entry_points = dist_info + '/entry_points.txt'
+            entry_points = wheel.read(entry_points) \
+                if entry_points in wheel.namelist() else ''
+        for script, module, attrs in _get_script_entry_points(entry_points):
+            write('scripts', [script], ENTRY_POINT_SCRIPT.format(
+                python=python, module=module, name=attrs.split('.')[0],
+                func=attrs), executable=True)
+        write('purelib', [dist_info, 'INSTALLER'], WHEEL_INSTALLER_NAME + '\n')
+        record.append('{0}/RECORD,,'.format(dist_info))
+        with open(os.path.join(
+                staged_roots['purelib'], dist_info, 'RECORD'), 'w') as f:
+            f.write('\n'.join(record) + '\n')
+
+        with commit_lock:
+            _commit_staged_files(staged_roots, roots, dist_info,
+                                 os.path.join(stage, 'backup'))
+    except Exception as ex:
+        lgr.debug('Installing {0} failed.'.format(wheel_path), exc_info=True)
+        return ex
+    finally:
+        shutil.rmtree(stage, ignore_errors=True)
+
+
+def _commit_staged_files(staged_roots, roots, dist_info, backup_path):
+    """Moves a staged distribution into place, its dist-info directory last.
+
+    Files it overwrites (e.g. those of another distribution sharing a
+    package or a script name) are moved to `backup_path` first. If moving
+    fails, whatever was already moved is removed again and the overwritten
+    files are restored.
+    """
+    moved = []
+    os.makedirs(backup_path)
+    try:
+        for staged_root, root in set(
+                (staged_roots[scheme], roots[scheme]) for scheme in roots):
+            if os.path.isdir(staged_root):
+                _merge_tree(staged_root, root, moved, backup_path,
+                            skip=dist_info if root == roots['purelib']
+                            else None)
+        os.rename(os.path.join(staged_roots['purelib'], dist_info),
+                  os.path.join(roots['purelib'], dist_info))
+    except OSError:
+        for path, backup in reversed(moved):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.lexists(path):
+                os.remove(path)
+            if backup:
+                os.rename(backup, path)
+        raise
+
+
+def _merge_tree(source, destination, moved, backup_path, skip=None):
+    """Moves the contents of `source` into `destination`, renaming whole
+    directories where `destination` doesn't have them yet.
+
+    Whatever is replaced is moved to `backup_path` first. Each path moved
+    is recorded in `moved`, along with its backup (if any).
+    """
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+    for name in os.listdir(source):
+        if name == skip:
+            continue
+        source_path = os.path.join(source, name)
+        destination_path = os.path.join(destination, name)
+        if os.path.isdir(source_path) and os.path.isdir(destination_path) \
+                and not os.path.islink(destination_path):
+            _merge_tree(source_path, destination_path, moved, backup_path)
+            continue
+        backup = None
+        if os.path.lexists(destination_path):
+            backup = os.path.join(backup_path, str(len(moved)))
+            os.rename(destination_path, backup)
+        try:
+            os.rename(source_path, destination_path)
+        except OSError:
+            if backup:
+                os.rename(backup, destination_path)
+            raise
+        moved.append((destination_path, backup))
+
+
+def _get_script_entry_points(entry_points):
+    """Returns the (script, module, attrs) of the console_scripts and
+    gui_scripts in the contents of an entry_points.txt file.
+    """
+    scripts = []
+    section = None
+    for line in entry_points.splitlines():
+        line = line.strip()
+        if line.startswith('['):
+            section = line.strip('[]').strip()
+        elif '=' in line and section in ('console_scripts', 'gui_scripts'):
+            script, _, target = line.partition('=')
+            # e.g. cfy = cloudify_cli.cli:main [extra]
+            module, _, attrs = target.split('[')[0].strip().partition(':')
+            if not attrs:
+                raise ValueError('Invalid entry point: {0}'.format(line))
+            scripts.append((script.strip(), module.strip(), attrs.strip()))
+    return scripts
+
+
+def download_requirements(requirements, destination, virtualenv_path=False,
+                          find_links=(), pre=False):
+    """Downloads requirements, along with their dependencies, to
+    `destination`.
+
+    Distributions found in `find_links` are copied from there rather than
+    downloaded again.
+    """
+    lgr.info('Downloading {0}...'.format(', '.join(requirements)))
+    pip = os.path.join(_get_env_bin_path(virtualenv_path), 'pip') \
+        if virtualenv_path else 'pip'
+    pip_cmd = [pip, 'download', '--dest', destination]
+    for path in find_links:
+        pip_cmd.extend(['--find-links', path])
+    pip_cmd.extend('"{0}"'.format(req) for req in requirements)
+    if pre:
+        pip_cmd.append('--pre')
+    result = run(' '.join(pip_cmd), retry=True)
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        sys.exit('Could not download: {0}.'.format(', '.join(requirements)))
+
+
+def merge_requirements(requirements):
+    """Merges the requirements of each distribution (e.g. when it's listed
+    in both dev-requirements.txt and requirements.txt) into one, as pip
+    refuses to be given the same distribution twice.
+
+    Requirements with environment markers are only deduplicated.
+    """
+    merged = collections.OrderedDict()
+    for requirement in requirements:
+        match = REQUIREMENT_LINE.match(requirement)
+        if not match or match.group('marker') is not None:
+            merged.setdefault(('line', requirement), None)
+            continue
+        name, extras, specifiers = merged.setdefault(
+            ('name', _normalize_name(match.group('name'))),
+            (match.group('name'), set(), []))
+        extras.update(extra.strip() for extra in
+                      (match.group('extras') or '').split(',')
+                      if extra.strip())
+        for specifier in match.group('specifiers').split(','):
+            specifier = specifier.replace(' ', '')
+            if specifier and specifier not in specifiers:
+                specifiers.append(specifier)
+    lines = []
+    for (kind, requirement), entry in merged.items():
+        if entry is None:
+            lines.append(requirement)
+            continue
+        name, extras, specifiers = entry
+        lines.append('{0}{1}{2}'.format(
+            name, '[{0}]'.format(','.join(sorted(extras))) if extras else '',
+            ','.join(specifiers)))
+    return lines
+
+
+def lock_requirements(download_dir, exclude=()):
+    """Returns the lines of a lock of the distributions pip downloaded to
+    `download_dir`, pinning each of them to its version and sha256 hash.
+
+    Distributions of the projects named in `exclude` are left out, including
+    source archives which aren't named after their project (e.g. GitHub
+    archives), whose name is read from their metadata. Raises ValueError for
+    files which aren't distributions.
+    """
+    exclude = set(_normalize_name(name) for name in exclude)
+    lines = []
+    for filename in sorted(os.listdir(download_dir)):
+        match = SDIST_FILENAME.match(filename)
+        if filename.endswith('.whl'):
+            name, version = filename.split('-')[:2]
+        elif match:
+            name, version = match.group('name', 'version')
+        else:
+            try:
+                with open(os.path.join(download_dir, filename), 'rb') as f:
+                    name = read_project_name(f)
+            except (tarfile.TarError, IOError):
+                name = None
+            if name and _normalize_name(name) in exclude:
+                continue
+            raise ValueError('not a distribution: {0}'.format(filename))
+        if _normalize_name(name) in exclude:
+            continue
+        digest = hashlib.sha256()
+        with open(os.path.join(download_dir, filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+                digest.update(chunk)
+        lines.append('{0}=={1} --hash=sha256:{2}'.format(
+            name, version, digest.hexdigest()))
+    return lines
+
+
+def read_project_name(stream):
+    """Returns the name of the project in a source archive (a tar stream),
+    as found in its PKG-INFO or, failing that, in its setup.py. Returns None
+    if neither names it.
+
+    As with extract_requirement_files, these are looked for at the top level
+    of the archive or within a single directory and reading stops as soon as
+    a PKG-INFO is found.
+    """
+    names = {}
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            parts = [part for part in member.name.split('/')
+                     if part not in ('', '.')]
+            if not (member.isfile() and len(parts) in (1, 2)):
+                continue
+            pattern = {'PKG-INFO': PKG_INFO_NAME,
+                       'setup.py': SETUP_PY_NAME}.get(parts[-1])
+            if not pattern:
+                continue
+            match = pattern.search(tar.extractfile(member).read())
+            if match:
+                names.setdefault((parts[-1] != 'PKG-INFO', len(parts)),
+                                 match.group(1))
+            if (False, 1) in names or (False, 2) in names:
+                break
+    return names[min(names)] if names else None
+
+
+def install_lock(lock_path, virtualenv_path=False, find_links=()):
+    """Installs the distributions pinned in a lock (see lock_requirements)
+    without resolving their dependencies.
+
+    If `find_links` are given, distributions are only looked up there.
+    """
+    lgr.info('Installing the locked requirements...')
+    pip = os.path.join(_get_env_bin_path(virtualenv_path), 'pip') \
+        if virtualenv_path else 'pip'
+    pip_cmd = [pip, 'install', '--require-hashes', '--no-deps', '-r',
+               lock_path]
+    if find_links:
+        pip_cmd.append('--no-index')
+        for path in find_links:
+            pip_cmd.extend(['--find-links', path])
+    with trace('install_lock', lock=lock_path, offline=bool(find_links)):
+        result = run(' '.join(pip_cmd), retry=not find_links)
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stdout)
+        sys.exit('Could not install the requirements locked in {0}.'.format(
+            lock_path))
+
+
+def build_wheels(module, wheels_path, version=False, pre=False,
+                 virtualenv_path=False, requirement_files=None,
+                 workers=WHEEL_BUILD_WORKERS):
+    """Populates `wheels_path` with wheels for a module and its dependencies.
+
+    The module (and requirement files) are resolved and downloaded using
+    `pip download`. Downloaded wheels are used as is while source
+    distributions are built into wheels concurrently, running up to
+    `workers` pip processes (each from a pool thread, so that they can be
+    killed on Ctrl-C like other commands). The resulting directory can be
+    used for an offline installation using --wheelspath.
+    """
+    lgr.info('Building wheels for {0} in {1}...'.format(module, wheels_path))
+    pip = os.path.join(_get_env_bin_path(virtualenv_path), 'pip') \
+        if virtualenv_path else 'pip'
+    download_dir = tempfile.mkdtemp()
+    try:
+        pip_cmd = [pip, 'download', '--dest', download_dir]
+        for req_file in requirement_files or []:
+            pip_cmd.extend(['-r', req_file])
+        pip_cmd.append('{0}=={1}'.format(module, version) if version
+                       else module)
+        if pre:
+            pip_cmd.append('--pre')
+        result = run(' '.join(pip_cmd), retry=True)
+        if not result.returncode == 0:
+            lgr.error(result.aggr_stdout)
+            sys.exit('Could not download {0} and its dependencies.'.format(
+                module))
+
+        if not os.path.isdir(wheels_path):
+            os.makedirs(wheels_path)
+        sdists = []
+        for name in sorted(os.listdir(download_dir)):
+            path = os.path.join(download_dir, name)
+            if name.endswith('.whl'):
+                shutil.move(path, os.path.join(wheels_path, name))
+            else:
+                sdists.append(path)
+        if sdists:
+            lgr.info('Building {0} wheel(s) using {1} process(es)...'.format(
+                len(sdists), workers))
+            pool = multiprocessing.pool.ThreadPool(
+                max(1, min(workers, len(sdists))))
+            try:
+                results = pool.map(
+                    _build_wheel, [(pip, sdist, wheels_path)
+                                   for sdist in sdists])
+            finally:
+                pool.close()
+                pool.join()
+            failed = [sdist for sdist, succeeded in results if not succeeded]
+            if failed:
+                sys.exit('Could not build wheels for: {0}.'.format(
+                    ', '.join(os.path.basename(sdist) for sdist in failed)))
+    finally:
+        shutil.rmtree(download_dir)
+    WheelhouseIndex(wheels_path).update()
+    lgr.info('Wheels are available in {0}.'.format(wheels_path))
+
+
+def _build_wheel(args):
+    """Builds a single source distribution into a wheel (in a pool thread).
+    """
+    pip, sdist, wheels_path = args
+    result = run('{0} wheel --no-deps --wheel-dir {1} {2}'.format(
+        pip, wheels_path, sdist))
+    if not result.returncode == 0:
+        lgr.error(result.aggr_stderr)
+    return sdist, result.returncode == 0
+
+
+def untar_requirement_files(archive, destination):
+    """This will extract requirement files from an archive.
+    """
+    with open(archive, 'rb') as f:
+        return extract_requirement_files(f, destination)
+
+
+def extract_requirement_files(stream, destination):
+    """Extracts requirement files from a tar stream into `destination`.
+
+    Requirement files are looked for at the top level of the archive or,
+    if all of it is contained in a single directory (as in GitHub
+    archives), directly within that directory. The archive is read
+    sequentially and reading stops as soon as all requirement files were
+    found. Returns the paths of the extracted files.
+    """
+    found = {}
+    root = None
+    single_root = True
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        for member in tar:
+            parts = [part for part in member.name.split('/')
+                     if part not in ('', '.')]
+            if not parts:
+                continue
+            root = root or parts[0]
+            single_root = single_root and parts[0] == root
+            depth = len(parts) - 1
+            if member.isfile() and depth in (0, 1) \
+                    and parts[-1] in REQUIREMENT_FILE_NAMES:
+                found[(depth, parts[-1])] = tar.extractfile(member).read()
+            if all((0, name) in found for name in REQUIREMENT_FILE_NAMES) \
+                    or single_root and all((1, name) in found
+                                           for name in REQUIREMENT_FILE_NAMES):
+                break
+    depth = 0 if any(key[0] == 0 for key in found) or not single_root else 1
+    req_files = []
+    for name in REQUIREMENT_FILE_NAMES:
+        if (depth, name) in found:
+            req_files.append(os.path.join(destination, name))
+            with open(req_files[-1], 'wb') as f:
+                f.write(found[(depth, name)])
+    return req_files
+
+
+def open_url(url):
+    """Returns a file object from which the contents of `url` can be read.
+
+    Unless `url` is a local file or a download cache is used, the contents
+    are streamed from the server as they are read.
+    """
+    if os.path.isfile(url):
+        return open(url, 'rb')
+    if download_cache is not None:
+        return open(download_cache.fetch(url), 'rb')
+    response = urllib2.urlopen(url, timeout=DOWNLOAD_TIMEOUT)
+    if response.geturl() != url:
+        lgr.debug('Redirected to {0}'.format(response.geturl()))
+    return response
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on `path` across processes.
+
+    Locking is only supported on POSIX. On Windows this does nothing.
+    """
+    if IS_WIN:
+        yield
+        return
+    import fcntl
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def trace(name, category='phase', **args):
+    """Returns a span of the global tracer timing the enclosed block.
+
+    The span yields its `args` dict, which may be updated with results
+    (e.g. an exit code) before the block ends. When tracing is disabled
+    the span records nothing.
+    """
+    if tracer is None:
+        return _untraced(args)
+    return tracer.span(name, category, **args)
+
+
+@contextlib.contextmanager
+def _untraced(args):
+    yield args
+
+
+def write_json(path, data):
+    """Atomically replaces the contents of `path` with `data` as JSON.
+    """
+    temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    if IS_WIN and os.path.isfile(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def download_file(url, destination):
+    lgr.info('Downloading {0} to {1}'.format(url, destination))
+    with trace('download', url=url):
+        _download_file(url, destination)
+
+
+def _download_file(url, destination):
+    if os.path.isfile(url):
+        shutil.copyfile(url, destination)
+        return
+    if download_cache is not None:
+        try:
+            download_cache.fetch(url, destination)
+            return
+        except (IOError, OSError) as ex:
+            # only the cache's own file operations are worked around, network
+            # errors (socket.error being an IOError) would just recur.
+            if isinstance(ex, (urllib2.URLError, socket.error)):
+                raise
+            lgr.warning('Download cache unusable ({0}), downloading '
+                        'without it.'.format(ex))
+    stream_download(url, destination)
+
+
+def stream_download(url, destination, headers=None):
+    """Downloads `url` to `destination` and returns (headers, sha256).
+
+    Redirects are followed within the same request and the body is streamed
+    to `<destination>.part` in DOWNLOAD_CHUNK_SIZE chunks while being hashed.
+    If the connection drops (or no data arrives for DOWNLOAD_TIMEOUT
+    seconds), the download is resumed from where it stopped using a Range
+    request (up to DOWNLOAD_RETRIES times, with an exponential backoff).
+    A `.part` file left by an earlier run is resumed as well, provided the
+    server confirms (via If-Range) that the file did not change in the
+    meantime. If that file turns out to be complete (the server refuses the
+    range with a 416 giving the same size and validator), it is used as is,
+    otherwise it is downloaded again from the start.
+    """
+    part_path = destination + '.part'
+    validator_path = part_path + '.validator'
+    retries = DOWNLOAD_RETRIES
+    while True:
+        request_headers = dict(headers or {})
+        offset = 0
+        if os.path.isfile(part_path) and os.path.isfile(validator_path):
+            offset = os.path.getsize(part_path)
+            with open(validator_path) as f:
+                request_headers['If-Range'] = f.read()
+            request_headers['Range'] = 'bytes={0}-'.format(offset)
+        try:
+            response = urllib2.urlopen(
+                urllib2.Request(url, headers=request_headers),
+                timeout=DOWNLOAD_TIMEOUT)
+            if response.geturl() != url:
+                lgr.debug('Redirected to {0}'.format(response.geturl()))
+            info = response.info()
+            validator = info.get('ETag') or info.get('Last-Modified')
+            resumed = response.getcode() == 206 and info.get(
+                'Content-Range', '').startswith('bytes {0}-'.format(offset))
+            if resumed:
+                lgr.debug('Resuming download of {0} from byte {1}'.format(
+                    url, offset))
+            else:
+                offset = 0
+            digest = hashlib.sha256()
+            with open(part_path, 'r+b' if resumed else 'wb') as f:
+                if resumed:
+                    for chunk in iter(
+                            lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+                        digest.update(chunk)
+                if validator and not resumed:
+                    with open(validator_path, 'w') as v:
+                        v.write(validator)
+                elif not validator and os.path.isfile(validator_path):
+                    os.remove(validator_path)
+                for chunk in iter(
+                        lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            expected = info.get('Content-Length')
+            if expected and os.path.getsize(part_path) != \
+                    offset + int(expected):
+                raise httplib.IncompleteRead(
+                    '', int(expected) + offset - os.path.getsize(part_path))
+        except urllib2.HTTPError as ex:
+            if not (ex.code == 416 and offset):
+                raise
+            info = ex.info()
+            validator = info.get('ETag') or info.get('Last-Modified')
+            with open(validator_path) as f:
+                unchanged = validator in (None, f.read())
+            if unchanged and info.get('Content-Range') == \
+                    'bytes */{0}'.format(offset):
+                lgr.debug('{0} was already downloaded'.format(url))
+                digest = hashlib.sha256()
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(
+                            lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+                        digest.update(chunk)
+                break
+            lgr.debug('Cannot resume the download of {0}, downloading it '
+                      'again'.format(url))
+            os.remove(part_path)
+            os.remove(validator_path)
+            continue
+        except (socket.error, httplib.HTTPException) as ex:
+            if not retries:
+                raise
+            delay = DOWNLOAD_RETRY_BACKOFF * 2 ** (
+                DOWNLOAD_RETRIES - retries)
+            retries -= 1
+            lgr.warning('Download of {0} interrupted ({1}), resuming in {2} '
+                        'second(s)...'.format(url, repr(ex), delay))
+            with trace('backoff', 'download', url=url, seconds=delay):
+                time.sleep(delay)
+            continue
+        break
+    if os.path.isfile(destination):
+        os.remove(destination)
+    os.rename(part_path, destination)
+    if os.path.isfile(validator_path):
+        os.remove(validator_path)
+    return info, digest.hexdigest()
+
+
+def probe_mirror(url, timeout=MIRROR_PROBE_TIMEOUT):
+    """Measures the latency of the server hosting `url`.
+
+    Returns the seconds it took to connect to the server and then to receive
+    the first byte of `url` (requested using a Range request so that only a
+    byte is sent), or None if the server couldn't be reached in time or
+    responded with an error. Local files have no latency.
+    """
+    if os.path.isfile(url):
+        return 0.0, 0.0
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == 'https':
+        connection = httplib.HTTPSConnection(parsed.netloc, timeout=timeout)
+    else:
+        connection = httplib.HTTPConnection(parsed.netloc, timeout=timeout)
+    try:
+        start = time.time()
+        connection.connect()
+        connected = time.time()
+        connection.request(
+            'GET', parsed.path + ('?' + parsed.query if parsed.query else ''),
+            headers={'Range': 'bytes=0-0'})
+        response = connection.getresponse()
+        response.read(1)
+        latency = connected - start, time.time() - connected
+    except (socket.error, httplib.HTTPException) as ex:
+        lgr.debug('Could not probe {0} ({1})'.format(url, repr(ex)))
+        return None
+    finally:
+        connection.close()
+    if response.status >= 400:
+        lgr.debug('Could not probe {0} ({1} {2})'.format(
+            url, response.status, response.reason))
+        return None
+    lgr.debug('Probed {0}: connected in {1:.0f}ms, first byte after '
+              '{2:.0f}ms.'.format(url, latency[0] * 1000, latency[1] * 1000))
+    return latency
+
+
+class Mirrors(object):
+    """Chooses the mirror to download each component from.
+
+    `mirrors` ({component: [url, ...]}) overrides COMPONENT_MIRRORS. The
+    mirrors of a component are probed concurrently and ranked by the time it
+    took to connect to them and to receive the first byte of the component,
+    followed by the mirrors which failed the probe. A ranking is reused for
+    `ttl` seconds (across processes when `cache_path` is provided) unless
+    downloading from its first mirror fails.
+    """
+    def __init__(self, mirrors=None, ttl=MIRROR_RANKING_TTL, cache_path=None,
+                 workers=MIRROR_PROBE_WORKERS):
+        self.mirrors = dict(COMPONENT_MIRRORS, **(mirrors or {}))
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.workers = workers
+        self._rankings = {}
+        self._lock = Lock()
+
+    def rank(self, component):
+        """Returns the mirrors of `component`, fastest first.
+        """
+        urls = self.mirrors[component]
+        if len(urls) < 2:
+            return list(urls)
+        with self._lock:
+            entry = self._rankings.get(component)
+            if entry is None and self.cache_path:
+                entry = self._load().get(component)
+            if not entry or entry['mirrors'] != urls or \
+                    not 0 <= time.time() - entry['time'] < self.ttl:
+                entry = self._probe(component, urls)
+                self._save(component, entry)
+            self._rankings[component] = entry
+            return entry['ranking']
+
+    def download(self, component, destination):
+        """Downloads `component` to `destination`, failing over to the next
+        mirror when downloading from one fails. Returns the URL used.
+        """
+        ranking = self.rank(component)
+        for index, url in enumerate(ranking):
+            try:
+                download_file(url, destination)
+                return url
+            except (EnvironmentError, httplib.HTTPException) as ex:
+                if index == len(ranking) - 1:
+                    raise
+                lgr.warning('Could not download {0} from {1} ({2}), trying '
+                            '{3}...'.format(component, url, repr(ex),
+                                            ranking[index + 1]))
+                # the next download probes the mirrors again.
+                with self._lock:
+                    self._rankings.pop(component, None)
+                    self._save(component, None)
+
+    def _probe(self, component, urls):
+        with trace('probe_mirrors', component=component) as span:
+            pool = multiprocessing.pool.ThreadPool(
+                max(1, min(self.workers, len(urls))))
+            try:
+                latencies = pool.map(probe_mirror, urls)
+            finally:
+                pool.close()
+                pool.join()
+            span.update(latencies=dict(zip(urls, latencies)))
+        reachable = sorted(
+            [(sum(latency), url) for url, latency in zip(urls, latencies)
+             if latency is not None])
+        ranking = [url for _, url in reachable] + [
+            url for url, latency in zip(urls, latencies) if latency is None]
+        if reachable:
+            lgr.info('Using {0} for {1} ({2:.0f}ms).'.format(
+                ranking[0], component, reachable[0][0] * 1000))
+        else:
+            lgr.warning('None of the mirrors of {0} responded.'.format(
+                component))
+        return {
+            'mirrors': urls,
+            'ranking': ranking,
+            'latencies': dict(zip(urls, latencies)),
+            'time': time.time(),
+        }
+
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, component, entry):
+        if not self.cache_path:
+            return
+        try:
+            with file_lock(self.cache_path + '.lock'):
+                rankings = self._load()
+                if entry is None:
+                    rankings.pop(component, None)
+                else:
+                    rankings[component] = entry
+                write_json(self.cache_path, rankings)
+        except (IOError, OSError) as ex:
+            lgr.debug('Could not write {0} ({1})'.format(self.cache_path, ex))
+
+
+class DownloadCache(object):
+    """A local, content-addressed cache for downloaded files.
+
+    Files are stored under `<path>/blobs` named by their sha256.
+    `<path>/index.json` maps each URL to its blob along with the ETag and
+    Last-Modified headers it was served with, which are used to revalidate
+    cached files with conditional requests. Once the blobs take more than
+    `max_size` MB, the least recently used ones are evicted.
+    The cache can be shared by concurrent processes: downloads of a URL and
+    updates of the index are serialized using lock files in `<path>/locks`.
+    """
+    def __init__(self, path, max_size=DOWNLOAD_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.blobs_path = os.path.join(path, 'blobs')
+        self.locks_path = os.path.join(path, 'locks')
+        self.index_path = os.path.join(path, 'index.json')
+        self.stats = {'hits': 0, 'misses': 0}
+        self._lock = Lock()
+        for directory in (self.blobs_path, self.locks_path):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _blob_path(self, sha256):
+        return os.path.join(self.blobs_path, sha256)
+
+    def _cached_entry(self, url):
+        with self._lock:
+            # another process may have updated the index since
+            self._index = self._load_index()
+            entry = self._index.get(url)
+        if entry and os.path.isfile(self._blob_path(entry['sha256'])):
+            return entry
+        return None
+
+    def fetch(self, url, destination=None):
+        """Copies `url` to `destination`, downloading it only if the cached
+        copy is missing or stale.
+
+        Returns the path of the cached copy.
+        """
+        url_hash = hashlib.sha1(url).hexdigest()
+        with file_lock(os.path.join(self.locks_path, url_hash)):
+            return self._fetch(url, url_hash, destination)
+
+    def _fetch(self, url, url_hash, destination):
+        entry = self._cached_entry(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        # downloads of a URL always use the same temporary file, so they
+        # can be resumed by later runs if interrupted.
+        temp_path = os.path.join(
+            self.blobs_path, '{0}.download'.format(url_hash))
+        try:
+            info, sha256 = stream_download(url, temp_path, headers)
+        except urllib2.HTTPError as ex:
+            if not (ex.code == 304 and entry):
+                raise
+            lgr.debug('Using cached copy of {0}'.format(url))
+            self._record(url, entry, hit=True)
+            blob_path = self._blob_path(entry['sha256'])
+            if destination:
+                shutil.copyfile(blob_path, destination)
+            return blob_path
+        blob_path = self._blob_path(sha256)
+        if os.path.isfile(blob_path):
+            os.remove(temp_path)
+        else:
+            os.rename(temp_path, blob_path)
+        entry = {
+            'sha256': sha256,
+            'size': os.path.getsize(blob_path),
+            'etag': info.get('ETag'),
+            'last_modified': info.get('Last-Modified'),
+        }
+        self._record(url, entry, hit=False)
+        if destination:
+            shutil.copyfile(blob_path, destination)
+        return blob_path
+
+    def _record(self, url, entry, hit):
+        with self._lock:
+            with file_lock(os.path.join(self.locks_path, 'index')):
+                self._index = self._load_index()
+                self.stats['hits' if hit else 'misses'] += 1
+                entry['last_used'] = time.time()
+                self._index[url] = entry
+                self._evict(keep=entry['sha256'])
+                write_json(self.index_path, self._index)
+
+    def _evict(self, keep):
+        """Removes least recently used blobs until the cache fits `max_size`.
+
+        The `keep` blob (the one just fetched) is never removed, even if it
+        doesn't fit on its own.
+        """
+        blobs = {}
+        for entry in self._index.values():
+            last_used = blobs.get(entry['sha256'], (0, 0))[1]
+            blobs[entry['sha256']] = (
+                entry['size'], max(last_used, entry['last_used']))
+        size = sum(blob_size for blob_size, _ in blobs.values())
+        for sha256, (blob_size, _) in sorted(
+                blobs.items(), key=lambda blob: blob[1][1]):
+            if size <= self.max_size:
+                break
+            if sha256 == keep:
+                continue
+            lgr.debug('Evicting {0} from the download cache'.format(sha256))
+            if os.path.isfile(self._blob_path(sha256)):
+                os.remove(self._blob_path(sha256))
+            self._index = dict((url, entry) for url, entry
+                               in self._index.items()
+                               if entry['sha256'] != sha256)
+            size -= blob_size
+
+    def report(self):
+        lgr.info('Download cache ({0}): {1} hit(s), {2} miss(es).'.format(
+            self.path, self.stats['hits'], self.stats['misses']))
+
+
+def get_missing_system_packages(manager, packages):
+    """Returns those of `packages` which are not installed.
+
+    Rather than loading the package manager, the dpkg status file or the
+    pacman local database are read directly and rpm is queried once for
+    all packages (yum).
+    """
+    if manager == 'apt':
+        installed = _get_installed_dpkg_packages()
+    elif manager == 'yum':
+        result = run('rpm -q --whatprovides {0}'.format(' '.join(packages)),
+                     suppress_errors=True)
+        if result.returncode == 127:
+            return list(packages)
+        return [package for package in packages
+                if 'no package provides {0}'.format(package)
+                in result.aggr_stdout]
+    elif manager == 'pacman':
+        try:
+            installed = set(entry.rsplit('-', 2)[0]
+                            for entry in os.listdir(PACMAN_LOCAL_DB_PATH))
+        except OSError:
+            installed = set()
+    return [package for package in packages if package not in installed]
+
+
+def _get_installed_dpkg_packages():
+    """Returns the names of installed packages, and of the virtual packages
+    they provide, from the dpkg status file.
+    """
+    installed = set()
+    names = []
+    state = ''
+    try:
+        with open(DPKG_STATUS_PATH) as f:
+            for line in itertools.chain(f, ['\n']):
+                if line.startswith('Package:'):
+                    names.append(line.split(':', 1)[1].strip())
+                elif line.startswith('Provides:'):
+                    names.extend(provided.split()[0] for provided in
+                                 line.split(':', 1)[1].split(','))
+                elif line.startswith('Status:'):
+                    state = line.split()[-1]
+                elif not line.strip():
+                    if state == 'installed':
+                        installed.update(names)
+                    names = []
+                    state = ''
+    except IOError:
+        pass
+    return installed
+
+
+def install_system_packages(manager, packages):
+    """Installs those of `packages` which are missing in one transaction.
+
+    Returns the packages which were installed.
+    """
+    with trace('install_system_packages', packages=packages) as span:
+        missing = get_missing_system_packages(manager, packages)
+        span['missing'] = missing
+        if not missing:
+            lgr.info('System packages already installed: {0}.'.format(
+                ', '.join(packages)))
+            return []
+        lgr.info('Installing system packages: {0}...'.format(
+            ', '.join(missing)))
+        result = run(SYSTEM_PACKAGE_INSTALL_COMMANDS[manager].format(
+            ' '.join(missing)), retry=True)
+        if not result.returncode == 0:
+            sys.exit('Could not install system packages: {0}.'.format(
+                ', '.join(missing)))
+        return missing
+
+
+def get_os_props(cache_path=None):
+    """Returns the (distro, release) of the Linux distribution.
+
+    The distribution is identified by its os-release file, falling back to
+    the older lsb-release, redhat-release and arch-release files. A
+    derivative is reported as the supported distribution it is like (its
+    os-release ID_LIKE), e.g. Linux Mint as ubuntu.
+    The result is cached for the rest of the process and, if `cache_path`
+    is provided, on disk for as long as the file it was read from doesn't
+    change.
+    """
+    global _os_props
+    if _os_props is not None:
+        return _os_props
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached['path'] and \
+                os.path.getmtime(cached['path']) == cached['mtime']:
+            _os_props = cached['distro'], cached['release']
+            return _os_props
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+
+    _os_props, path = _read_os_props()
+    if cache_path and path:
+        try:
+            write_json(cache_path, {
+                'path': path,
+                'mtime': os.path.getmtime(path),
+                'distro': _os_props[0],
+                'release': _os_props[1],
+            })
+        except (IOError, OSError) as ex:
+            lgr.debug('Could not write {0} ({1})'.format(cache_path, ex))
+    return _os_props
+
+
+def _read_os_props():
+    """Returns the (distro, release) along with the file identifying them.
+    """
+    for path in OS_RELEASE_PATHS:
+        fields = _read_release_fields(path)
+        if fields:
+            ids = [DISTRO_ALIASES.get(distro, distro) for distro in
+                   [fields.get('ID', '')] + fields.get('ID_LIKE', '').split()]
+            supported = [distro for distro in ids
+                         if distro in SUPPORTED_DISTROS]
+            return ((supported or ids)[0], fields.get('VERSION_ID', '')), path
+    fields = _read_release_fields(LSB_RELEASE_PATH)
+    if fields and 'DISTRIB_ID' in fields:
+        distro = fields['DISTRIB_ID'].lower()
+        return (DISTRO_ALIASES.get(distro, distro),
+                fields.get('DISTRIB_RELEASE', '')), LSB_RELEASE_PATH
+    try:
+        with open(REDHAT_RELEASE_PATH) as f:
+            # e.g. "CentOS release 6.5 (Final)"
+            match = re.match(r'(\w+).* release ([\d.]+)', f.read())
+        if match:
+            distro = match.group(1).lower()
+            return (DISTRO_ALIASES.get(distro, distro),
+                    match.group(2)), REDHAT_RELEASE_PATH
+    except IOError:
+        pass
+    if os.path.isfile(ARCH_RELEASE_PATH):
+        return ('arch', ''), ARCH_RELEASE_PATH
+    if hasattr(platform, 'linux_distribution'):
+        distro, _, release = platform.linux_distribution(
+            full_distribution_name=False)
+        return (distro.lower(), release.lower()), None
+    return ('', ''), None
+
+
+def _read_release_fields(path):
+    """Reads the KEY=value fields of an os-release (or lsb-release) file.
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return {}
+    fields = {}
+    for line in lines:
+        key, sep, value = line.partition('=')
+        if sep and not key.startswith('#'):
+            fields[key.strip()] = value.strip().strip('"\'')
+    return fields
+
+
+def _get_env_bin_path(env_path):
+    """returns the bin path for a virtualenv
+    """
+    try:
+        import virtualenv
+        return virtualenv.path_locations(env_path)[3]
+    except ImportError:
+        # this is a fallback for a race condition in which you're trying
+        # to use the script and create a virtualenv from within
+        # a virtualenv in which virtualenv isn't installed and so
+        # is not importable.
+        return os.path.join(env_path, 'scripts' if IS_WIN else 'bin')
+
+
+class OutputCapture(object):
+    """Captures output in memory up to `limit` bytes.
+
+    Once the limit is crossed the full transcript is spilled to a temporary
+    log file and only a head and a tail of the output are kept in memory,
+    so memory usage stays bounded regardless of how much is written.
+    """
+    def __init__(self, limit=OUTPUT_CAPTURE_LIMIT,
+                 head_size=OUTPUT_CAPTURE_HEAD_SIZE,
+                 tail_size=OUTPUT_CAPTURE_TAIL_SIZE):
+        self.limit = limit
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.size = 0
+        self.log_path = None
+        self._chunks = []
+        self._head = ''
+        self._tail = collections.deque()
+        self._tail_bytes = 0
+        self._log = None
+
+    @property
+    def spilled(self):
+        return self.log_path is not None
+
+    def write(self, data):
+        self.size += len(data)
+        if self._log is not None:
+            self._log.write(data)
+            self._append_tail(data)
+            return
+        self._chunks.append(data)
+        if self.size > self.limit:
+            self._spill()
+
+    def _spill(self):
+        fd, self.log_path = tempfile.mkstemp(
+            prefix='get-cloudify-', suffix='.log')
+        self._log = os.fdopen(fd, 'wb')
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._log.write(data)
+        self._head = data[:self.head_size]
+        self._append_tail(data)
+
+    def _append_tail(self, data):
+        data = data[-self.tail_size:]
+        self._tail.append(data)
+        self._tail_bytes += len(data)
+        while self._tail_bytes - len(self._tail[0]) >= self.tail_size:
+            self._tail_bytes -= len(self._tail.popleft())
+
+    def close(self):
+        if self._log is not None and not self._log.closed:
+            self._log.close()
+
+    def discard(self):
+        """Removes the spilled log file, if any.
+        """
+        self.close()
+        if self.log_path and os.path.isfile(self.log_path):
+            os.remove(self.log_path)
+
+    def getvalue(self):
+        if not self.spilled:
+            if len(self._chunks) > 1:
+                self._chunks = [''.join(self._chunks)]
+            return self._chunks[0] if self._chunks else ''
+        tail = ''.join(self._tail)[-self.tail_size:]
+        omitted = self.size - len(self._head) - len(tail)
+        if os.path.isfile(self.log_path):
+            note = 'full output in {0}'.format(self.log_path)
+        else:
+            note = 'full output discarded'
+        return '{0}\n[... {1} bytes omitted, {2} ...]\n{3}'.format(
+            self._head, omitted, note, tail)
+
+
+class PipeReader(Thread):
+    """Aggregates and logs the output of a pipe line by line.
+
+    Output is either fed by `multiplex_output` or, when started as a thread,
+    read directly from `fd` until EOF.
+    All output is passed on to the transcript as it arrives. Only progress
+    lines and warnings are logged to the console at INFO/WARNING level, the
+    rest at DEBUG level, and lines beyond the rate allowed by the console
+    limiter are only counted in `omitted`. The last lines are kept in `tail`
+    so that they can be logged if the command fails. Nothing is logged when
+    `log_level` is NOTSET.
+    """
+    def __init__(self, fd, proc, logger, log_level,
+                 capture_limit=OUTPUT_CAPTURE_LIMIT, source=None, tail=None):
+        Thread.__init__(self)
+        self.fd = fd
+        self.proc = proc
+        self.logger = logger
+        self.log_level = log_level
+        self.capture = OutputCapture(capture_limit)
+        self.source = source
+        self.tail = collections.deque(maxlen=CONSOLE_ERROR_TAIL_LINES) \
+            if tail is None else tail
+        self.omitted = 0
+        self.last_output = 0
+        self._partial_line = ''
+
+    @property
+    def aggr(self):
+        return self.capture.getvalue()
+
+    def feed(self, output):
+        self.last_output = time.time()
+        self.capture.write(output)
+        if transcript is not None:
+            transcript.write(self.source, output)
+        lines = (self._partial_line + output).split('\n')
+        self._partial_line = lines.pop()
+        for line in lines:
+            self._log(line)
+        # don't buffer endless output which has no line breaks
+        if len(self._partial_line) > PIPE_READ_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._partial_line:
+            self._log(self._partial_line)
+            self._partial_line = ''
+
+    def _log(self, line):
+        if self.log_level == logging.NOTSET:
+            return
+        self.tail.append(line)
+        if WARNING_LINE.search(line):
+            level = logging.WARNING
+        elif PROGRESS_LINE.match(line):
+            level = logging.INFO
+        else:
+            level = logging.DEBUG
+        if not self.logger.isEnabledFor(level):
+            return
+        if console_limiter is None or console_limiter.allow():
+            self.logger.log(level, line)
+        else:
+            self.omitted += 1
+
+    def run(self):
+        for output in iter(self.fd.readline, ''):
+            self.feed(output)
+        self.flush()
+
+
+class Watchdog(object):
+    """Kills a command running for longer than `timeout` seconds or not
+    writing any output to the pipes of `readers` for `stall_timeout` seconds.
+
+    Either limit is disabled when set to 0. Once the command is killed,
+    `timed_out` is set to "timeout" or "stall" on `proc`.
+    """
+    def __init__(self, proc, readers, timeout=0, stall_timeout=0):
+        self.proc = proc
+        self.readers = readers
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.start = time.time()
+
+    def check(self):
+        if self.proc.timed_out or not (self.timeout or self.stall_timeout):
+            return
+        now = time.time()
+        if self.timeout and now - self.start > self.timeout:
+            self.proc.timed_out = 'timeout'
+        elif self.stall_timeout and now - max(
+                [self.start] + [reader.last_output
+                                for reader in self.readers]) \
+                > self.stall_timeout:
+            self.proc.timed_out = 'stall'
+        else:
+            return
+        lgr.debug('Killing process {0} ({1}).'.format(
+            self.proc.pid, self.proc.timed_out))
+        kill_process_group(self.proc)
+
+
+class RateLimiter(object):
+    """Allows up to `rate` events per second, in bursts of up to `rate`.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._allowance = self.rate
+        self._last = time.time()
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time.time()
+            self._allowance = min(
+                self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            if self._allowance < 1:
+                return False
+            self._allowance -= 1
+            return True
+
+
+class Transcript(object):
+    """Writes the output of the commands run to a log file.
+
+    Output is queued by `write` and written in batches by a background
+    thread, so that logging it doesn't hold back draining the pipes. Each
+    batch is appended with a single write, so processes may share the file.
+    Whenever the output comes from a different source than the previous
+    output, it is preceded by a "==> source <==" header.
+    In forked processes (e.g. pool workers), where the writer thread isn't
+    running, output is written as it arrives instead.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pid = os.getpid()
+        self._queue = Queue.Queue()
+        self._source = None
+        self._line_start = True
+        self._writer = Thread(target=self._write_batches)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def write(self, source, data):
+        if os.getpid() == self._pid:
+            self._queue.put((source, data))
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            self._write(fd, [(source, data)])
+        finally:
+            os.close(fd)
+
+    def close(self):
+        """Waits for the queued output to be written.
+        """
+        self._queue.put(None)
+        self._writer.join()
+
+    def _write_batches(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            closed = False
+            while not closed:
+                items = [self._queue.get()]
+                while True:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                if None in items:
+                    closed = True
+                    items.remove(None)
+                self._write(fd, items)
+        finally:
+            os.close(fd)
+
+    def _write(self, fd, items):
+        chunks = []
+        for source, data in items:
+            if source != self._source:
+                header = '{0}==> {1} <==\n'.format(
+                    '' if self._line_start else '\n', source)
+                if not isinstance(header, str):
+                    header = header.encode('utf-8')
+                chunks.append(header)
+                self._source = source
+            if data:
+                chunks.append(data)
+                self._line_start = data.endswith('\n')
+        if chunks:
+            os.write(fd, ''.join(chunks))
+
+
+class Prefetcher(object):
+    """Fetches the artifacts an installation needs on a pool of threads,
+    ahead of the phases using them.
+
+    Each artifact is fetched by a function returning its local path.
+    Fetches start in the order they were added, so a fetch may wait (using
+    `get`) for an artifact added before it. Failing fetches are only logged:
+    the phase needing the artifact then fetches it as it would without
+    prefetching.
+    """
+    def __init__(self, workers=PREFETCH_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._results = {}
+        self._lock = Lock()
+        self._cancelled = False
+        # the threads currently fetching artifacts
+        self._threads = set()
+
+    @property
+    def names(self):
+        return list(self._results)
+
+    def start(self, artifacts):
+        """Starts fetching `artifacts`, a list of (name, func) tuples.
+        """
+        if not artifacts:
+            return
+        lgr.debug('Prefetching: {0}'.format(
+            ', '.join(name for name, _ in artifacts)))
+        self._pool = multiprocessing.pool.ThreadPool(
+            max(1, min(self.workers, len(artifacts))))
+        for name, func in artifacts:
+            self._results[name] = self._pool.apply_async(
+                self._fetch, (name, func))
+        self._pool.close()
+
+    def get(self, name):
+        """Waits for an artifact and returns its local path, or None if it
+        wasn't prefetched.
+        """
+        result = self._results.get(name)
+        return result.get() if result is not None else None
+
+    def cancel(self):
+        """Skips the fetches which haven't started yet and kills the commands
+        run by those which are running (see kill_commands).
+        """
+        with self._lock:
+            self._cancelled = True
+            threads = list(self._threads)
+        kill_commands(threads)
+
+    def join(self):
+        if self._pool is not None:
+            self._pool.join()
+
+    def _fetch(self, name, func):
+        with self._lock:
+            if self._cancelled:
+                return None
+            self._threads.add(current_thread())
+        try:
+            with trace('prefetch {0}'.format(name), 'prefetch'):
+                return func()
+        except (Exception, SystemExit) as ex:
+            if not self._cancelled:
+                lgr.warning('Could not prefetch {0} ({1}), it will be '
+                            'fetched when needed.'.format(name, str(ex)))
+            return None
+        finally:
+            with self._lock:
+                self._threads.discard(current_thread())
+
+
+class TaskGraph(object):
+    """Runs tasks on a pool of worker threads according to their dependencies.
+
+    A task is started once all the tasks it depends on have succeeded.
+    Dependencies on tasks which were never added are ignored, so tasks must
+    be added after the tasks they depend on.
+    When a task fails, everything downstream of it is cancelled. Tasks that
+    are already running (or are independent of the failed one) are allowed
+    to finish, after which the first failure is raised again.
+    When interrupted, no more tasks are started and the commands run by the
+    running ones are killed (see kill_commands), after which the
+    KeyboardInterrupt is raised again.
+    """
+    def __init__(self, workers=EXECUTE_WORKERS):
+        self.workers = workers
+        self._tasks = collections.OrderedDict()
+
+    @property
+    def names(self):
+        return list(self._tasks)
+
+    def add(self, name, func, depends_on=()):
+        self._tasks[name] = (
+            func, set(dep for dep in depends_on if dep in self._tasks))
+
+    def _downstream_of(self, name):
+        downstream = set([name])
+        for task, (_, deps) in self._tasks.items():
+            if deps & downstream:
+                downstream.add(task)
+        downstream.discard(name)
+        return downstream
+
+    def run(self):
+        work = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            for name in iter(work.get, None):
+                try:
+                    with trace(name, 'task'):
+                        self._tasks[name][0]()
+                    done.put((name, None))
+                except BaseException as ex:
+                    lgr.debug('Task {0} failed.'.format(name), exc_info=True)
+                    done.put((name, ex))
+
+        pending = dict((name, set(deps))
+                       for name, (_, deps) in self._tasks.items())
+        threads = [Thread(target=worker)
+                   for _ in range(max(1, min(self.workers, len(pending))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        failure = None
+        running = 0
+        try:
+            while pending or running:
+                for name in [n for n in self._tasks
+                             if not pending.get(n, True)]:
+                    del pending[name]
+                    lgr.debug('Starting task {0}...'.format(name))
+                    work.put(name)
+                    running += 1
+                if not running:
+                    break
+                try:
+                    name, error = done.get(timeout=TASK_POLLING_INTERVAL)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                if error is None:
+                    for deps in pending.values():
+                        deps.discard(name)
+                    continue
+                failure = failure or error
+                for cancelled in self._downstream_of(name) & set(pending):
+                    lgr.debug('Cancelling task {0}.'.format(cancelled))
+                    del pending[cancelled]
+        except KeyboardInterrupt:
+            lgr.warning('Interrupted, stopping the running tasks...')
+            for thread in threads:
+                work.put(None)
+            # the commands run by the tasks don't receive it
+            kill_commands()
+            self._wait(done, running)
+            raise
+
+        for thread in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        if failure is not None:
+            raise failure
+
+    @staticmethod
+    def _wait(done, running):
+        """Waits for the running tasks to finish (which they do once their
+        commands were killed) unless interrupted again.
+        """
+        try:
+            while running:
+                try:
+                    done.get(timeout=TASK_POLLING_INTERVAL)
+                    running -= 1
+                except Queue.Empty:
+                    pass
+        except KeyboardInterrupt:
+            pass
+
+
+class Tracer(object):
+    """Records timed spans as Chrome trace events.
+
+    Each span is recorded as a complete ("X") event with its start time and
+    duration in microseconds, the process and thread it ran in and its
+    args. `save` writes the events in the trace event format, which can be
+    loaded into chrome://tracing, Perfetto or speedscope.
+    """
+    def __init__(self):
+        self.events = []
+        self._lock = Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **args):
+        start = time.time()
+        try:
+            yield args
+        except BaseException as ex:
+            args['error'] = str(ex) or type(ex).__name__
+            raise
+        finally:
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((time.time() - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': current_thread().ident,
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def save(self, path):
+        lgr.info('Writing trace to {0}...'.format(path))
+        with self._lock:
+            events = list(self.events)
+        write_json(path, {'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+class WheelhouseIndex(object):
+    """An index of the wheels in a wheelhouse.
+
+    The index is kept in `<wheels_path>/index.json` and records each wheel's
+    name, version, tags, size, mtime, sha256 and requirements. It is updated
+    incrementally: only wheels which are new or whose size or mtime changed
+    are read again. Their sha256 is recorded then, so a wheel which changes
+    afterwards (even in place, keeping its size and mtime) is reported as
+    corrupted by `verify`.
+    """
+    def __init__(self, wheels_path, workers=WHEEL_VERIFY_WORKERS):
+        self.wheels_path = wheels_path
+        self.index_path = os.path.join(wheels_path, WHEELHOUSE_INDEX_NAME)
+        self.workers = workers
+        try:
+            with open(self.index_path) as f:
+                self.wheels = json.load(f)
+        except (IOError, ValueError):
+            self.wheels = {}
+        # wheels read by `update` which needn't be verified again
+        self._fresh = set()
+
+    def _map(self, func, items):
+        if not items:
+            return []
+        pool = multiprocessing.pool.ThreadPool(
+            max(1, min(self.workers, len(items))))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _hash(self, filename):
+        digest = hashlib.sha256()
+        with open(os.path.join(self.wheels_path, filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _read_wheel(self, filename):
+        path = os.path.join(self.wheels_path, filename)
+        parts = filename[:-len('.whl')].split('-')
+        entry = {
+            'name': parts[0],
+            'version': parts[1],
+            'tags': parts[-3:],
+            'size': os.path.getsize(path),
+            'mtime': os.path.getmtime(path),
+            'sha256': self._hash(filename),
+            'requires': [],
+        }
+        try:
+            with zipfile.ZipFile(path) as wheel:
+                if wheel.testzip() is not None:
+                    raise zipfile.BadZipfile('CRC check failed')
+                metadata = [name for name in wheel.namelist()
+                            if name.endswith('.dist-info/METADATA')]
+                for line in wheel.read(metadata[0]).splitlines():
+                    if not line.strip():
+                        break
+                    if line.startswith('Requires-Dist:'):
+                        entry['requires'].append(line.split(':', 1)[1].strip())
+        except (zipfile.BadZipfile, IndexError, IOError) as ex:
+            entry['error'] = str(ex) or 'no metadata found'
+        return filename, entry
+
+    def update(self):
+        """Brings the index up to date with the wheelhouse.
+        """
+        filenames = [name for name in os.listdir(self.wheels_path)
+                     if name.endswith('.whl')]
+        changed = []
+        for filename in filenames:
+            path = os.path.join(self.wheels_path, filename)
+            entry = self.wheels.get(filename)
+            if not entry or entry['size'] != os.path.getsize(path) \
+                    or entry['mtime'] != os.path.getmtime(path):
+                changed.append(filename)
+        removed = set(self.wheels) - set(filenames)
+        for filename in removed:
+            del self.wheels[filename]
+        if changed:
+            lgr.info('Indexing {0} wheel(s) in {1}...'.format(
+                len(changed), self.wheels_path))
+            self.wheels.update(self._map(self._read_wheel, changed))
+            self._fresh.update(changed)
+        if changed or removed:
+            try:
+                write_json(self.index_path, self.wheels)
+            except (IOError, OSError) as ex:
+                lgr.debug('Could not write {0} ({1})'.format(
+                    self.index_path, ex))
+
+    def verify(self):
+        """Verifies the wheels concurrently and returns the corrupted ones.
+
+        Every indexed wheel which `update` didn't just read is hashed again
+        and compared with the index (those which are gone are corrupted).
+        """
+        stale, gone = [], set()
+        for filename in sorted(set(self.wheels) - self._fresh):
+            if os.path.isfile(os.path.join(self.wheels_path, filename)):
+                stale.append(filename)
+            else:
+                gone.add(filename)
+        lgr.debug('Verifying {0} wheel(s) in {1}...'.format(
+            len(stale), self.wheels_path))
+        hashes = dict(zip(stale, self._map(self._hash, stale)))
+        return sorted(
+            filename for filename, entry in self.wheels.items()
+            if 'error' in entry or filename in gone or
+            hashes.get(filename, entry['sha256']) != entry['sha256'])
+
+    def resolve(self, requirements, interpreter):
+        """Resolves requirements against the wheels in the wheelhouse.
+
+        Only wheels `interpreter` supports are considered (see
+        get_interpreter_tags). Requirements whose markers don't apply to
+        `interpreter` are skipped. Like pip, the highest version satisfying a
+        requirement is chosen and then the requirements of the chosen wheel
+        (those whose markers apply) are resolved in turn.
+        Returns the chosen wheels ({name: filename}) and the requirements
+        the wheelhouse cannot satisfy. Raises ValueError if a requirement
+        cannot be parsed.
+        """
+        import pkg_resources
+
+        candidates = {}
+        for filename, entry in self.wheels.items():
+            if 'error' not in entry and \
+                    wheel_compatible(entry['tags'], interpreter):
+                candidates.setdefault(
+                    _normalize_name(entry['name']), []).append(
+                        (pkg_resources.parse_version(entry['version']),
+                         filename))
+        chosen = {}
+        extras = {}
+        missing = []
+        pending = collections.deque()
+        for req in requirements:
+            requirement = pkg_resources.Requirement.parse(req)
+            if requirement.marker is None or requirement.marker.evaluate(
+                    dict(interpreter['environment'], extra='')):
+                pending.append(requirement)
+        while pending:
+            requirement = pending.popleft()
+            name = _normalize_name(requirement.project_name)
+            # markers were already evaluated
+            unmet = '{0}{1}{2}'.format(
+                requirement.project_name,
+                '[{0}]'.format(','.join(requirement.extras))
+                if requirement.extras else '',
+                requirement.specifier)
+            if name not in chosen:
+                matches = sorted(
+                    (version, filename)
+                    for version, filename in candidates.get(name, [])
+                    if self.wheels[filename]['version'] in requirement)
+                if not matches:
+                    if unmet not in missing:
+                        missing.append(unmet)
+                    continue
+                chosen[name] = matches[-1][1]
+                extras[name] = set()
+                new_extras = set(requirement.extras) | set([''])
+            elif self.wheels[chosen[name]]['version'] not in requirement:
+                if unmet not in missing:
+                    missing.append(unmet)
+                continue
+            else:
+                new_extras = set(requirement.extras) - extras[name]
+            for req in self.wheels[chosen[name]]['requires']:
+                dependency = pkg_resources.Requirement.parse(req)
+                if dependency.marker is None:
+                    if '' in new_extras:
+                        pending.append(dependency)
+                elif any(dependency.marker.evaluate(
+                        dict(interpreter['environment'], extra=extra))
+                        for extra in new_extras):
+                    pending.append(dependency)
+            extras[name].update(new_extras)
+        return chosen, missing
 
-    Can specify a specific version.
-    Can specify a prerelease.
-    Can specify a virtualenv to install in.
-    Can specify a list of paths or urls to requirement txt files.
-    Can specify a local wheelspath to use for offline installation.
-    Can request an upgrade.
-    """
-    lgr.info('Installing {0}...'.format(module))
-    pip_cmd = ['pip', 'install']
-    if virtualenv_path:
-        pip_cmd[0] = os.path.join(
-            _get_env_bin_path(virtualenv_path), pip_cmd[0])
-    if requirement_files:
-        for req_file in requirement_files:
-            pip_cmd.extend(['-r', req_file])
-    module = '{0}=={1}'.format(module, version) if version else module
-    pip_cmd.append(module)
-    if wheelspath:
-        pip_cmd.extend(
-            ['--use-wheel', '--no-index', '--find-links', wheelspath])
-    if pre:
-        pip_cmd.append('--pre')
-    if upgrade:
-        pip_cmd.append('--upgrade')
-    if IS_VIRTUALENV and not virtualenv_path:
-        lgr.info('Installing within current virtualenv: {0}...'.format(
-            IS_VIRTUALENV))
-    result = run(' '.join(pip_cmd))
-    if not result.returncode == 0:
-        lgr.error(result.aggr_stdout)
-        sys.exit('Could not install module: {0}.'.format(module))
 
+class VirtualenvTemplateCache(object):
+    """Keeps fully installed virtualenvs from which new ones can be cloned.
 
-def untar_requirement_files(archive, destination):
-    """This will extract requirement files from an archive.
+    Each template is stored in `<path>/<key>/virtualenv` along with
+    `<path>/<key>/template.json` recording the path it was originally
+    created in. Cloning hardlinks (or, where supported, reflinks) the
+    template's files into the new virtualenv and rewrites the scripts and
+    symlinks which refer to the original path.
     """
-    with tarfile.open(name=archive) as tar:
-        req_files = [req_file for req_file in tar.getmembers()
-                     if os.path.basename(req_file.name)
-                     in REQUIREMENT_FILE_NAMES]
-        tar.extractall(path=destination, members=req_files)
+    def __init__(self, path):
+        self.path = path
+        self._reflink = IS_LINUX
+        if not os.path.isdir(path):
+            os.makedirs(path)
 
+    @staticmethod
+    def key(**inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
 
-def download_file(url, destination):
-    lgr.info('Downloading {0} to {1}'.format(url, destination))
-    final_url = urllib.urlopen(url).geturl()
-    if final_url != url:
-        lgr.debug('Redirected to {0}'.format(final_url))
-    f = urllib.URLopener()
-    f.retrieve(final_url, destination)
+    def store(self, key, virtualenv_path):
+        template_path = os.path.join(self.path, key)
+        if os.path.isdir(template_path):
+            return
+        lgr.info('Storing virtualenv template {0}...'.format(key))
+        temp_path = '{0}.{1}.tmp'.format(template_path, os.getpid())
+        try:
+            shutil.copytree(virtualenv_path,
+                            os.path.join(temp_path, 'virtualenv'),
+                            symlinks=True)
+            write_json(os.path.join(temp_path, 'template.json'),
+                       {'origin': os.path.abspath(virtualenv_path)})
+            try:
+                os.rename(temp_path, template_path)
+            except OSError:
+                # stored concurrently by another installation
+                if not os.path.isdir(template_path):
+                    raise
+        finally:
+            if os.path.isdir(temp_path):
+                shutil.rmtree(temp_path)
 
+    def clone(self, key, virtualenv_path):
+        """Creates `virtualenv_path` from the template stored under `key`.
 
-def get_os_props():
-    distro, _, release = platform.linux_distribution(
-        full_distribution_name=False)
-    return distro, release
+        Returns False if there is no such template.
+        """
+        try:
+            with open(os.path.join(self.path, key, 'template.json')) as f:
+                origin = json.load(f)['origin']
+        except (IOError, ValueError):
+            return False
+        template_path = os.path.join(self.path, key, 'virtualenv')
+        lgr.info('Cloning virtualenv template {0} to {1}...'.format(
+            key, virtualenv_path))
+        destination = os.path.abspath(virtualenv_path)
+        bin_path = os.path.join(
+            template_path, 'Scripts' if IS_WIN else 'bin')
+        for root, dirs, files in os.walk(template_path):
+            target_root = os.path.join(
+                destination, os.path.relpath(root, template_path))
+            if not os.path.isdir(target_root):
+                os.makedirs(target_root)
+            for name in dirs + files:
+                source = os.path.join(root, name)
+                target = os.path.join(target_root, name)
+                if os.path.islink(source):
+                    link = os.readlink(source)
+                    if link.startswith(origin):
+                        link = destination + link[len(origin):]
+                    os.symlink(link, target)
+                elif name in files:
+                    if root == bin_path or name.endswith(
+                            ('.pth', '.egg-link')):
+                        self._copy_rewritten(
+                            source, target, origin, destination)
+                    else:
+                        self._link(source, target)
+            # symlinks to directories were already created and mustn't be
+            # walked into.
+            dirs[:] = [d for d in dirs
+                       if not os.path.islink(os.path.join(root, d))]
+        return True
 
+    @staticmethod
+    def _copy_rewritten(source, target, origin, destination):
+        with open(source, 'rb') as f:
+            content = f.read()
+        if '\0' not in content[:1024]:
+            content = content.replace(origin, destination)
+        with open(target, 'wb') as f:
+            f.write(content)
+        shutil.copymode(source, target)
 
-def _get_env_bin_path(env_path):
-    """returns the bin path for a virtualenv
+    def _link(self, source, target):
+        """Reflinks, hardlinks or (if neither is possible) copies a file.
+        """
+        if self._reflink:
+            import fcntl
+            try:
+                with open(source, 'rb') as src:
+                    with open(target, 'wb') as dst:
+                        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                shutil.copystat(source, target)
+                return
+            except (IOError, OSError):
+                # the filesystem doesn't support it, don't try again.
+                self._reflink = False
+                os.remove(target)
+        try:
+            os.link(source, target)
+        except (AttributeError, OSError):
+            shutil.copy2(source, target)
+
+
+class RequirementLocks(object):
+    """Keeps the locks requirements were resolved to (see
+    lock_requirements).
+
+    Each lock is stored as a requirements file, `<path>/<key>.txt`, where the
+    key identifies the requirements and the interpreter they were resolved
+    for.
     """
-    try:
-        import virtualenv
-        return virtualenv.path_locations(env_path)[3]
-    except ImportError:
-        # this is a fallback for a race condition in which you're trying
-        # to use the script and create a virtualenv from within
-        # a virtualenv in which virtualenv isn't installed and so
-        # is not importable.
-        return os.path.join(env_path, 'scripts' if IS_WIN else 'bin')
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
 
+    @staticmethod
+    def key(**inputs):
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True)).hexdigest()
 
-class PipeReader(Thread):
-    def __init__(self, fd, proc, logger, log_level):
-        Thread.__init__(self)
-        self.fd = fd
-        self.proc = proc
-        self.logger = logger
-        self.log_level = log_level
-        self.aggr = ''
+    def _lock_path(self, key):
+        return os.path.join(self.path, '{0}.txt'.format(key))
 
-    def run(self):
-        while self.proc.poll() is None:
-            output = self.fd.readline()
-            if len(output) > 0:
-                self.aggr += output
-                self.logger.log(self.log_level, output)
-            else:
-                time.sleep(PROCESS_POLLING_INTERVAL)
+    def get(self, key):
+        """Returns the path of the lock stored under `key`, or None if there
+        is no such lock.
+        """
+        lock_path = self._lock_path(key)
+        return lock_path if os.path.isfile(lock_path) else None
+
+    def store(self, key, lines):
+        """Stores a lock under `key` and returns its path.
+        """
+        lock_path = self._lock_path(key)
+        temp_path = '{0}.{1}.tmp'.format(lock_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        if IS_WIN and os.path.isfile(lock_path):
+            os.remove(lock_path)
+        os.rename(temp_path, lock_path)
+        return lock_path
+
+    def discard(self, key):
+        if self.get(key):
+            os.remove(self._lock_path(key))
 
 
 class CloudifyInstaller():
@@ -298,7 +3098,11 @@ class CloudifyInstaller():
                  pythonpath='python', installpip=False,
                  installvirtualenv=False, installpythondev=False,
                  installpycrypto=False, os_distro=None, os_release=None,
-                 **kwargs):
+                 cachedir=None, cachesize=DOWNLOAD_CACHE_SIZE,
+                 buildwheels=False, precompile=False, probestartup=0,
+                 probereport=None, timeout=COMMAND_TIMEOUT,
+                 stalltimeout=COMMAND_STALL_TIMEOUT, retries=COMMAND_RETRIES,
+                 mirrors=None, mirrorttl=MIRROR_RANKING_TTL, **kwargs):
         self.force = force
         self.upgrade = upgrade
         self.virtualenv = virtualenv
@@ -313,6 +3117,39 @@ class CloudifyInstaller():
         self.installvirtualenv = installvirtualenv
         self.installpythondev = installpythondev
         self.installpycrypto = installpycrypto
+        self.cache_dir = cachedir
+        self.build_wheels = buildwheels
+        self.precompile = precompile
+        self.probe_startup = probestartup
+        self.probe_report = probereport
+        self.virtualenv_templates = None
+        self.requirement_locks = None
+        self._template_key = None
+        self._source_digest = None
+        self._interpreter_id = None
+        # the key and requirements of the lock, found once by _find_lock
+        self._lock = None
+        self._lock_guard = Lock()
+        self._cloned_virtualenv = False
+        self.installed_system_packages = []
+        # wheels chosen from the wheelhouse by _plan_install
+        self._resolved_wheels = {}
+        self._prefetcher = Prefetcher()
+
+        self.command_limits = {
+            'timeout': timeout,
+            'stall_timeout': stalltimeout,
+            'retries': retries,
+        }
+
+        self.download_cache = DownloadCache(
+            os.path.join(self.cache_dir, 'downloads'), cachesize) \
+            if self.cache_dir else None
+        # chooses the mirrors components are downloaded from
+        self.component_mirrors = Mirrors(
+            self._read_mirrors(mirrors) if mirrors else None, mirrorttl,
+            os.path.join(self.cache_dir, 'mirrors.json')
+            if self.cache_dir else None)
 
         # TODO: we should test all mutually exclusive arguments.
         if not IS_WIN and self.installpycrypto:
@@ -320,9 +3157,13 @@ class CloudifyInstaller():
         if not (IS_LINUX or IS_DARWIN) and self.installpythondev:
             lgr.warning('Pythondev only relevant on Linux or OSx.')
 
-        os_props = get_os_props()
-        self.distro = os_distro or os_props[0].lower()
-        self.release = os_release or os_props[1].lower()
+        if IS_LINUX and not (os_distro and os_release):
+            os_props = get_os_props(os.path.join(
+                self.cache_dir, 'os.json') if self.cache_dir else None)
+        else:
+            os_props = ('', '')
+        self.distro = (os_distro or os_props[0]).lower()
+        self.release = (os_release or os_props[1]).lower()
 
     def execute(self):
         """Installation Logic
@@ -333,74 +3174,638 @@ class CloudifyInstaller():
         If an offline installation fails (for instance, not all wheels were
         found), an online installation process will commence.
         """
+        with self._scope():
+            self._execute()
+
+    @contextlib.contextmanager
+    def _scope(self):
+        """Makes the module functions used while installing (e.g. open_url)
+        use this installer's settings, restoring the previous ones once it's
+        done so that they don't leak into later installers.
+        """
+        global download_cache, command_limits
+        previous_cache, previous_limits = download_cache, command_limits
+        download_cache = self.download_cache
+        command_limits = self.command_limits
+        try:
+            yield
+        finally:
+            download_cache = previous_cache
+            command_limits = previous_limits
+
+    def _execute(self):
         lgr.debug('Identified Platform: {0}'.format(PLATFORM))
         lgr.debug('Identified Distribution: {0}'.format(self.distro))
         lgr.debug('Identified Release: {0}'.format(self.release))
 
         module = self.source or 'cloudify'
-
-        if self.force or self.installpip:
-            self.install_pip()
-
         if self.virtualenv:
-            if self.force or self.installvirtualenv:
-                self.install_virtualenv()
             env_bin_path = _get_env_bin_path(self.virtualenv)
 
+        # phases requiring root must be done before dropping privileges,
+        # which affects the whole process.
+        privileged = ('install_pip', 'install_virtualenv',
+                      'install_pythondev', 'drop_root_privileges')
+        graph = TaskGraph()
+        if self.force or self.installpip:
+            graph.add('install_pip', self.install_pip)
+        if self.virtualenv and (self.force or self.installvirtualenv):
+            graph.add('install_virtualenv', self.install_virtualenv,
+                      depends_on=['install_pip'])
         if IS_LINUX and (self.force or self.installpythondev):
-            self.install_pythondev(self.distro)
+            graph.add('install_pythondev',
+                      lambda: self.install_pythondev(self.distro))
         if (IS_VIRTUALENV or self.virtualenv) and not IS_WIN:
             # drop root permissions so that installation is done using the
             # current user.
-            drop_root_privileges()
-        if self.virtualenv:
-            if not os.path.isfile(os.path.join(
-                    env_bin_path, ('activate.bat' if IS_WIN else 'activate'))):
-                make_virtualenv(self.virtualenv, self.python_path)
+            graph.add('drop_root_privileges', drop_root_privileges,
+                      depends_on=privileged)
+        # if withrequirements is not provided, this will be False.
+        # if it's provided without a value, it will be a list.
+        if isinstance(self.withrequirements, list) \
+                and not self.withrequirements:
+            graph.add('find_requirement_files', self._find_requirement_files,
+                      depends_on=privileged)
+        if self.virtualenv and not os.path.isfile(os.path.join(
+                env_bin_path, ('activate.bat' if IS_WIN else 'activate'))):
+            # an exact (pinned or --source archive) installation into a new
+            # virtualenv can be cloned from a previously installed one.
+            if self.cache_dir and not (self.upgrade or self.build_wheels) \
+                    and self._is_exact():
+                self.virtualenv_templates = VirtualenvTemplateCache(
+                    os.path.join(self.cache_dir, 'virtualenvs'))
+            graph.add('make_virtualenv', self._make_virtualenv,
+                      depends_on=privileged + (
+                          ('find_requirement_files', )
+                          if self.virtualenv_templates else ()))
+        if IS_WIN and (self.force or self.installpycrypto):
+            graph.add('install_pycrypto',
+                      lambda: self.install_pycrypto(self.virtualenv),
+                      depends_on=privileged + ('make_virtualenv',))
+        if self.build_wheels:
+            graph.add('build_wheels',
+                      lambda: build_wheels(
+                          module=module,
+                          wheels_path=self.wheels_path,
+                          version=self.version,
+                          pre=self.pre,
+                          virtualenv_path=self.virtualenv,
+                          requirement_files=self.withrequirements),
+                      depends_on=graph.names)
+        else:
+            if self.cache_dir:
+                self.requirement_locks = RequirementLocks(
+                    os.path.join(self.cache_dir, 'locks'))
+            graph.add('install_cloudify', lambda: self._install(module),
+                      depends_on=graph.names)
+        prefetch_dir = tempfile.mkdtemp(prefix='get-cloudify-prefetch-')
+        give_to_sudo_user(prefetch_dir)
+        try:
+            self._prefetcher.start(self._plan_prefetch(module, prefetch_dir))
+            with trace('execute', virtualenv=self.virtualenv):
+                graph.run()
+        finally:
+            # whatever wasn't used by now won't be
+            self._prefetcher.cancel()
+            self._prefetcher.join()
+            errors = []
+            shutil.rmtree(prefetch_dir,
+                          onerror=lambda *args: errors.append(args[1:]))
+            if errors:
+                lgr.warning('Could not remove {0} from {1} ({2}).'.format(
+                    errors[0][0], prefetch_dir, errors[0][1][1]))
+
+        if self.installed_system_packages:
+            lgr.info('Installed system packages: {0}.'.format(
+                ', '.join(self.installed_system_packages)))
+        if self.download_cache is not None:
+            self.download_cache.report()
+        if self.probe_startup and not self.build_wheels:
+            self._probe_startup()
+        if self.virtualenv and not self.build_wheels:
+            activate_path = os.path.join(env_bin_path, 'activate')
+            activate_command = \
+                '{0}.bat'.format(activate_path) if IS_WIN \
+                else 'source {0}'.format(activate_path)
+            lgr.info('You can now run: "{0}" to activate '
+                     'the Virtualenv.'.format(activate_command))
+
+    def install_system_prerequisites(self):
+        """Installs the system wide prerequisites requested by the arguments.
+        """
+        graph = TaskGraph()
+        if self.force or self.installpip:
+            graph.add('install_pip', self.install_pip)
+        if self.force or self.installvirtualenv:
+            graph.add('install_virtualenv', self.install_virtualenv,
+                      depends_on=['install_pip'])
+        if IS_LINUX and (self.force or self.installpythondev):
+            graph.add('install_pythondev',
+                      lambda: self.install_pythondev(self.distro))
+        with self._scope():
+            graph.run()
 
+    @staticmethod
+    def _read_mirrors(path):
+        with open(path) as f:
+            mirrors = json.load(f)
+        if not isinstance(mirrors, dict) or not all(
+                isinstance(urls, list) and urls
+                for urls in mirrors.values()):
+            sys.exit('Mirrors must be an object listing the URLs of each '
+                     'component: {0}'.format(path))
+        return mirrors
+
+    def _plan_prefetch(self, module, prefetch_dir):
+        """Lists the remote artifacts the installation will need as
+        (name, func) tuples, each func fetching an artifact into
+        `prefetch_dir` and returning its path.
+        """
+        def download(name, fetch):
+            # created upfront as root privileges may be dropped while the
+            # artifact is fetched.
+            destination = os.path.join(prefetch_dir, str(len(artifacts)))
+            os.makedirs(destination)
+            give_to_sudo_user(destination)
+
+            def func():
+                path = fetch(destination)
+                try:
+                    give_to_sudo_user(destination)
+                except OSError:
+                    # root privileges were dropped meanwhile, the sudo user
+                    # can still remove what was written as root.
+                    pass
+                return path
+            artifacts.append((name, func))
+
+        def remote(url):
+            return bool(url) and not os.path.exists(url)
+
+        artifacts = []
+        if self.build_wheels:
+            return artifacts
+        if (self.force or self.installpip) and not self.find_pip():
+            download('pip', lambda destination: self._download_component(
+                'pip', destination))
         if IS_WIN and (self.force or self.installpycrypto):
-            self.install_pycrypto(self.virtualenv)
+            download('pycrypto', lambda destination: self._download_component(
+                'pycrypto32' if struct.calcsize('P') == 4 else 'pycrypto64',
+                destination))
+        if remote(self.source):
+            download('source', lambda destination: self._download_url(
+                self.source, destination))
+        for req_file in self.withrequirements or []:
+            if remote(req_file):
+                download(req_file, lambda destination, url=req_file:
+                         self._download_requirements_file(url, destination))
+        # distributions aren't downloaded for an offline installation, one
+        # that may be cloned from a virtualenv template, or before pip is
+        # installed. Nor are they when running under sudo, as pip would run
+        # the setup.py of source distributions before root privileges are
+        # dropped.
+        offline = not self.force_online and os.path.isdir(self.wheels_path)
+        cloneable = self.virtualenv and self.cache_dir and \
+            not self.upgrade and self._is_exact()
+        privileged = not IS_WIN and os.getuid() == 0 and \
+            'SUDO_UID' in os.environ and (IS_VIRTUALENV or self.virtualenv)
+        if not (offline or cloneable or privileged or
+                'pip' in dict(artifacts)):
+            download('packages', lambda destination: self._download_packages(
+                module, destination))
+        return artifacts
 
-        # if withrequirements is not provided, this will be False.
-        # if it's provided without a value, it will be a list.
-        if isinstance(self.withrequirements, list):
-            self.withrequirements = self.withrequirements \
-                or self._get_default_requirement_files(self.source)
-
-        if self.force_online or not os.path.isdir(self.wheels_path):
-            install_module(module=module,
-                           version=self.version,
-                           pre=self.pre,
-                           virtualenv_path=self.virtualenv,
-                           requirement_files=self.withrequirements,
-                           upgrade=self.upgrade)
-        elif os.path.isdir(self.wheels_path):
+    def _prefetched(self, name):
+        return self._prefetcher.get(name)
+
+    def _download_component(self, component, destination):
+        destination = os.path.join(destination, os.path.basename(
+            self.component_mirrors.mirrors[component][0]))
+        self.component_mirrors.download(component, destination)
+        return destination
+
+    @staticmethod
+    def _download_url(url, destination):
+        destination = os.path.join(destination, os.path.basename(
+            urlparse.urlparse(url).path) or 'download')
+        download_file(url, destination)
+        return destination
+
+    def _download_requirements_file(self, url, destination):
+        path = self._download_url(url, destination)
+        with open(path) as f:
+            for line in f:
+                if line.strip().startswith(('-r', '-c', '--requirement',
+                                            '--constraint')):
+                    lgr.debug('{0} refers to other files relative to it, '
+                              'not using a local copy.'.format(url))
+                    return None
+        return path
+
+    def _download_packages(self, module, destination):
+        """Downloads the distributions to install (those of the module and
+        of its requirements, or those of their lock if they are locked)
+        using pip.
+        """
+        source = self._prefetched('source') if self.source else None
+        if self.withrequirements:
+            requirement_files = [self._prefetched(req_file) or req_file
+                                 for req_file in self.withrequirements]
+        elif isinstance(self.withrequirements, list):
+            requirement_files = self._get_default_requirement_files(
+                source or self.source)
+        else:
+            requirement_files = []
+        pip_cmd = ['{0} -m pip'.format(self.python_path)
+                   if self.virtualenv else 'pip', 'download', '--dest',
+                   destination]
+        try:
+            _, requirements, lock_path = self._find_lock(requirement_files)
+        except ValueError:
+            requirements, lock_path = None, None
+        if lock_path:
+            # only the locked distributions are installed by _install_locked
+            pip_cmd.extend(['--require-hashes', '--no-deps', '-r', lock_path])
+        else:
+            if requirements is None:
+                for req_file in requirement_files:
+                    pip_cmd.extend(['-r', req_file])
+            else:
+                # as resolved by _install_locked
+                pip_cmd.extend('"{0}"'.format(req) for req in requirements)
+            pip_cmd.append(source or ('{0}=={1}'.format(module, self.version)
+                                      if self.version else module))
+            if self.pre:
+                pip_cmd.append('--pre')
+        result = run(' '.join(pip_cmd), suppress_errors=True, retry=True)
+        if not result.returncode == 0:
+            lgr.debug(result.aggr_stderr)
+            raise IOError('pip download failed')
+        return destination
+
+    def _find_requirement_files(self):
+        self.withrequirements = \
+            self._get_default_requirement_files(
+                self._prefetched('source') or self.source)
+
+    def _make_virtualenv(self):
+        if self.virtualenv_templates:
+            requirements = []
+            for req_file in self.withrequirements or []:
+                with contextlib.closing(open_url(req_file)) as f:
+                    requirements.append(hashlib.sha256(f.read()).hexdigest())
+            self._template_key = self.virtualenv_templates.key(
+                interpreter=self._get_interpreter_id(),
+                platform=PLATFORM,
+                source=self._get_source_digest(),
+                version=self.version,
+                pre=self.pre,
+                requirements=requirements)
+            if self.virtualenv_templates.clone(
+                    self._template_key, self.virtualenv):
+                self._cloned_virtualenv = True
+                return
+        make_virtualenv(self.virtualenv, self.python_path)
+
+    def _is_exact(self):
+        """Whether a specific distribution is installed: a pinned --version
+        or a --source archive, but not a --source directory (which can't be
+        told apart from a modified one).
+        """
+        if self.source:
+            return not os.path.isdir(self.source)
+        return bool(self.version)
+
+    def _get_interpreter_id(self):
+        if self._interpreter_id is None:
+            self._interpreter_id = get_interpreter_id(
+                self.python_path if self.virtualenv else sys.executable)
+        return self._interpreter_id
+
+    def _get_source_digest(self):
+        """Returns the sha256 of the --source archive, so that an archive
+        which changed (e.g. that of a branch) isn't mistaken for the one
+        installed before.
+        """
+        if self.source and self._source_digest is None:
+            digest = hashlib.sha256()
+            with contextlib.closing(open_url(
+                    self._prefetched('source') or self.source)) as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), ''):
+                    digest.update(chunk)
+            self._source_digest = digest.hexdigest()
+        return self._source_digest
+
+    def _probe_startup(self):
+        if self.virtualenv:
+            bin_path = _get_env_bin_path(self.virtualenv)
+            python_path = os.path.join(bin_path, 'python')
+            cfy_path = os.path.join(bin_path, 'cfy')
+        else:
+            python_path = sys.executable
+            cfy_path = distutils.spawn.find_executable('cfy')
+            if not cfy_path:
+                sys.exit('Could not find cfy in the path.')
+        lgr.info('Measuring cfy startup time...')
+        report = probe_startup(cfy_path, python_path, self.probe_startup)
+        if self.probe_report:
+            write_json(self.probe_report, report)
+
+    def _install(self, module):
+        if self._cloned_virtualenv:
+            lgr.info('Cloudify was installed from a virtualenv template.')
+        else:
+            if self.withrequirements:
+                self.withrequirements = [
+                    self._prefetched(req_file) or req_file
+                    for req_file in self.withrequirements]
+            self._install_module(self._prefetched('source') or module)
+        if self.precompile:
+            lgr.info('Compiling installed modules...')
+            if self.virtualenv:
+                precompile(os.path.join(
+                    _get_env_bin_path(self.virtualenv), 'python'),
+                    _get_site_packages(self.virtualenv))
+            else:
+                precompile(sys.executable)
+        if self._template_key and not self._cloned_virtualenv:
+            self.virtualenv_templates.store(
+                self._template_key, self.virtualenv)
+
+    def _install_module(self, module):
+        mode, missing = 'online', []
+        if not self.force_online and os.path.isdir(self.wheels_path):
             lgr.info('Wheels directory found: "{0}". '
-                     'Attemping offline installation...'.format(
+                     'Checking whether it provides all requirements...'.format(
                          self.wheels_path))
-            try:
-                install_module(module=module,
-                               pre=True,
-                               virtualenv_path=self.virtualenv,
-                               wheelspath=self.wheels_path,
-                               requirement_files=self.withrequirements,
-                               upgrade=self.upgrade)
-            except Exception as ex:
-                lgr.warning('Offline installation failed ({0}).'.format(
-                    str(ex)))
+            with trace('preflight') as span:
+                mode, missing = self._plan_install(module)
+                span.update(mode=mode, missing=missing)
+        if mode == 'online' and self._install_locked(module):
+            return
+        find_links = [self.wheels_path]
+        if mode == 'online' and self._prefetched('packages'):
+            lgr.info('Using the prefetched distributions...')
+            mode, find_links = 'prefetched', [self._prefetched('packages')]
+        download_dir = None
+        try:
+            if mode == 'hybrid':
+                lgr.info('Downloading requirements missing from the '
+                         'wheelhouse...')
+                download_dir = tempfile.mkdtemp()
+                try:
+                    with trace('download_missing', requirements=missing):
+                        download_requirements(missing, download_dir,
+                                              virtualenv_path=self.virtualenv,
+                                              find_links=find_links,
+                                              pre=True)
+                    find_links.append(download_dir)
+                except SystemExit as ex:
+                    lgr.warning('{0} Falling back to an online '
+                                'installation.'.format(ex))
+                    mode = 'online'
+            if mode == 'offline' and self._install_wheels():
+                return
+            if mode != 'online':
+                lgr.info('Attempting offline installation...')
+                try:
+                    with trace('offline_install', mode=mode):
+                        if mode == 'offline' and self._resolved_wheels:
+                            install_resolved_wheels(
+                                [os.path.join(self.wheels_path, filename)
+                                 for filename in sorted(
+                                     self._resolved_wheels.values())],
+                                virtualenv_path=self.virtualenv,
+                                upgrade=self.upgrade)
+                            return
+                        install_module(module=module,
+                                       version=self.version,
+                                       pre=True,
+                                       virtualenv_path=self.virtualenv,
+                                       wheelspath=find_links,
+                                       requirement_files=self.withrequirements,
+                                       upgrade=self.upgrade)
+                    return
+                except (Exception, SystemExit) as ex:
+                    lgr.warning('Offline installation failed ({0}).'.format(
+                        str(ex)))
+            with trace('online_install', fallback=mode != 'online'):
                 install_module(module=module,
                                version=self.version,
                                pre=self.pre,
                                virtualenv_path=self.virtualenv,
                                requirement_files=self.withrequirements,
                                upgrade=self.upgrade)
-        if self.virtualenv:
-            activate_path = os.path.join(env_bin_path, 'activate')
-            activate_command = \
-                '{0}.bat'.format(activate_path) if IS_WIN \
-                else 'source {0}'.format(activate_path)
-            lgr.info('You can now run: "{0}" to activate '
-                     'the Virtualenv.'.format(activate_command))
+        finally:
+            if download_dir:
+                shutil.rmtree(download_dir)
+
+    def _install_locked(self, module):
+        """Installs the requirements from their lock, resolving them and
+        storing their lock first if there is none (or when upgrading).
+
+        Returns False if the requirements cannot be locked or installed from
+        their lock, in which case they should be installed as usual.
+        """
+        try:
+            key, requirements, lock_path = self._find_lock(
+                self.withrequirements)
+        except ValueError as ex:
+            lgr.debug('Cannot lock requirements ({0}).'.format(ex))
+            return False
+        # distributions already downloaded, either those of the lock or
+        # those the requirements are resolved to.
+        packages = self._prefetched('packages')
+        find_links = [packages] if packages else []
+        download_dir = None
+        try:
+            if lock_path is None:
+                if not find_links:
+                    download_dir = tempfile.mkdtemp()
+                    download_requirements(
+                        requirements + [module if self.source else (
+                            '{0}=={1}'.format(module, self.version)
+                            if self.version else module)],
+                        download_dir, virtualenv_path=self.virtualenv,
+                        pre=self.pre)
+                    find_links = [download_dir]
+                lgr.info('Locking the requirements...')
+                lock_path = self.requirement_locks.store(
+                    key, lock_requirements(
+                        find_links[0], exclude=self._get_source_names()))
+            install_lock(lock_path, virtualenv_path=self.virtualenv,
+                         find_links=find_links)
+            if self.source:
+                # its requirements are already installed.
+                install_module(module=module,
+                               pre=self.pre,
+                               virtualenv_path=self.virtualenv)
+        except (ValueError, SystemExit) as ex:
+            lgr.warning('Could not install the locked requirements ({0}), '
+                        'installing them as usual.'.format(ex))
+            self.requirement_locks.discard(key)
+            return False
+        finally:
+            if download_dir:
+                shutil.rmtree(download_dir)
+        return True
+
+    def _get_source_names(self):
+        """Returns the name of the project of the --source archive, whose
+        distribution isn't locked along with its requirements.
+
+        Raises ValueError if it isn't named in the archive.
+        """
+        if not self.source:
+            return []
+        with contextlib.closing(open_url(
+                self._prefetched('source') or self.source)) as f:
+            try:
+                name = read_project_name(f)
+            except tarfile.TarError as ex:
+                raise ValueError('could not read {0} ({1})'.format(
+                    self.source, ex))
+        if not name:
+            raise ValueError('{0} has no project name'.format(self.source))
+        return [name]
+
+    def _find_lock(self, requirement_files):
+        """Returns the key of the lock of the requirements listed in
+        `requirement_files` (merged and deduplicated), the requirements and
+        the path of their lock, which is None if there is no such lock or
+        when upgrading.
+
+        The key is only computed once (the requirement files given by the
+        prefetcher are local copies of the same files).
+
+        Raises ValueError if the requirements cannot be locked, including
+        when the distribution installed isn't a specific one, as its
+        requirements (and their resolution) change from one release to
+        the next.
+        """
+        if not (self.requirement_locks and requirement_files):
+            raise ValueError('no lock cache or requirement files')
+        if not self._is_exact():
+            raise ValueError('neither a --version nor a --source archive')
+        with self._lock_guard:
+            if self._lock is None:
+                requirements = merge_requirements(
+                    self._read_requirements(requirement_files))
+                key = self.requirement_locks.key(
+                    interpreter=self._get_interpreter_id(),
+                    platform=PLATFORM,
+                    source=self._get_source_digest(),
+                    version=self.version,
+                    pre=self.pre,
+                    requirements=sorted(requirements))
+                self._lock = key, requirements
+        key, requirements = self._lock
+        lock_path = None if self.upgrade else self.requirement_locks.get(key)
+        return key, requirements, lock_path
+
+    def _install_wheels(self):
+        """Installs the wheels chosen by _plan_install without pip.
+
+        Returns False if pip should be used instead: outside of a
+        virtualenv, when upgrading or when a different version of one of the
+        distributions is already installed.
+        """
+        if not (self.virtualenv and self._resolved_wheels) or self.upgrade:
+            return False
+        installed = get_installed_distributions(self.virtualenv)
+        wheels = []
+        for name, filename in sorted(self._resolved_wheels.items()):
+            version = filename.split('-')[1]
+            if name not in installed:
+                wheels.append(os.path.join(self.wheels_path, filename))
+            elif installed[name] != version:
+                return False
+        lgr.info('Installing {0} wheel(s) from {1}...'.format(
+            len(wheels), self.wheels_path))
+        try:
+            with trace('install_wheels', wheels=len(wheels)):
+                if install_wheels(wheels, self.virtualenv):
+                    return True
+        except (IOError, OSError, ValueError, zipfile.BadZipfile) as ex:
+            lgr.warning('Could not install the wheels directly '
+                        '({0}).'.format(ex))
+        lgr.info('Installing using pip instead...')
+        return False
+
+    def _plan_install(self, module):
+        """Checks what the wheelhouse provides before running pip.
+
+        Returns how to install along with the requirements missing from the
+        wheelhouse: 'offline' if nothing is missing, 'hybrid' if only some
+        of the requirements are, 'online' if the wheelhouse provides none of
+        them (or is corrupted) and None if the requirements cannot be
+        resolved in advance (e.g. when installing from --source), in which
+        case an offline installation should just be attempted.
+        """
+        index = self._verify_wheelhouse()
+        if index is None:
+            return 'online', []
+        if self.source:
+            return None, []
+        try:
+            requirements = ['{0}=={1}'.format(module, self.version)
+                            if self.version else module]
+            requirements.extend(
+                self._read_requirements(self.withrequirements or []))
+            python_path = self.python_path if self.virtualenv \
+                else sys.executable
+            chosen, missing = index.resolve(
+                requirements, get_interpreter_tags(python_path))
+            self._resolved_wheels = chosen
+        except ImportError:
+            lgr.debug('pkg_resources is not available, cannot resolve '
+                      'requirements.')
+            return None, []
+        except ValueError as ex:
+            lgr.debug('Cannot resolve requirements ({0}).'.format(ex))
+            return None, []
+        if not missing:
+            lgr.info('The wheelhouse provides all {0} requirement(s).'.format(
+                len(chosen)))
+            return 'offline', []
+        lgr.info('Requirements missing from the wheelhouse: {0}'.format(
+            ', '.join(missing)))
+        return ('hybrid' if chosen else 'online'), missing
+
+    @staticmethod
+    def _read_requirements(requirement_files):
+        """Returns the requirements listed in requirement files.
+
+        Raises ValueError for anything other than plain requirements (e.g.
+        options, URLs or nested requirement files).
+        """
+        requirements = []
+        for req_file in requirement_files:
+            with contextlib.closing(open_url(req_file)) as f:
+                for line in f.read().splitlines():
+                    line = line.split(' #', 1)[0].strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    if line.startswith('-') or '/' in line.split(';')[0]:
+                        raise ValueError('unsupported requirement in {0}: '
+                                         '{1}'.format(req_file, line))
+                    requirements.append(line)
+        return requirements
+
+    def _verify_wheelhouse(self):
+        """Updates the wheelhouse's index and verifies its wheels.
+
+        Returns the index, or None if any of the wheels is corrupted.
+        """
+        index = WheelhouseIndex(self.wheels_path)
+        index.update()
+        corrupted = index.verify()
+        if corrupted:
+            lgr.error('Corrupted wheels found in {0}: {1}'.format(
+                self.wheels_path, ', '.join(corrupted)))
+            lgr.warning('Skipping offline installation.')
+            return None
+        return index
 
     @staticmethod
     def find_virtualenv():
@@ -432,12 +3837,18 @@ class CloudifyInstaller():
                 tempdir = tempfile.mkdtemp()
                 get_pip_path = os.path.join(tempdir, 'get-pip.py')
                 try:
-                    download_file(PIP_URL, get_pip_path)
+                    prefetched = self._prefetched('pip')
+                    if prefetched:
+                        get_pip_path = prefetched
+                    else:
+                        self.component_mirrors.download(
+                            'pip', get_pip_path)
                 except StandardError as e:
                     sys.exit('Failed downloading pip from {0}. ({1})'.format(
-                             PIP_URL, e.message))
+                        ', '.join(self.component_mirrors.mirrors['pip']),
+                        e.message))
                 result = run('{0} {1}'.format(
-                    self.python_path, get_pip_path))
+                    self.python_path, get_pip_path), retry=True)
                 if not result.returncode == 0:
                     sys.exit('Could not install pip')
             finally:
@@ -451,51 +3862,49 @@ class CloudifyInstaller():
             return [os.path.join(source, f) for f in REQUIREMENT_FILE_NAMES
                     if os.path.isfile(os.path.join(source, f))]
         else:
-            tempdir = tempfile.mkdtemp()
-            archive = os.path.join(tempdir, 'cli_source')
             # TODO: need to handle deletion of the temp source dir
+            tempdir = tempfile.mkdtemp()
+            lgr.info('Looking for requirement files in {0}...'.format(source))
             try:
-                download_file(source, archive)
+                stream = open_url(source)
             except Exception as ex:
                 lgr.error('Could not download {0} ({1})'.format(
                     source, str(ex)))
                 sys.exit(1)
             try:
-                untar_requirement_files(archive, tempdir)
+                return extract_requirement_files(stream, tempdir)
             except Exception as ex:
                 lgr.error('Could not extract {0} ({1})'.format(
-                    archive, str(ex)))
+                    source, str(ex)))
                 sys.exit(1)
             finally:
-                os.remove(archive)
-            # GitHub always adds a single parent directory to the tree.
-            # TODO: look in parent dir, then one level underneath.
-            # the GitHub style tar assumption isn't a very good one.
-            req_dir = os.path.join(tempdir, os.listdir(tempdir)[0])
-            return [os.path.join(req_dir, f) for f in REQUIREMENT_FILE_NAMES
-                    if os.path.isfile(os.path.join(req_dir, f))]
+                stream.close()
 
     def install_pythondev(self, distro):
         """Installs python-dev and gcc
 
-        This will try to match a command for your platform and distribution.
+        This will try to match a package manager for your platform and
+        distribution. Packages which are already installed are skipped.
+        Returns the packages which were installed.
         """
         lgr.info('Installing python-dev...')
         if distro in ('ubuntu', 'debian'):
-            cmd = 'apt-get install -y gcc python-dev'
+            manager, packages = 'apt', ['gcc', 'python-dev']
         elif distro in ('centos', 'redhat', 'fedora'):
-            cmd = 'yum -y install gcc python-devel'
-        elif os.path.isfile('/etc/arch-release'):
+            manager, packages = 'yum', ['gcc', 'python-devel']
+        elif distro == 'arch':
             # Arch doesn't require a python-dev package.
             # It's already supplied with Python.
-            cmd = 'pacman -S gcc --noconfirm'
+            manager, packages = 'pacman', ['gcc']
         elif IS_DARWIN:
             lgr.info('python-dev package not required on Darwin.')
-            return
+            return []
         else:
             sys.exit('python-dev package installation not supported '
                      'in current distribution.')
-        run(cmd)
+        installed = install_system_packages(manager, packages)
+        self.installed_system_packages.extend(installed)
+        return installed
 
     # Windows only
     def install_pycrypto(self, virtualenv_path):
@@ -510,39 +3919,271 @@ class CloudifyInstaller():
 
         lgr.info('Installing PyCrypto {0}bit...'.format(
             '32' if is_pyx32 else '64'))
-        # easy install is used instead of pip as pip doesn't handle windows
-        # executables.
-        cmd = 'easy_install {0}'.format(PYCR32_URL if is_pyx32 else PYCR64_URL)
-        if virtualenv_path:
-            cmd = os.path.join(_get_env_bin_path(virtualenv_path), cmd)
-        run(cmd)
+        component = 'pycrypto32' if is_pyx32 else 'pycrypto64'
+        tempdir = tempfile.mkdtemp()
+        try:
+            installer_path = self._prefetched('pycrypto') or \
+                self._download_component(component, tempdir)
+            # easy install is used instead of pip as pip doesn't handle
+            # windows executables.
+            cmd = 'easy_install {0}'.format(installer_path)
+            if virtualenv_path:
+                cmd = os.path.join(_get_env_bin_path(virtualenv_path), cmd)
+            run(cmd)
+        finally:
+            shutil.rmtree(tempdir)
 
 
-def check_cloudify_installed(virtualenv_path=None):
+def _get_site_packages(env_path):
+    """returns the site-packages paths of a virtualenv
+
+    Paths which are links to others (e.g. the lib64 -> lib symlink
+    virtualenv creates) are only returned once.
+    """
+    if IS_WIN:
+        return [os.path.join(env_path, 'Lib', 'site-packages')]
+    paths = collections.OrderedDict()
+    for path in sorted(glob.glob(os.path.join(
+            env_path, 'lib*', 'python*', 'site-packages'))):
+        paths.setdefault(os.path.realpath(path), path)
+    return list(paths.values())
+
+
+def _normalize_name(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def get_installed_version(name, virtualenv_path=None):
+    """Returns the version of a distribution installed in a virtualenv (or in
+    the current environment if no virtualenv is provided), or None if it isn't
+    installed.
+    """
+    return get_installed_distributions(virtualenv_path).get(
+        _normalize_name(name))
+
+
+def get_installed_distributions(virtualenv_path=None):
+    """Returns the versions of the distributions installed in a virtualenv (or
+    in the current environment if no virtualenv is provided) by their
+    normalized names.
+
+    This reads the dist-info/egg-info metadata in site-packages instead of
+    importing anything, including that of develop installs (pip install -e),
+    whose .egg-link points to the project's egg-info. Results are cached
+    until one of the site-packages directories is modified.
+    """
     if virtualenv_path:
-        result = run(
-            os.path.join(_get_env_bin_path(virtualenv_path),
-                         'python -c "import cloudify"'),
-            suppress_errors=True)
-        return result.returncode == 0
+        paths = _get_site_packages(virtualenv_path)
     else:
+        paths = [path for path in sys.path if path and os.path.isdir(path)]
+    mtimes = []
+    for path in paths:
         try:
-            import cloudify  # NOQA
-            return True
-        except ImportError:
-            return False
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    key = tuple(paths)
+    cached = _installed_versions.get(key)
+    if cached and cached[0] == mtimes:
+        return cached[1]
+
+    versions = {}
+    for path in [p for p, mtime in zip(paths, mtimes) if mtime is not None]:
+        for entry in os.listdir(path):
+            base, ext = os.path.splitext(entry)
+            if ext not in ('.dist-info', '.egg-info', '.egg', '.egg-link'):
+                continue
+            # e.g. cloudify-3.2.dist-info or cloudify-3.2-py2.7.egg-info
+            parts = base.split('-')
+            if ext == '.egg-link':
+                name, version = _read_egg_link(os.path.join(path, entry))
+            elif len(parts) > 1:
+                name, version = parts[:2]
+            elif ext == '.egg-info':
+                # e.g. cloudify.egg-info in a project installed in place
+                name, version = _read_pkg_info(os.path.join(path, entry))
+            else:
+                continue
+            if name and version:
+                # the first path providing a distribution is the one used
+                versions.setdefault(_normalize_name(name), version)
+    _installed_versions[key] = (mtimes, versions)
+    return versions
+
+
+def _read_pkg_info(egg_info):
+    """Returns the name and version in an egg-info's PKG-INFO (egg-info
+    may also be a PKG-INFO file itself), or Nones if there are none.
+    """
+    path = os.path.join(egg_info, 'PKG-INFO') if os.path.isdir(egg_info) \
+        else egg_info
+    try:
+        with open(path) as f:
+            metadata = f.read()
+    except IOError:
+        return None, None
+    name, version = PKG_INFO_NAME.search(metadata), \
+        PKG_INFO_VERSION.search(metadata)
+    return name and name.group(1), version and version.group(1)
 
 
-def handle_upgrade(upgrade=False, virtualenv=''):
-    if check_cloudify_installed(virtualenv):
-        lgr.info('Cloudify is already installed in the path.')
-        if upgrade:
+def _read_egg_link(egg_link):
+    """Returns the name and version of a project installed in develop mode,
+    read from the egg-info in the directory its .egg-link points to.
+    """
+    try:
+        with open(egg_link) as f:
+            project_path = f.readline().strip()
+        entries = os.listdir(os.path.join(
+            os.path.dirname(egg_link), project_path))
+    except (IOError, OSError):
+        return None, None
+    name = os.path.splitext(os.path.basename(egg_link))[0]
+    for entry in entries:
+        if entry.endswith('.egg-info') and _normalize_name(
+                entry[:-len('.egg-info')].split('-')[0]) == \
+                _normalize_name(name):
+            return _read_pkg_info(os.path.join(
+                os.path.dirname(egg_link), project_path, entry))
+    return None, None
+
+
+def check_cloudify_installed(virtualenv_path=None):
+    return get_installed_version('cloudify', virtualenv_path) is not None
+
+
+def handle_upgrade(upgrade=False, virtualenv='', version=None,
+                   buildwheels=False):
+    if buildwheels:
+        # only a wheelhouse is built, nothing is installed
+        return
+    installed_version = get_installed_version('cloudify', virtualenv)
+    if installed_version:
+        lgr.info('Cloudify {0} is already installed in the path.'.format(
+            installed_version))
+        if upgrade and version == installed_version:
+            lgr.info('Requested version is already installed.')
+            sys.exit(0)
+        elif upgrade:
             lgr.info('Upgrading...')
         else:
             lgr.error('Use the --upgrade flag to upgrade.')
             sys.exit(1)
 
 
+def install_fleet(manifest, workers=FLEET_WORKERS, **defaults):
+    """Installs Cloudify into each virtualenv listed in a manifest.
+
+    The manifest is a JSON list of objects, each providing a `virtualenv`
+    and optionally any other installation argument (e.g. `version`,
+    `source` or `withrequirements`). Arguments missing from an entry are
+    taken from `defaults`.
+    System wide prerequisites (pip, virtualenv, python-dev) are installed
+    once and the entries are then installed concurrently on a pool of
+    `workers` processes. Downloads are shared through the download cache
+    in `cachedir`, or in a temporary one removed afterwards when no
+    `cachedir` is provided.
+
+    Returns a list of (virtualenv, succeeded, seconds, error) tuples.
+    """
+    with open(manifest) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list) or not all(
+            isinstance(entry, dict) and entry.get('virtualenv')
+            for entry in entries):
+        sys.exit('Manifest must be a list of objects, each with a '
+                 'virtualenv: {0}'.format(manifest))
+
+    temp_cache_dir = None
+    if not defaults.get('cachedir'):
+        # without a cache nothing would be shared between the entries
+        temp_cache_dir = tempfile.mkdtemp(prefix='get-cloudify-fleet-cache-')
+        give_to_sudo_user(temp_cache_dir)
+        defaults['cachedir'] = temp_cache_dir
+    try:
+        return _install_fleet(entries, workers, defaults)
+    finally:
+        if temp_cache_dir:
+            shutil.rmtree(temp_cache_dir, ignore_errors=True)
+
+
+def _install_fleet(entries, workers, defaults):
+    prerequisites = CloudifyInstaller(**defaults)
+    prerequisites.install_system_prerequisites()
+    defaults.update({
+        'force': False,
+        'installpip': False,
+        'installvirtualenv': False,
+        'installpythondev': False,
+        'installpycrypto': defaults.get('force') or defaults.get(
+            'installpycrypto'),
+        'os_distro': prerequisites.distro,
+        'os_release': prerequisites.release,
+    })
+    jobs = [dict(defaults, **entry) for entry in entries]
+
+    lgr.info('Installing Cloudify into {0} virtualenv(s) using {1} '
+             'process(es)...'.format(len(jobs), workers))
+    start = time.time()
+    # each installation gets a fresh process as it may drop privileges.
+    pool = multiprocessing.Pool(
+        max(1, min(workers, len(jobs))), maxtasksperchild=1)
+    try:
+        results = pool.map(_install_fleet_entry, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    if tracer is not None:
+        for result in results:
+            tracer.events.extend(result[-1])
+    results = [result[:-1] for result in results]
+
+    lgr.info('{0:<50} {1:<8} {2:>8}'.format('Virtualenv', 'Status', 'Seconds'))
+    for virtualenv, succeeded, seconds, error in results:
+        lgr.info('{0:<50} {1:<8} {2:>8.1f}{3}'.format(
+            virtualenv, 'OK' if succeeded else 'FAILED', seconds,
+            '' if succeeded else ' ({0})'.format(error)))
+    failed = len([result for result in results if not result[1]])
+    lgr.info('{0} succeeded, {1} failed in {2:.1f} seconds.'.format(
+        len(results) - failed, failed, time.time() - start))
+    return results
+
+
+def _install_fleet_entry(args):
+    """Installs a single manifest entry (in a pool worker).
+    """
+    virtualenv = args['virtualenv']
+    formatter = logging.Formatter(
+        fmt='%(asctime)s [%(levelname)s] [{0}] %(message)s'.format(
+            virtualenv), datefmt='%H:%M:%S')
+    for handler in lgr.handlers:
+        handler.setFormatter(formatter)
+    global tracer, transcript
+    if tracer is not None:
+        # only this installation's spans are sent back to the parent.
+        tracer = Tracer()
+    if transcript is not None:
+        # the parent's writer thread doesn't exist in this process.
+        transcript = Transcript(transcript.path)
+    start = time.time()
+    error = None
+    try:
+        with trace('install', 'fleet', virtualenv=virtualenv):
+            handle_upgrade(
+                args.get('upgrade'), virtualenv, args.get('version'),
+                args.get('buildwheels'))
+            CloudifyInstaller(**args).execute()
+    except SystemExit as ex:
+        error = ex.code
+    except Exception as ex:
+        lgr.exception('Installation failed.')
+        error = str(ex)
+    if transcript is not None:
+        transcript.close()
+    events = tracer.events if tracer is not None else []
+    return virtualenv, not error, time.time() - start, error, events
+
+
 def parse_args(args=None):
     class VerifySource(argparse.Action):
         def __call__(self, parser, args, values, option_string=None):
@@ -588,6 +4229,13 @@ def parse_args(args=None):
     online_group.add_argument(
         '--wheelspath', type=str, default='wheelhouse',
         help='Path to wheels (defaults to "<cwd>/wheelhouse").')
+    parser.add_argument(
+        '--buildwheels', action='store_true',
+        help='Instead of installing, download and build wheels for Cloudify\n'
+             'and its requirements into --wheelspath.')
+    parser.add_argument(
+        '--precompile', action='store_true',
+        help='Compile the installed modules to bytecode after installing.')
     if IS_WIN:
         parser.add_argument(
             '--pythonpath', type=str, default='c:/python27/python.exe',
@@ -598,6 +4246,65 @@ def parse_args(args=None):
             '--pythonpath', type=str, default='python',
             help='Python path to use (defaults to "python") '
                  'when creating a virtualenv.')
+    parser.add_argument(
+        '--probestartup', type=int, nargs='?', const=STARTUP_PROBE_RUNS,
+        default=0, metavar='RUNS',
+        help='After installing, run "cfy --version" RUNS times (defaults\n'
+             'to {0}) and report its startup latency and heaviest imports.'
+             .format(STARTUP_PROBE_RUNS))
+    parser.add_argument(
+        '--probereport', type=str,
+        help='Write the --probestartup report to this file as JSON.')
+    parser.add_argument(
+        '--manifest', type=str,
+        help='Path to a JSON manifest listing virtualenvs to install\n'
+             'Cloudify in concurrently (each entry may override any of the\n'
+             'other arguments, e.g.\n'
+             '{"virtualenv": "env1", "version": "3.2"}).')
+    parser.add_argument(
+        '--fleetworkers', type=int, default=FLEET_WORKERS,
+        help='Number of concurrent installations when using --manifest\n'
+             '(defaults to {0}).'.format(FLEET_WORKERS))
+    parser.add_argument(
+        '--logfile', type=str,
+        help='Write the full output of the commands run to this file\n'
+             '(defaults to a new file in the temporary directory).')
+    parser.add_argument(
+        '--trace', type=str,
+        help='Write the duration of each installation phase and command\n'
+             'to this file in the Chrome trace event format.')
+    parser.add_argument(
+        '--cachedir', type=str,
+        help='Directory in which to cache downloaded files.')
+    parser.add_argument(
+        '--cachesize', type=int, default=DOWNLOAD_CACHE_SIZE,
+        help='Maximum size of the download cache in MB (defaults to {0}).'
+             .format(DOWNLOAD_CACHE_SIZE))
+    parser.add_argument(
+        '--mirrors', type=str,
+        help='Path to a JSON file listing the mirrors to download\n'
+             'components from, e.g. {"pip": ["url1", "url2"]}. The\n'
+             'fastest responding mirror is used.')
+    parser.add_argument(
+        '--mirrorttl', type=int, default=MIRROR_RANKING_TTL,
+        help='Seconds for which the ranking of mirrors is reused\n'
+             '(defaults to {0}, kept in --cachedir across runs).'.format(
+                 MIRROR_RANKING_TTL))
+    parser.add_argument(
+        '--timeout', type=int, default=COMMAND_TIMEOUT,
+        help='Seconds after which a command (e.g. pip) is killed, along\n'
+             'with the processes it started (defaults to {0}, 0 means no\n'
+             'limit).'.format(COMMAND_TIMEOUT))
+    parser.add_argument(
+        '--stalltimeout', type=int, default=COMMAND_STALL_TIMEOUT,
+        help='Seconds without any output after which a command is killed\n'
+             '(defaults to {0}, 0 means no limit).'.format(
+                 COMMAND_STALL_TIMEOUT))
+    parser.add_argument(
+        '--retries', type=int, default=COMMAND_RETRIES,
+        help='Number of times downloads, pip and package manager commands\n'
+             'are retried after failing (defaults to {0}).'.format(
+                 COMMAND_RETRIES))
     parser.add_argument(
         '--installpip', action='store_true',
         help='Attempt to install pip.')
@@ -616,6 +4323,7 @@ def parse_args(args=None):
 
 
 lgr = init_logger(__file__)
+console_limiter = RateLimiter(CONSOLE_LINES_PER_SECOND)
 
 
 if __name__ == '__main__':
@@ -626,9 +4334,28 @@ if __name__ == '__main__':
         lgr.setLevel(logging.DEBUG)
     else:
         lgr.setLevel(logging.INFO)
-    handle_upgrade(args.upgrade, args.virtualenv)
 
-    xargs = ['quiet', 'verbose']
-    args = {arg: v for arg, v in vars(args).items() if arg not in xargs}
-    installer = CloudifyInstaller(**args)
-    installer.execute()
+    xargs = ['quiet', 'verbose', 'manifest', 'fleetworkers', 'trace',
+             'logfile']
+    installer_args = {arg: v for arg, v in vars(args).items()
+                      if arg not in xargs}
+    if args.trace:
+        tracer = Tracer()
+    transcript = Transcript(args.logfile or os.path.join(
+        tempfile.gettempdir(), 'get-cloudify-{0}-{1}.log'.format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid())))
+    lgr.debug('Writing the output of commands to {0}'.format(
+        transcript.path))
+    try:
+        if args.manifest:
+            results = install_fleet(
+                args.manifest, args.fleetworkers, **installer_args)
+            sys.exit(0 if all(result[1] for result in results) else 1)
+        handle_upgrade(args.upgrade, args.virtualenv, args.version,
+                       args.buildwheels)
+        installer = CloudifyInstaller(**installer_args)
+        installer.execute()
+    finally:
+        transcript.close()
+        if tracer is not None:
+            tracer.save(args.trace)
@@ -0,0 +1,367 @@
+########
+# Copyright (c) 2014 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+############
+"""Times CloudifyInstaller.execute against a local package index.
+
+A synthetic `cloudify` package (with a configurable number of
+dependencies) is served from a simple index on localhost, so results do not
+depend on the network and can be compared between commits:
+
+    python tests/benchmark_install.py --output before.json
+    (apply changes)
+    python tests/benchmark_install.py --compare before.json
+
+The modes measured are:
+    online   - installing from the index into a new virtualenv.
+    offline  - installing from a --wheelspath into a new virtualenv.
+    source   - installing a --source archive, discovering its
+               requirements.txt (--withrequirements without a value).
+    upgrade  - upgrading an existing virtualenv to a newer version.
+"""
+import argparse
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import importlib
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from StringIO import StringIO
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+get_cloudify = importlib.import_module('get-cloudify')
+
+MODES = ('online', 'offline', 'source', 'upgrade')
+WHEEL_TAG = 'py2.py3-none-any'
+CLI_MODULE = '''def main():
+    print('Cloudify CLI {0}')
+'''
+
+
+class IndexServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a PEP 503 simple index of `packages_path` on localhost.
+    """
+    daemon_threads = True
+
+    def __init__(self, packages_path):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), IndexRequestHandler)
+        self.files = {}
+        projects = {}
+        for filename in sorted(os.listdir(packages_path)):
+            with open(os.path.join(packages_path, filename), 'rb') as f:
+                body = f.read()
+            self.files['/packages/' + filename] = body
+            project = re.sub(r'[-_.]+', '-', filename.split('-')[0]).lower()
+            projects.setdefault(project, []).append(
+                '<a href="/packages/{0}#sha256={1}">{0}</a>'.format(
+                    filename, hashlib.sha256(body).hexdigest()))
+        for project, links in projects.items():
+            self.files['/simple/{0}/'.format(project)] = \
+                '<html><body>{0}</body></html>'.format('\n'.join(links))
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def index_url(self):
+        return 'http://127.0.0.1:{0}/simple/'.format(self.server_port)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class IndexRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html' if self.path.endswith(
+            '/') else 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def make_wheel(directory, name, version, files, requires=(),
+               entry_points=None):
+    """Creates a wheel (with a valid RECORD) in `directory`.
+    """
+    dist_info = '{0}-{1}.dist-info'.format(name.replace('-', '_'), version)
+    files = dict(files)
+    files[dist_info + '/METADATA'] = ''.join(
+        ['Metadata-Version: 2.0\nName: {0}\nVersion: {1}\n'.format(
+            name, version)] +
+        ['Requires-Dist: {0}\n'.format(req) for req in requires])
+    files[dist_info + '/WHEEL'] = \
+        'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {0}\n'.format(
+            WHEEL_TAG)
+    if entry_points:
+        files[dist_info + '/entry_points.txt'] = entry_points
+    record = []
+    for path, content in sorted(files.items()):
+        digest = base64.urlsafe_b64encode(
+            hashlib.sha256(content).digest()).rstrip('=')
+        record.append('{0},sha256={1},{2}'.format(path, digest, len(content)))
+    record.append('{0}/RECORD,,'.format(dist_info))
+    files[dist_info + '/RECORD'] = '\n'.join(record) + '\n'
+    path = os.path.join(directory, '{0}-{1}-{2}.whl'.format(
+        name.replace('-', '_'), version, WHEEL_TAG))
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as wheel:
+        for arcname, content in sorted(files.items()):
+            wheel.writestr(arcname, content)
+    return path
+
+
+def make_source(directory, version, requires):
+    """Creates a `cloudify` source archive with a requirements.txt.
+    """
+    root = 'cloudify-{0}'.format(version)
+    files = {
+        'setup.py':
+            'from setuptools import setup\n'
+            'setup(name="cloudify", version={0!r},\n'
+            '      packages=["cloudify_cli"], install_requires={1!r},\n'
+            '      entry_points={{"console_scripts": '
+            '["cfy = cloudify_cli:main"]}})\n'.format(version, requires),
+        'requirements.txt': '\n'.join(requires) + '\n',
+        'cloudify_cli/__init__.py': CLI_MODULE.format(version),
+    }
+    path = os.path.join(directory, root + '.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo('{0}/{1}'.format(root, name))
+            info.size = len(content)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(content))
+    return path
+
+
+def make_packages(directory, fanout):
+    """Creates `cloudify` 1.0 and 1.1 and `fanout` dependencies of them.
+
+    Returns the list of requirements and the path of a `cloudify` 1.2
+    source archive (which is not published in the index).
+    """
+    requires = []
+    for i in range(fanout):
+        name = 'cloudify-bench-dep-{0}'.format(i)
+        module = name.replace('-', '_')
+        make_wheel(directory, name, '1.0', {
+            '{0}/__init__.py'.format(module): '',
+            '{0}/data.py'.format(module): 'DATA = {0!r}\n'.format(
+                'x' * 4096)})
+        requires.append('{0}==1.0'.format(name))
+    for version in ('1.0', '1.1'):
+        make_wheel(directory, 'cloudify', version,
+                   {'cloudify_cli/__init__.py': CLI_MODULE.format(version)},
+                   requires=requires,
+                   entry_points='[console_scripts]\n'
+                                'cfy = cloudify_cli:main\n')
+    source = make_source(
+        os.path.dirname(directory), '1.2', requires)
+    return requires, source
+
+
+def measure(mode, workdir, packages_path, source):
+    """Runs a single installation in `mode` and returns its duration and
+    the duration of each of its phases.
+    """
+    virtualenv = tempfile.mkdtemp(dir=workdir)
+    os.rmdir(virtualenv)
+    args = {
+        'virtualenv': virtualenv,
+        'wheelspath': os.path.join(workdir, 'no-wheelhouse'),
+    }
+    if mode == 'offline':
+        args['wheelspath'] = packages_path
+    elif mode == 'source':
+        args.update(source=source, withrequirements=[])
+    elif mode == 'upgrade':
+        get_cloudify.CloudifyInstaller(version='1.0', **args).execute()
+        args['upgrade'] = True
+
+    tracer = get_cloudify.tracer = get_cloudify.Tracer()
+    start = time.time()
+    try:
+        get_cloudify.CloudifyInstaller(**args).execute()
+    finally:
+        get_cloudify.tracer = None
+    seconds = time.time() - start
+    get_cloudify._installed_versions.clear()
+    expected = {'online': '1.1', 'offline': '1.1', 'source': '1.2',
+                'upgrade': '1.1'}[mode]
+    installed = get_cloudify.get_installed_version('cloudify', virtualenv)
+    if installed != expected:
+        sys.exit('{0} installation installed cloudify {1} instead of '
+                 '{2}.'.format(mode, installed, expected))
+    shutil.rmtree(virtualenv)
+
+    phases = {}
+    for event in tracer.events:
+        if event['cat'] == 'task':
+            phases[event['name']] = \
+                phases.get(event['name'], 0) + event['dur'] / 1000000.0
+    return seconds, phases
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(runs):
+    seconds = [run[0] for run in runs]
+    phases = {}
+    for _, run_phases in runs:
+        for name, duration in run_phases.items():
+            phases.setdefault(name, []).append(duration)
+    return {
+        'runs': seconds,
+        'min': min(seconds),
+        'median': median(seconds),
+        'max': max(seconds),
+        'phases': dict((name, median(durations))
+                       for name, durations in phases.items()),
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(modes=MODES, fanout=20, repeat=3):
+    workdir = tempfile.mkdtemp(prefix='get-cloudify-benchmark-')
+    packages_path = os.path.join(workdir, 'packages')
+    os.makedirs(packages_path)
+    server = None
+    environ = dict(os.environ)
+    try:
+        source = make_packages(packages_path, fanout)[1]
+        server = IndexServer(packages_path)
+        # pip's http and wheel caches would make later runs faster and
+        # its configuration could add other indexes.
+        for name in list(os.environ):
+            if name.startswith('PIP_'):
+                del os.environ[name]
+        os.environ.update({
+            'PIP_CONFIG_FILE': os.devnull,
+            'PIP_INDEX_URL': server.index_url,
+            'PIP_NO_CACHE_DIR': '1',
+            'PIP_DISABLE_PIP_VERSION_CHECK': '1',
+        })
+        results = {}
+        for mode in modes:
+            sys.stderr.write('Benchmarking {0} installation ({1} '
+                             'runs)...\n'.format(mode, repeat))
+            results[mode] = summarize(
+                [measure(mode, workdir, packages_path, source)
+                 for _ in range(repeat)])
+        return {
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'fanout': fanout,
+            'repeat': repeat,
+            'results': results,
+        }
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        if server is not None:
+            server.stop()
+        shutil.rmtree(workdir)
+
+
+def compare(baseline, current):
+    """Returns lines comparing the median durations of two results.
+    """
+    lines = ['{0:<10} {1:>10} {2:>10} {3:>8}'.format(
+        'Mode', 'Baseline', 'Current', 'Change')]
+    for mode, result in sorted(current['results'].items()):
+        before = baseline['results'].get(mode)
+        if before is None:
+            continue
+        lines.append('{0:<10} {1:>9.2f}s {2:>9.2f}s {3:>+7.1f}%'.format(
+            mode, before['median'], result['median'],
+            (result['median'] / before['median'] - 1) * 100))
+    return lines
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--modes', nargs='+', choices=MODES, default=list(MODES),
+        help='Installation modes to measure (defaults to all of them).')
+    parser.add_argument(
+        '--fanout', type=int, default=20,
+        help='Number of dependencies of the cloudify package.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of installations to time per mode.')
+    parser.add_argument(
+        '--output', type=str,
+        help='Write the results to this file instead of stdout.')
+    parser.add_argument(
+        '--compare', type=str,
+        help='Compare the results with those in this file.')
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='Show the installation logs.')
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    get_cloudify.lgr.setLevel(
+        logging.DEBUG if args.verbose else logging.CRITICAL)
+    results = benchmark(args.modes, args.fanout, args.repeat)
+    if args.output:
+        get_cloudify.write_json(args.output, results)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(json.load(f), results):
+                sys.stderr.write(line + '\n')
@@ -23,18 +23,116 @@ import os
 import tarfile
 import importlib
 import sys
+import threading
+import hashlib
+import BaseHTTPServer
+import SocketServer
+import socket
+import zipfile
+import json
+import base64
+import logging
+import time
+import signal
+import subprocess
 
 sys.path.append("../")
 
 get_cloudify = importlib.import_module('get-cloudify')
 
 
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves `files` ({path: body}) on localhost from a background thread.
+
+    Each file is served with an ETag (its sha256), conditional and range
+    requests are honored (unsatisfiable ranges are answered with a 416) and
+    `redirects` ({path: path}) are answered with a 302. A path in
+    `drop_after` ({path: bytes}) has its connection dropped once, after
+    sending that many bytes of the body. Every response is delayed by
+    `delay` seconds.
+    Requests are recorded as (method, path, status).
+    """
+    daemon_threads = True
+
+    def __init__(self, files, redirects=None):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), LocalHTTPRequestHandler)
+        self.files = files
+        self.redirects = redirects or {}
+        self.drop_after = {}
+        self.delay = 0
+        self.requests = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{0}{1}'.format(self.server_port, path)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients (e.g. timed out probes) may hang up before the response
+        # is sent.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(
+                self, request, client_address)
+
+
+class LocalHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.path in self.server.redirects:
+            return self._respond(
+                302, headers={'Location': self.server.redirects[self.path]})
+        body = self.server.files.get(self.path)
+        if body is None:
+            return self._respond(404)
+        etag = '"{0}"'.format(hashlib.sha256(body).hexdigest())
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        if self.headers.get('If-None-Match') == etag:
+            return self._respond(304)
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range', etag) == etag:
+            start, _, end = byte_range.split('=')[1].partition('-')
+            start, end = int(start), int(end or len(body) - 1)
+            if start >= len(body):
+                headers['Content-Range'] = 'bytes */{0}'.format(len(body))
+                return self._respond(416, headers=headers)
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                start, end, len(body))
+            return self._respond(206, body[start:end + 1], headers)
+        self._respond(200, body, headers)
+
+    def _respond(self, status, body='', headers=None):
+        self.server.requests.append(('GET', self.path, status))
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        drop_after = self.server.drop_after.pop(self.path, None)
+        if drop_after is not None:
+            self.wfile.write(body[:drop_after])
+            self.wfile.flush()
+            self.close_connection = 1
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
 class CliBuilderUnitTests(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 
     def setUp(self):
         super(CliBuilderUnitTests, self).setUp()
         self.get_cloudify = get_cloudify
+        # commands expected to fail are still retried, without waiting
+        self.patch(self.get_cloudify, 'COMMAND_RETRY_BACKOFF', 0)
         self.get_cloudify.IS_VIRTUALENV = False
 
     def _create_dummy_requirements_tar(self, url, destination):
@@ -81,12 +179,140 @@ class CliBuilderUnitTests(testtools.TestCase):
         self.assertIsNot(proc.returncode, 0, 'command \'{}\' execution was '
                                              'expected to fail'.format(cmd))
 
+    def test_run_aggregates_all_output(self):
+        proc = self.get_cloudify.run(
+            'seq 1 50000; seq 1 20000 1>&2', suppress_errors=True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(
+            ''.join('{0}\n'.format(i) for i in range(1, 50001)),
+            proc.aggr_stdout)
+        self.assertEqual(
+            ''.join('{0}\n'.format(i) for i in range(1, 20001)),
+            proc.aggr_stderr)
+
+    def test_run_aggregates_unterminated_output(self):
+        proc = self.get_cloudify.run('printf "first\\nlast"')
+        self.assertEqual('first\nlast', proc.aggr_stdout)
+
+    def test_run_bounds_captured_output(self):
+        proc = self.get_cloudify.run(
+            'seq 1 300000; exit 1', capture_limit=10000)
+        self.assertEqual(proc.returncode, 1)
+        self.assertLess(
+            len(proc.aggr_stdout),
+            self.get_cloudify.OUTPUT_CAPTURE_HEAD_SIZE +
+            self.get_cloudify.OUTPUT_CAPTURE_TAIL_SIZE + 200)
+        self.assertTrue(proc.aggr_stdout.startswith('1\n2\n3\n'))
+        self.assertTrue(proc.aggr_stdout.endswith('299999\n300000\n'))
+        log_path = proc.aggr_stdout.split('full output in ')[1].split()[0]
+        try:
+            with open(log_path) as f:
+                self.assertEqual(
+                    ''.join('{0}\n'.format(i) for i in range(1, 300001)),
+                    f.read())
+        finally:
+            os.remove(log_path)
+
+    def test_output_capture_spills_to_file(self):
+        capture = self.get_cloudify.OutputCapture(
+            limit=100, head_size=10, tail_size=20)
+        capture.write('a' * 60)
+        self.assertFalse(capture.spilled)
+        self.assertEqual('a' * 60, capture.getvalue())
+        for _ in range(100):
+            capture.write('b' * 50)
+        capture.write('c' * 30)
+        self.assertTrue(capture.spilled)
+        self.assertLessEqual(capture._tail_bytes, 20 + 50)
+        value = capture.getvalue()
+        self.assertTrue(value.startswith('a' * 10 + '\n'))
+        self.assertTrue(value.endswith('\n' + 'c' * 20))
+        capture.close()
+        with open(capture.log_path) as f:
+            self.assertEqual('a' * 60 + 'b' * 5000 + 'c' * 30, f.read())
+        capture.discard()
+        self.assertFalse(os.path.isfile(capture.log_path))
+        self.assertIn('full output discarded', capture.getvalue())
+
+    def test_run_returns_when_process_exits(self):
+        # the backgrounded sleep inherits the pipes but must not be waited on
+        proc = self.get_cloudify.run('sleep 5 & echo done')
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual('done\n', proc.aggr_stdout)
+
+    def test_task_graph_respects_dependencies(self):
+        order = []
+        graph = self.get_cloudify.TaskGraph(workers=4)
+        graph.add('a', lambda: order.append('a'))
+        graph.add('b', lambda: order.append('b'), depends_on=['a'])
+        graph.add('c', lambda: order.append('c'),
+                  depends_on=['b', 'not_scheduled'])
+        graph.run()
+        self.assertEqual(['a', 'b', 'c'], order)
+
+    def test_task_graph_overlaps_independent_tasks(self):
+        barrier = threading.Event()
+        graph = self.get_cloudify.TaskGraph(workers=2)
+        # each task only finishes if the other one is running concurrently
+        graph.add('a', lambda: barrier.wait(5) or self.fail('no overlap'))
+        graph.add('b', barrier.set)
+        graph.run()
+
+    def test_task_graph_failure_cancels_downstream(self):
+        ran = []
+        graph = self.get_cloudify.TaskGraph()
+
+        def fail():
+            sys.exit('Boom!')
+        graph.add('fail', fail)
+        graph.add('independent', lambda: ran.append('independent'))
+        graph.add('child', lambda: ran.append('child'), depends_on=['fail'])
+        graph.add('grandchild', lambda: ran.append('grandchild'),
+                  depends_on=['child', 'independent'])
+        ex = self.assertRaises(SystemExit, graph.run)
+        self.assertEqual('Boom!', ex.message)
+        self.assertEqual(['independent'], ran)
+
+    def test_task_graph_interrupt(self):
+        script = '''
+import importlib, logging, sys
+sys.path.insert(0, sys.argv[1])
+get_cloudify = importlib.import_module('get-cloudify')
+get_cloudify.lgr.handlers = [logging.NullHandler()]
+graph = get_cloudify.TaskGraph()
+graph.add('sleep', lambda: get_cloudify.run(
+    'echo $$ > {0}; sleep 30'.format(sys.argv[2])))
+graph.add('child', lambda: sys.stdout.write('child ran'),
+          depends_on=['sleep'])
+try:
+    graph.run()
+except KeyboardInterrupt:
+    print('interrupted')
+'''
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        pid_path = os.path.join(tempdir, 'pid')
+        proc = subprocess.Popen(
+            [sys.executable, '-c', script, os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__))), pid_path],
+            stdout=subprocess.PIPE)
+        while not os.path.isfile(pid_path) or not os.path.getsize(pid_path):
+            time.sleep(0.1)
+        with open(pid_path) as f:
+            pid = int(f.read())
+        start = time.time()
+        proc.send_signal(signal.SIGINT)
+        stdout, _ = proc.communicate()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual('interrupted\n', stdout)
+        self.assertRaises(OSError, os.kill, pid, 0)
+
     def test_install_pip_failed_download(self):
         installer = self.get_cloudify.CloudifyInstaller()
 
         mock_boom = mock.MagicMock()
         mock_boom.side_effect = StandardError('Boom!')
-        self.get_cloudify.download_file = mock_boom
+        self.patch(self.get_cloudify, 'download_file', mock_boom)
 
         mock_false = mock.MagicMock()
 
@@ -101,7 +327,8 @@ class CliBuilderUnitTests(testtools.TestCase):
                 self.get_cloudify.PIP_URL), ex.message)
 
     def test_install_pip_fail(self):
-        self.get_cloudify.download_file = mock.MagicMock(return_value=None)
+        self.patch(self.get_cloudify, 'download_file',
+                   mock.MagicMock(return_value=None))
 
         pythonpath = 'non_existing_path'
         installer = self.get_cloudify.CloudifyInstaller(pythonpath=pythonpath)
@@ -132,7 +359,7 @@ class CliBuilderUnitTests(testtools.TestCase):
     def test_get_os_props(self):
         distro = self.get_cloudify.get_os_props()[0]
         distros = ('ubuntu', 'redhat', 'debian', 'fedora', 'centos',
-                   'archlinux')
+                   'arch')
         if distro.lower() not in distros:
             self.fail('distro prop \'{0}\' should be equal to one of: '
                       '{1}'.format(distro, distros))
@@ -166,17 +393,75 @@ class CliBuilderUnitTests(testtools.TestCase):
             shutil.rmtree(tmp_venv)
 
     def test_get_requirements_from_source_url(self):
-        def get(url, destination):
-            return self._create_dummy_requirements_tar(url, destination)
-
-        self.get_cloudify.download_file = get
+        tempdir = tempfile.mkdtemp()
         try:
+            archive = self._create_dummy_requirements_tar(
+                None, os.path.join(tempdir, 'source.tar.gz'))
+            with open(archive, 'rb') as f:
+                server = LocalHTTPServer({'/source.tar.gz': f.read()})
+            self.addCleanup(server.stop)
             installer = self.get_cloudify.CloudifyInstaller()
-            req_list = installer._get_default_requirement_files('null')
+            req_list = installer._get_default_requirement_files(
+                server.url('/source.tar.gz'))
             self.assertEquals(len(req_list), 1)
             self.assertIn('dev-requirements.txt', req_list[0])
         finally:
-            self.get_cloudify.download_file = get_cloudify.download_file
+            shutil.rmtree(tempdir)
+
+    @staticmethod
+    def _tar_stream(members, mode='w:gz'):
+        """Returns a tar stream of `members` ([(name, content)]) which
+        records how many bytes were read from it.
+        """
+        stream = StringIO()
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        stream.seek(0)
+        read = stream.read
+        stream.bytes_read = 0
+
+        def counting_read(size=-1):
+            data = read(size)
+            stream.bytes_read += len(data)
+            return data
+        stream.read = counting_read
+        return stream
+
+    def test_extract_requirement_files_from_flat_archive(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        stream = self._tar_stream([
+            ('setup.py', 'setup()'),
+            ('requirements.txt', 'sh==1.11\n'),
+            ('docs/dev-requirements.txt', 'sphinx\n'),
+        ])
+        req_list = self.get_cloudify.extract_requirement_files(
+            stream, tempdir)
+        self.assertEqual([os.path.join(tempdir, 'requirements.txt')],
+                         req_list)
+        with open(req_list[0]) as f:
+            self.assertEqual('sh==1.11\n', f.read())
+
+    def test_extract_requirement_files_stops_reading_early(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        stream = self._tar_stream([
+            ('cli-3.2/dev-requirements.txt', 'nose\n'),
+            ('cli-3.2/docs/requirements.txt', 'sphinx\n'),
+            ('cli-3.2/requirements.txt', 'sh==1.11\n'),
+            ('cli-3.2/large.bin', os.urandom(1024 * 1024)),
+        ], mode='w')
+        req_list = self.get_cloudify.extract_requirement_files(
+            stream, tempdir)
+        self.assertEqual(
+            [os.path.join(tempdir, name) for name in
+             ('dev-requirements.txt', 'requirements.txt')], req_list)
+        with open(req_list[1]) as f:
+            self.assertEqual('sh==1.11\n', f.read())
+        self.assertLess(stream.bytes_read, 1024 * 1024)
 
     def test_get_requirements_from_source_path(self):
         tempdir = tempfile.mkdtemp()
@@ -190,6 +475,1950 @@ class CliBuilderUnitTests(testtools.TestCase):
             shutil.rmtree(tempdir)
 
 
+def make_sdist(directory, name, version='1.0', install_requires=()):
+    """Creates a minimal source distribution in `directory`.
+    """
+    tempdir = tempfile.mkdtemp()
+    try:
+        package_dir = os.path.join(tempdir, '{0}-{1}'.format(name, version))
+        os.makedirs(os.path.join(package_dir, name))
+        with open(os.path.join(package_dir, name, '__init__.py'), 'w') as f:
+            f.write('')
+        with open(os.path.join(package_dir, 'setup.py'), 'w') as f:
+            f.write('from setuptools import setup\n'
+                    'setup(name={0!r}, version={1!r}, packages=[{0!r}],\n'
+                    '      install_requires={2!r})\n'.format(
+                        name, version, list(install_requires)))
+        sdist = os.path.join(directory, '{0}-{1}.tar.gz'.format(
+            name, version))
+        with tarfile.open(sdist, 'w:gz') as tar:
+            tar.add(package_dir, arcname=os.path.basename(package_dir))
+        return sdist
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def make_wheel(directory, name, version='1.0', requires=(), files=None,
+               entry_points=None, tag='py2-none-any'):
+    """Creates a minimal wheel in `directory` and returns its path.
+
+    `files` maps paths within the wheel to their contents and defaults to
+    an empty `<name>/__init__.py`.
+    """
+    dist_info = '{0}-{1}.dist-info'.format(name, version)
+    files = dict(files or {'{0}/__init__.py'.format(name): ''})
+    files['{0}/METADATA'.format(dist_info)] = ''.join(
+        ['Metadata-Version: 2.0\nName: {0}\nVersion: {1}\n'.format(
+            name, version)] +
+        ['Requires-Dist: {0}\n'.format(req) for req in requires])
+    files['{0}/WHEEL'.format(dist_info)] = \
+        'Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {0}\n'.format(tag)
+    if entry_points:
+        files['{0}/entry_points.txt'.format(dist_info)] = entry_points
+    path = os.path.join(directory, '{0}-{1}-{2}.whl'.format(
+        name, version, tag))
+    with zipfile.ZipFile(path, 'w') as wheel:
+        for arcname, content in sorted(files.items()):
+            wheel.writestr(arcname, content)
+        wheel.writestr('{0}/RECORD'.format(dist_info), '')
+    return path
+
+
+class BuildWheelsTests(testtools.TestCase):
+    def setUp(self):
+        super(BuildWheelsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'COMMAND_RETRY_BACKOFF', 0)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_build_wheels_from_sdists(self):
+        module = make_sdist(self.tempdir, 'fakecloudify')
+        requirement = make_sdist(self.tempdir, 'fakedep', '2.0')
+        req_file = os.path.join(self.tempdir, 'requirements.txt')
+        with open(req_file, 'w') as f:
+            f.write(requirement + '\n')
+        wheels_path = os.path.join(self.tempdir, 'wheelhouse')
+        pids = []
+        build_wheel = self.get_cloudify._build_wheel
+
+        def _build_wheel(args):
+            pids.append(os.getpid())
+            return build_wheel(args)
+        self.patch(self.get_cloudify, '_build_wheel', _build_wheel)
+        self.get_cloudify.build_wheels(
+            module, wheels_path, requirement_files=[req_file], workers=2)
+        self.assertEqual(
+            ['fakecloudify-1.0-py2-none-any.whl',
+             'fakedep-2.0-py2-none-any.whl', 'index.json'],
+            sorted(os.listdir(wheels_path)))
+        # pip is run from threads rather than from forked processes
+        self.assertEqual([os.getpid()] * 2, pids)
+
+    def test_build_wheels_fail(self):
+        ex = self.assertRaises(
+            SystemExit, self.get_cloudify.build_wheels,
+            os.path.join(self.tempdir, 'missing.tar.gz'),
+            os.path.join(self.tempdir, 'wheelhouse'))
+        self.assertIn('Could not download', ex.message)
+
+
+class WheelhouseIndexTests(testtools.TestCase):
+    def setUp(self):
+        super(WheelhouseIndexTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.wheels_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wheels_path)
+        self.cloudify = make_wheel(
+            self.wheels_path, 'cloudify', '3.2',
+            requires=['cloudify-rest-client==3.2', 'pyyaml>=3.10'])
+        make_wheel(self.wheels_path, 'cloudify_rest_client', '3.2')
+
+    def test_update_indexes_wheels(self):
+        index = self.get_cloudify.WheelhouseIndex(self.wheels_path)
+        index.update()
+        entry = index.wheels['cloudify-3.2-py2-none-any.whl']
+        self.assertEqual('cloudify', entry['name'])
+        self.assertEqual('3.2', entry['version'])
+        self.assertEqual(['py2', 'none', 'any'], entry['tags'])
+        self.assertEqual(
+            ['cloudify-rest-client==3.2', 'pyyaml>=3.10'], entry['requires'])
+        with open(self.cloudify, 'rb') as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(),
+                             entry['sha256'])
+        self.assertEqual([], index.verify())
+
+    def test_update_is_incremental(self):
+        self.get_cloudify.WheelhouseIndex(self.wheels_path).update()
+        make_wheel(self.wheels_path, 'pyyaml', '3.10')
+        os.remove(self.cloudify)
+        index = self.get_cloudify.WheelhouseIndex(self.wheels_path)
+        read_wheel = mock.MagicMock(side_effect=index._read_wheel)
+        index._read_wheel = read_wheel
+        index.update()
+        read_wheel.assert_called_once_with('pyyaml-3.10-py2-none-any.whl')
+        self.assertEqual(
+            ['cloudify_rest_client-3.2-py2-none-any.whl',
+             'pyyaml-3.10-py2-none-any.whl'], sorted(index.wheels))
+        self.assertEqual(
+            index.wheels,
+            self.get_cloudify.WheelhouseIndex(self.wheels_path).wheels)
+
+    def test_verify_detects_modified_wheel(self):
+        os.utime(self.cloudify, (1000000000, 1000000000))
+        self.get_cloudify.WheelhouseIndex(self.wheels_path).update()
+        index = self.get_cloudify.WheelhouseIndex(self.wheels_path)
+        with open(self.cloudify, 'r+b') as f:
+            f.seek(10)
+            f.write('X')
+        self.assertEqual(['cloudify-3.2-py2-none-any.whl'], index.verify())
+        os.remove(self.cloudify)
+        self.assertEqual(['cloudify-3.2-py2-none-any.whl'], index.verify())
+
+    def test_wheelhouse_modified_in_place_is_corrupted(self):
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=self.wheels_path)
+        os.utime(self.cloudify, (1000000000, 1000000000))
+        self.assertIsNotNone(installer._verify_wheelhouse())
+        # same size and mtime, so update() doesn't read it again
+        with open(self.cloudify, 'r+b') as f:
+            f.seek(10)
+            f.write('X')
+        os.utime(self.cloudify, (1000000000, 1000000000))
+        self.assertIsNone(installer._verify_wheelhouse())
+
+    def test_verify_detects_broken_wheel(self):
+        broken = os.path.join(self.wheels_path, 'broken-1.0-py2-none-any.whl')
+        with open(broken, 'w') as f:
+            f.write('not a zip file')
+        index = self.get_cloudify.WheelhouseIndex(self.wheels_path)
+        index.update()
+        self.assertEqual(['broken-1.0-py2-none-any.whl'], index.verify())
+
+    def test_corrupted_wheelhouse_skips_offline_install(self):
+        with open(self.cloudify, 'w') as f:
+            f.write('not a zip file')
+        install_module = mock.MagicMock()
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=self.wheels_path)
+        installer._install('cloudify')
+        install_module.assert_called_once_with(
+            module='cloudify', version='', pre=False, virtualenv_path='',
+            requirement_files='', upgrade=False)
+
+
+class WheelhouseResolveTests(testtools.TestCase):
+    interpreter = {
+        'python': ['cp27', 'py27', 'py2'],
+        'abi': ['none', 'cp27mu'],
+        'platform': 'linux_x86_64',
+        'environment': {'python_version': '2.7', 'sys_platform': 'linux2'},
+    }
+
+    def setUp(self):
+        super(WheelhouseResolveTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.wheels_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wheels_path)
+        make_wheel(self.wheels_path, 'cloudify', '3.2', requires=[
+            'cloudify-rest-client==3.2',
+            'pyyaml>=3.10',
+            'enum34; python_version < "3.4"',
+            'requests[security]'])
+        make_wheel(self.wheels_path, 'cloudify', '3.3a1')
+        make_wheel(self.wheels_path, 'cloudify_rest_client', '3.2')
+        make_wheel(self.wheels_path, 'PyYAML', '3.10')
+        make_wheel(self.wheels_path, 'enum34', '1.0')
+        make_wheel(self.wheels_path, 'requests', '2.7', requires=[
+            'pyOpenSSL; extra == "security"'])
+        make_wheel(self.wheels_path, 'pyOpenSSL', '0.15',
+                   tag='cp27-cp27mu-manylinux1_x86_64')
+
+    def _resolve(self, *requirements, **interpreter):
+        index = self.get_cloudify.WheelhouseIndex(self.wheels_path)
+        index.update()
+        return index.resolve(
+            requirements, dict(self.interpreter, **interpreter))
+
+    def test_wheel_compatible(self):
+        compatible = self.get_cloudify.wheel_compatible
+        self.assertTrue(compatible(['py2.py3', 'none', 'any'],
+                                   self.interpreter))
+        self.assertTrue(compatible(['cp27', 'cp27mu', 'manylinux1_x86_64'],
+                                   self.interpreter))
+        self.assertFalse(compatible(['cp27', 'cp27m', 'linux_x86_64'],
+                                    self.interpreter))
+        self.assertFalse(compatible(['py3', 'none', 'any'],
+                                    self.interpreter))
+        self.assertFalse(compatible(['cp27', 'cp27mu', 'manylinux1_i686'],
+                                    self.interpreter))
+        mac = dict(self.interpreter, platform='macosx_10_9_x86_64')
+        self.assertTrue(compatible(['cp27', 'none', 'macosx_10_6_intel'], mac))
+        self.assertFalse(compatible(['cp27', 'none', 'macosx_10_12_x86_64'],
+                                    mac))
+
+    def test_get_interpreter_tags(self):
+        interpreter = self.get_cloudify.get_interpreter_tags(sys.executable)
+        self.assertIn('py2', interpreter['python'])
+        self.assertIn('none', interpreter['abi'])
+        self.assertEqual('2.7', interpreter['environment']['python_version'])
+        self.assertTrue(self.get_cloudify.wheel_compatible(
+            ['py2', 'none', 'any'], interpreter))
+        self.assertRaises(ValueError, self.get_cloudify.get_interpreter_tags,
+                          'false')
+
+    def test_resolve_complete(self):
+        chosen, missing = self._resolve('cloudify==3.2')
+        self.assertEqual([], missing)
+        self.assertEqual(
+            ['cloudify', 'cloudify_rest_client', 'enum34', 'pyopenssl',
+             'pyyaml', 'requests'], sorted(chosen))
+
+    def test_resolve_chooses_highest_version(self):
+        chosen, missing = self._resolve('cloudify')
+        self.assertEqual('cloudify-3.3a1-py2-none-any.whl',
+                         chosen['cloudify'])
+
+    def test_resolve_missing(self):
+        os.remove(os.path.join(
+            self.wheels_path, 'PyYAML-3.10-py2-none-any.whl'))
+        chosen, missing = self._resolve('cloudify==3.2', 'pyopenssl>=0.16')
+        self.assertEqual(['pyopenssl>=0.16', 'pyyaml>=3.10'], missing)
+        self.assertEqual('cloudify-3.2-py2-none-any.whl', chosen['cloudify'])
+
+    def test_resolve_evaluates_markers(self):
+        chosen, missing = self._resolve(
+            'cloudify==3.2', environment={'python_version': '3.6'})
+        self.assertEqual([], missing)
+        self.assertNotIn('enum34', chosen)
+        chosen, missing = self._resolve(
+            'cloudify==3.2', 'sh==1.11; python_version<"3"',
+            environment={'python_version': '3.6'})
+        self.assertEqual([], missing)
+        self.assertNotIn('sh', chosen)
+
+    def test_resolve_skips_incompatible_wheels(self):
+        chosen, missing = self._resolve('cloudify==3.2', abi=['none'])
+        self.assertEqual(['pyOpenSSL'], missing)
+
+    def _installer(self, **kwargs):
+        self.patch(self.get_cloudify, 'get_interpreter_tags',
+                   lambda python_path: self.interpreter)
+        return self.get_cloudify.CloudifyInstaller(
+            wheelspath=self.wheels_path, **kwargs)
+
+    def test_plan_install(self):
+        installer = self._installer(version='3.2')
+        self.assertEqual(('offline', []),
+                         installer._plan_install('cloudify'))
+        requirements = os.path.join(self.wheels_path, 'requirements.txt')
+        with open(requirements, 'w') as f:
+            f.write('# comment\nsh==1.11  # pinned\n')
+        installer = self._installer(version='3.2',
+                                    withrequirements=[requirements])
+        self.assertEqual(('hybrid', ['sh==1.11']),
+                         installer._plan_install('cloudify'))
+        installer = self._installer(version='4.0')
+        self.assertEqual(('online', ['cloudify==4.0']),
+                         installer._plan_install('cloudify'))
+        installer = self._installer(source='cloudify-cli.tar.gz')
+        self.assertEqual((None, []),
+                         installer._plan_install('cloudify-cli.tar.gz'))
+
+    def test_hybrid_install(self):
+        download_requirements = mock.MagicMock()
+        install_module = mock.MagicMock()
+        self.patch(self.get_cloudify, 'download_requirements',
+                   download_requirements)
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        os.remove(os.path.join(
+            self.wheels_path, 'PyYAML-3.10-py2-none-any.whl'))
+        self._installer(version='3.2')._install_module('cloudify')
+        args, kwargs = download_requirements.call_args
+        self.assertEqual(['pyyaml>=3.10'], args[0])
+        install_module.assert_called_once_with(
+            module='cloudify', version='3.2', pre=True, virtualenv_path='',
+            wheelspath=[self.wheels_path, args[1]], requirement_files='',
+            upgrade=False)
+        self.assertFalse(os.path.isdir(args[1]))
+
+    def test_offline_install_uses_resolved_wheels(self):
+        run = mock.Mock(return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'run', run)
+        installer = self._installer(version='3.2')
+        installer._install_module('cloudify')
+        self.assertEqual(1, run.call_count)
+        self.assertEqual('pip install --no-index {0}'.format(' '.join(
+            '"{0}"'.format(os.path.join(self.wheels_path, filename))
+            for filename in sorted(installer._resolved_wheels.values()))),
+            run.call_args[0][0])
+        self.assertNotIn('--find-links', run.call_args[0][0])
+
+    def test_failed_offline_install_falls_back_online(self):
+        install_resolved_wheels = mock.MagicMock(
+            side_effect=SystemExit('Could not install the wheels'))
+        install_module = mock.MagicMock()
+        self.patch(self.get_cloudify, 'install_resolved_wheels',
+                   install_resolved_wheels)
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        self._installer(version='3.2')._install_module('cloudify')
+        self.assertTrue(install_resolved_wheels.called)
+        self.assertEqual(1, install_module.call_count)
+        self.assertNotIn('wheelspath', install_module.call_args[1])
+
+    def test_only_online_installs_are_retried(self):
+        run = mock.Mock(return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'run', run)
+        self.get_cloudify.install_module('cloudify', wheelspath=[
+            self.wheels_path])
+        self.assertFalse(run.call_args[1]['retry'])
+        self.get_cloudify.install_lock('lock.txt', find_links=[
+            self.wheels_path])
+        self.assertFalse(run.call_args[1]['retry'])
+        self.get_cloudify.install_resolved_wheels([self.wheels_path])
+        self.assertNotIn('retry', run.call_args[1])
+        self.get_cloudify.install_module('cloudify')
+        self.assertTrue(run.call_args[1]['retry'])
+
+
+class InstallWheelsTests(testtools.TestCase):
+    def setUp(self):
+        super(InstallWheelsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.wheels_path = os.path.join(self.tempdir, 'wheels')
+        self.virtualenv = os.path.join(self.tempdir, 'env')
+        self.site_packages = os.path.join(
+            self.virtualenv, 'lib', 'python2.7', 'site-packages')
+        self.bin_path = os.path.join(self.virtualenv, 'bin')
+        for path in (self.wheels_path, self.site_packages, self.bin_path):
+            os.makedirs(path)
+        os.symlink(sys.executable, os.path.join(self.bin_path, 'python'))
+        self.wheel = make_wheel(
+            self.wheels_path, 'cloudify', '3.2', files={
+                'cloudify_cli/__init__.py': 'def main():\n'
+                                            '    print("Cloudify CLI 3.2")\n',
+                'cloudify-3.2.data/scripts/cfy-tool': '#!python\nprint(1)\n',
+                'cloudify-3.2.data/data/share/cloudify.txt': 'data',
+            }, entry_points='[console_scripts]\ncfy = cloudify_cli:main\n')
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_install_wheels(self):
+        self.assertTrue(self.get_cloudify.install_wheels(
+            [self.wheel], self.virtualenv))
+        dist_info = os.path.join(self.site_packages, 'cloudify-3.2.dist-info')
+        self.assertEqual('get-cloudify\n',
+                         self._read(os.path.join(dist_info, 'INSTALLER')))
+        self.assertEqual('data', self._read(os.path.join(
+            self.virtualenv, 'share', 'cloudify.txt')))
+        tool = os.path.join(self.bin_path, 'cfy-tool')
+        self.assertEqual('#!{0}\nprint(1)\n'.format(
+            os.path.join(self.bin_path, 'python')), self._read(tool))
+        self.assertTrue(os.access(tool, os.X_OK))
+        record = self._read(os.path.join(dist_info, 'RECORD')).splitlines()
+        paths = [line.split(',')[0] for line in record]
+        self.assertIn('cloudify_cli/__init__.py', paths)
+        self.assertIn('../../../bin/cfy', paths)
+        self.assertIn('cloudify-3.2.dist-info/INSTALLER', paths)
+        self.assertEqual('cloudify-3.2.dist-info/RECORD,,', record[-1])
+        for line in record[:-1]:
+            path, digest, size = line.split(',')
+            with open(os.path.join(self.site_packages, path), 'rb') as f:
+                data = f.read()
+            self.assertEqual(len(data), int(size))
+            self.assertEqual(digest, 'sha256=' + base64.urlsafe_b64encode(
+                hashlib.sha256(data).digest()).rstrip('='))
+        os.environ['PYTHONPATH'] = self.site_packages
+        self.addCleanup(os.environ.pop, 'PYTHONPATH')
+        result = self.get_cloudify.run(os.path.join(self.bin_path, 'cfy'))
+        self.assertEqual(0, result.returncode)
+        self.assertEqual('Cloudify CLI 3.2\n', result.aggr_stdout)
+
+    def test_install_wheels_with_lib64_symlink(self):
+        os.symlink('lib', os.path.join(self.virtualenv, 'lib64'))
+        self.assertEqual(
+            [self.site_packages],
+            self.get_cloudify._get_site_packages(self.virtualenv))
+        self.assertTrue(self.get_cloudify.install_wheels(
+            [self.wheel], self.virtualenv))
+        self.assertIn('cloudify-3.2.dist-info', os.listdir(
+            os.path.join(self.virtualenv, 'lib64', 'python2.7',
+                         'site-packages')))
+
+    def test_unsupported_wheels(self):
+        headers = make_wheel(self.wheels_path, 'headers', '1.0', files={
+            'headers-1.0.data/headers/headers.h': ''})
+        self.assertFalse(self.get_cloudify.install_wheels(
+            [self.wheel, headers], self.virtualenv))
+        escaping = make_wheel(self.wheels_path, 'escaping', '1.0', files={
+            '../escaping.py': ''})
+        self.assertFalse(self.get_cloudify.install_wheels(
+            [escaping], self.virtualenv))
+        self.assertEqual([], os.listdir(self.site_packages))
+
+    def test_install_wheels_concurrently(self):
+        wheels = [make_wheel(self.wheels_path, 'plugin{0}'.format(i), '1.0',
+                             files={'plugins/plugin{0}.py'.format(i): ''})
+                  for i in range(8)]
+        self.assertTrue(self.get_cloudify.install_wheels(
+            wheels, self.virtualenv, workers=4))
+        self.assertEqual(
+            ['plugin{0}.py'.format(i) for i in range(8)],
+            sorted(os.listdir(os.path.join(self.site_packages, 'plugins'))))
+        self.assertEqual(8, len(
+            self.get_cloudify.get_installed_distributions(self.virtualenv)))
+        self.assertEqual(['bin', 'lib'], sorted(os.listdir(self.virtualenv)))
+
+    def test_failed_wheel_is_not_installed(self):
+        broken = make_wheel(
+            self.wheels_path, 'broken', '1.0',
+            files={'broken/__init__.py': ''},
+            entry_points='[console_scripts]\nbroken = broken\n')
+        self.assertRaises(ValueError, self.get_cloudify.install_wheels,
+                          [self.wheel, broken], self.virtualenv)
+        self.assertEqual(
+            ['cloudify-3.2.dist-info', 'cloudify_cli'],
+            sorted(os.listdir(self.site_packages)))
+        self.assertEqual(['bin', 'lib', 'share'],
+                         sorted(os.listdir(self.virtualenv)))
+
+    def test_failed_commit_is_rolled_back(self):
+        os.makedirs(os.path.join(
+            self.site_packages, 'cloudify-3.2.dist-info', 'leftover'))
+        self.assertRaises(OSError, self.get_cloudify.install_wheels,
+                          [self.wheel], self.virtualenv)
+        self.assertEqual(['cloudify-3.2.dist-info'],
+                         os.listdir(self.site_packages))
+        self.assertEqual(['python'], os.listdir(self.bin_path))
+
+    def test_rollback_restores_overwritten_files(self):
+        package = os.path.join(self.site_packages, 'cloudify_cli')
+        os.makedirs(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as f:
+            f.write('other')
+        with open(os.path.join(self.bin_path, 'cfy'), 'w') as f:
+            f.write('other cfy')
+        os.makedirs(os.path.join(
+            self.site_packages, 'cloudify-3.2.dist-info', 'leftover'))
+        self.assertRaises(OSError, self.get_cloudify.install_wheels,
+                          [self.wheel], self.virtualenv)
+        self.assertEqual(['__init__.py'], os.listdir(package))
+        self.assertEqual('other', self._read(
+            os.path.join(package, '__init__.py')))
+        self.assertEqual('other cfy', self._read(
+            os.path.join(self.bin_path, 'cfy')))
+        self.assertEqual(['cfy', 'python'],
+                         sorted(os.listdir(self.bin_path)))
+
+    def _install(self):
+        self.patch(self.get_cloudify, 'get_interpreter_tags',
+                   lambda python_path:
+                   WheelhouseResolveTests.interpreter)
+        install_module = mock.MagicMock()
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        self.get_cloudify.CloudifyInstaller(
+            virtualenv=self.virtualenv, wheelspath=self.wheels_path,
+            version='3.2')._install_module('cloudify')
+        return install_module
+
+    def test_offline_install_without_pip(self):
+        install_module = self._install()
+        self.assertFalse(install_module.called)
+        self.assertEqual('3.2', self.get_cloudify.get_installed_version(
+            'cloudify', self.virtualenv))
+
+    def test_offline_install_falls_back_to_pip(self):
+        os.makedirs(os.path.join(self.site_packages,
+                                 'cloudify-3.1.dist-info'))
+        install_resolved_wheels = mock.MagicMock()
+        self.patch(self.get_cloudify, 'install_resolved_wheels',
+                   install_resolved_wheels)
+        install_module = self._install()
+        self.assertFalse(install_module.called)
+        self.assertEqual([self.wheel],
+                         install_resolved_wheels.call_args[0][0])
+
+
+class CommandOutputTests(testtools.TestCase):
+    def setUp(self):
+        super(CommandOutputTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.transcript_path = os.path.join(self.tempdir, 'transcript.log')
+
+    def test_transcript(self):
+        transcript = self.get_cloudify.Transcript(self.transcript_path)
+        transcript.write('a', 'one\ntw')
+        transcript.write('a', 'o\n')
+        transcript.write('b', 'three')
+        transcript.write('a', 'four\n')
+        transcript.close()
+        with open(self.transcript_path) as f:
+            self.assertEqual('==> a <==\none\ntwo\n==> b <==\nthree\n'
+                             '==> a <==\nfour\n', f.read())
+
+    def test_transcript_in_forked_process(self):
+        transcript = self.get_cloudify.Transcript(self.transcript_path)
+        pid = os.fork()
+        if not pid:
+            transcript.write('child', 'one\n')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        transcript.write('parent', 'two\n')
+        transcript.close()
+        with open(self.transcript_path) as f:
+            self.assertEqual(
+                ['==> child <==', 'one', '==> parent <==', 'two'],
+                f.read().splitlines())
+
+    def test_run_writes_transcript(self):
+        transcript = self.get_cloudify.Transcript(self.transcript_path)
+        self.patch(self.get_cloudify, 'transcript', transcript)
+        proc = self.get_cloudify.run('seq 1 20000; echo error 1>&2; exit 2')
+        transcript.close()
+        with open(self.transcript_path) as f:
+            lines = f.read().splitlines()
+        header = '==> [{0}] seq 1 20000; echo error 1>&2; exit 2'.format(
+            proc.pid)
+        self.assertEqual(header + ' (stdout) <==', lines[0])
+        self.assertEqual([str(i) for i in range(1, 20001)],
+                         [line for line in lines if line.isdigit()])
+        self.assertIn(header + ' (stderr) <==', lines)
+        self.assertIn('error', lines)
+        self.assertEqual([header + ' <==', 'exited with 2'], lines[-2:])
+
+    def test_console_output_is_limited(self):
+        logger = mock.MagicMock()
+        self.patch(self.get_cloudify, 'lgr', logger)
+        self.patch(self.get_cloudify, 'console_limiter',
+                   self.get_cloudify.RateLimiter(5))
+        proc = self.get_cloudify.run(
+            'echo Collecting cloudify; echo WARNING: old pip 1>&2; '
+            'sleep 0.1; seq 1 100; exit 1')
+        self.assertEqual(1, proc.returncode)
+        logged = [call[0] for call in logger.log.call_args_list]
+        self.assertIn((logging.INFO, 'Collecting cloudify'), logged)
+        self.assertIn((logging.WARNING, 'WARNING: old pip'), logged)
+        self.assertEqual(5, len(logged))
+        errors = [call[0][0] for call in logger.error.call_args_list]
+        self.assertEqual(
+            ['Command failed with exit code 1: echo Collecting cloudify; '
+             'echo WARNING: old pip 1>&2; sleep 0.1; seq 1 100; exit 1'] +
+            [str(i) for i in range(81, 101)], errors)
+
+    def test_suppressed_errors_are_not_logged(self):
+        logger = mock.MagicMock()
+        self.patch(self.get_cloudify, 'lgr', logger)
+        self.get_cloudify.run('echo WARNING 1>&2; exit 1',
+                              suppress_errors=True)
+        self.assertFalse(logger.log.called)
+        self.assertFalse(logger.error.called)
+
+    def test_rate_limiter(self):
+        limiter = self.get_cloudify.RateLimiter(5)
+        self.assertEqual(5, len([i for i in range(10) if limiter.allow()]))
+        limiter._last -= 0.5
+        self.assertEqual(2, len([i for i in range(10) if limiter.allow()]))
+
+
+class RunLimitsTests(testtools.TestCase):
+    def setUp(self):
+        super(RunLimitsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.patch(self.get_cloudify, 'COMMAND_RETRY_BACKOFF', 0)
+        self.patch(self.get_cloudify, 'COMMAND_KILL_GRACE_PERIOD', 1)
+        self.patch(self.get_cloudify, 'command_limits', {
+            'timeout': 0, 'stall_timeout': 0, 'retries': 2})
+
+    def _assert_killed(self, pid):
+        for _ in range(20):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(0.1)
+        self.fail('Process {0} is still running.'.format(pid))
+
+    def test_timeout_kills_process_group(self):
+        start = time.time()
+        proc = self.get_cloudify.run(
+            'sleep 30 & echo $!; while true; do echo .; sleep 0.1; done',
+            timeout=1, stall_timeout=5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual('timeout', proc.timed_out)
+        self.assertNotEqual(0, proc.returncode)
+        self._assert_killed(int(proc.aggr_stdout.splitlines()[0]))
+
+    def test_stalled_command_is_killed(self):
+        proc = self.get_cloudify.run('echo started; sleep 30',
+                                     stall_timeout=1)
+        self.assertEqual('stall', proc.timed_out)
+        self.assertEqual('started\n', proc.aggr_stdout)
+        proc = self.get_cloudify.run(
+            'for i in 1 2 3 4; do echo $i; sleep 0.4; done', stall_timeout=1)
+        self.assertEqual(0, proc.returncode)
+        self.assertIsNone(proc.timed_out)
+
+    def test_retry(self):
+        self.patch(self.get_cloudify, 'tracer', self.get_cloudify.Tracer())
+        marker = os.path.join(self.tempdir, 'failed')
+        cmd = 'test -f {0} || {{ touch {0}; exit 1; }}'.format(marker)
+        proc = self.get_cloudify.run(cmd, retry=True)
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual([1, 0], [attempt['returncode']
+                                  for attempt in proc.attempts])
+        self.assertEqual(
+            [('run test', 1), ('backoff', None), ('run test', 2)],
+            [(event['name'], event['args'].get('attempt'))
+             for event in self.get_cloudify.tracer.events])
+
+    def test_installer_limits_are_scoped(self):
+        limits = self.get_cloudify.command_limits
+        installer = self.get_cloudify.CloudifyInstaller(
+            timeout=10, stalltimeout=5, retries=1)
+        self.assertIs(limits, self.get_cloudify.command_limits)
+        with installer._scope():
+            self.assertEqual(
+                {'timeout': 10, 'stall_timeout': 5, 'retries': 1},
+                self.get_cloudify.command_limits)
+        self.assertIs(limits, self.get_cloudify.command_limits)
+
+    def test_kill_commands(self):
+        self.patch(self.get_cloudify, '_commands_killed', threading.Event())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.get_cloudify.run('echo $$; sleep 30', retry=True)))
+        thread.start()
+        while not self.get_cloudify._running_commands:
+            time.sleep(0.1)
+        start = time.time()
+        self.get_cloudify.kill_commands()
+        thread.join()
+        self.assertLess(time.time() - start, 5)
+        # killed commands aren't retried and no more commands are run
+        self.assertEqual(1, len(results[0].attempts))
+        self._assert_killed(int(results[0].aggr_stdout))
+        self.assertEqual({}, self.get_cloudify._running_commands)
+        self.assertRaises(SystemExit, self.get_cloudify.run, 'true')
+
+    def test_retries_are_limited(self):
+        proc = self.get_cloudify.run('exit 3', retry=True)
+        self.assertEqual(3, proc.returncode)
+        self.assertEqual(3, len(proc.attempts))
+        proc = self.get_cloudify.run('exit 3')
+        self.assertEqual(1, len(proc.attempts))
+
+
+class PrecompileTests(testtools.TestCase):
+    def setUp(self):
+        super(PrecompileTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        os.makedirs(os.path.join(self.tempdir, 'package'))
+        for path, content in (('module.py', 'x = 1\n'),
+                              ('package/__init__.py', ''),
+                              ('broken.py', 'def broken(:\n')):
+            with open(os.path.join(self.tempdir, path), 'w') as f:
+                f.write(content)
+
+    def test_precompile(self):
+        # only the module whose bytecode is removed is compiled again
+        for workers, compiled in ((1, 2), (2, 1)):
+            self.assertEqual((3, compiled, 1), self.get_cloudify.precompile(
+                sys.executable, [self.tempdir], workers=workers))
+            self.assertTrue(os.path.isfile(
+                os.path.join(self.tempdir, 'module.pyc')))
+            self.assertTrue(os.path.isfile(
+                os.path.join(self.tempdir, 'package', '__init__.pyc')))
+            self.assertFalse(os.path.isfile(
+                os.path.join(self.tempdir, 'broken.pyc')))
+            os.remove(os.path.join(self.tempdir, 'module.pyc'))
+
+    def test_install_precompiles_virtualenv(self):
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        precompile = mock.MagicMock()
+        self.patch(self.get_cloudify, 'precompile', precompile)
+        installer = self.get_cloudify.CloudifyInstaller(
+            virtualenv=self.tempdir, precompile=True)
+        installer._install_module = mock.MagicMock()
+        installer._install('cloudify')
+        installer._install_module.assert_called_once_with('cloudify')
+        precompile.assert_called_once_with(
+            os.path.join(self.tempdir, 'bin', 'python'),
+            self.get_cloudify._get_site_packages(self.tempdir))
+
+
+class ProbeStartupTests(testtools.TestCase):
+    def setUp(self):
+        super(ProbeStartupTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        os.makedirs(os.path.join(self.tempdir, 'cli'))
+        files = {
+            'cli/__init__.py': 'from . import commands\n',
+            'cli/commands.py': 'import heavy\n',
+            'heavy.py': 'import time\ntime.sleep(0.1)\n',
+            'cfy': '#!{0}\nimport sys\nsys.path.insert(0, {1!r})\n'
+                   'import cli\nprint(sys.argv[1:])\n'.format(
+                       sys.executable, self.tempdir),
+        }
+        for path, content in files.items():
+            with open(os.path.join(self.tempdir, path), 'w') as f:
+                f.write(content)
+        self.cfy_path = os.path.join(self.tempdir, 'cfy')
+        os.chmod(self.cfy_path, 0o755)
+
+    def test_probe_startup(self):
+        report = self.get_cloudify.probe_startup(
+            self.cfy_path, sys.executable, runs=3, top=2)
+        self.assertEqual(3, len(report['latencies']))
+        self.assertEqual("['--version']", report['version'])
+        self.assertEqual(report['latencies'][1], report['p50'])
+        self.assertEqual(report['latencies'][2], report['p95'])
+        modules = [entry['module'] for entry in report['imports']]
+        # like python -X importtime, modules are listed as they're imported
+        self.assertLess(modules.index('heavy'), modules.index('cli.commands'))
+        self.assertLess(modules.index('cli.commands'), modules.index('cli'))
+        self.assertEqual(2, len(report['heaviest']))
+        self.assertEqual('heavy', report['heaviest'][0]['module'])
+        imports = dict((entry['module'], entry) for entry in report['imports'])
+        self.assertGreaterEqual(imports['heavy']['self'], 0.1)
+        self.assertLess(imports['cli']['self'], 0.1)
+        self.assertGreaterEqual(imports['cli']['cumulative'], 0.1)
+
+    def test_probe_startup_failure(self):
+        with open(self.cfy_path, 'a') as f:
+            f.write('sys.exit(1)\n')
+        self.assertRaises(SystemExit, self.get_cloudify.probe_startup,
+                          self.cfy_path, sys.executable, runs=1)
+
+    def test_percentile(self):
+        values = range(1, 21)
+        self.assertEqual(10, self.get_cloudify._percentile(values, 50))
+        self.assertEqual(19, self.get_cloudify._percentile(values, 95))
+        self.assertEqual(1, self.get_cloudify._percentile(values, 0))
+        self.assertEqual(7, self.get_cloudify._percentile([7], 95))
+        self.assertIsNone(self.get_cloudify._percentile([], 50))
+
+    def test_installer_writes_report(self):
+        report_path = os.path.join(self.tempdir, 'report.json')
+        self.patch(self.get_cloudify, '_get_env_bin_path',
+                   lambda env_path: self.tempdir)
+        os.symlink(sys.executable, os.path.join(self.tempdir, 'python'))
+        installer = self.get_cloudify.CloudifyInstaller(
+            virtualenv=self.tempdir, probestartup=2, probereport=report_path)
+        installer._probe_startup()
+        with open(report_path) as f:
+            report = json.load(f)
+        self.assertEqual(2, report['runs'])
+        self.assertEqual('heavy', report['heaviest'][0]['module'])
+
+
+class InstalledVersionTests(testtools.TestCase):
+    def setUp(self):
+        super(InstalledVersionTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.venv = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.venv)
+        self.site_packages = os.path.join(
+            self.venv, 'lib', 'python2.7', 'site-packages')
+        os.makedirs(os.path.join(
+            self.site_packages, 'cloudify_plugins_common-3.2.dist-info'))
+
+    def test_not_installed(self):
+        self.assertIsNone(
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+        self.assertFalse(self.get_cloudify.check_cloudify_installed(self.venv))
+
+    def test_installed_dist_info(self):
+        os.makedirs(os.path.join(self.site_packages, 'cloudify-3.2.dist-info'))
+        self.assertEqual(
+            '3.2',
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+        self.assertTrue(self.get_cloudify.check_cloudify_installed(self.venv))
+
+    def test_installed_egg_info(self):
+        os.makedirs(os.path.join(
+            self.site_packages, 'cloudify-3.3a1-py2.7.egg-info'))
+        self.assertEqual(
+            '3.3a1',
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+
+    def test_installed_in_develop_mode(self):
+        project = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, project)
+        os.makedirs(os.path.join(project, 'cloudify.egg-info'))
+        with open(os.path.join(
+                project, 'cloudify.egg-info', 'PKG-INFO'), 'w') as f:
+            f.write('Metadata-Version: 1.1\nName: cloudify\nVersion: 3.4\n')
+        with open(os.path.join(self.site_packages, 'cloudify.egg-link'),
+                  'w') as f:
+            f.write(project + '\n.')
+        self.assertEqual(
+            '3.4',
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+        self.assertRaises(
+            SystemExit, self.get_cloudify.handle_upgrade, virtualenv=self.venv)
+
+    def test_installed_unversioned_egg_info(self):
+        os.makedirs(os.path.join(self.site_packages, 'cloudify.egg-info'))
+        with open(os.path.join(
+                self.site_packages, 'cloudify.egg-info', 'PKG-INFO'),
+                'w') as f:
+            f.write('Metadata-Version: 1.1\nName: cloudify\nVersion: 3.4\n')
+        self.assertEqual(
+            '3.4',
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+
+    def test_result_is_cached_until_site_packages_change(self):
+        os.utime(self.site_packages, (1000000000, 1000000000))
+        self.assertIsNone(
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+        os.makedirs(os.path.join(self.site_packages, 'cloudify-3.2.dist-info'))
+        os.utime(self.site_packages, (1000000000, 1000000000))
+        self.assertIsNone(
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+        os.utime(self.site_packages, (1000000001, 1000000001))
+        self.assertEqual(
+            '3.2',
+            self.get_cloudify.get_installed_version('cloudify', self.venv))
+
+    def test_upgrade_to_installed_version(self):
+        os.makedirs(os.path.join(self.site_packages, 'cloudify-3.2.dist-info'))
+        ex = self.assertRaises(
+            SystemExit, self.get_cloudify.handle_upgrade,
+            upgrade=True, virtualenv=self.venv, version='3.2')
+        self.assertEqual(0, ex.message)
+        self.get_cloudify.handle_upgrade(
+            upgrade=True, virtualenv=self.venv, version='3.3')
+
+    def test_upgrade_ignored_when_building_wheels(self):
+        os.makedirs(os.path.join(self.site_packages, 'cloudify-3.2.dist-info'))
+        self.get_cloudify.handle_upgrade(
+            virtualenv=self.venv, buildwheels=True)
+        self.get_cloudify.handle_upgrade(
+            upgrade=True, virtualenv=self.venv, version='3.2',
+            buildwheels=True)
+
+
+class OsPropsTests(testtools.TestCase):
+    def setUp(self):
+        super(OsPropsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.patch(self.get_cloudify, '_os_props', None)
+        for name in ('os-release', 'lsb-release', 'redhat-release',
+                     'arch-release'):
+            setattr(self, name.replace('-', '_'),
+                    os.path.join(self.tempdir, name))
+        self.patch(self.get_cloudify, 'OS_RELEASE_PATHS', (self.os_release,))
+        self.patch(self.get_cloudify, 'LSB_RELEASE_PATH', self.lsb_release)
+        self.patch(self.get_cloudify, 'REDHAT_RELEASE_PATH',
+                   self.redhat_release)
+        self.patch(self.get_cloudify, 'ARCH_RELEASE_PATH', self.arch_release)
+        self.patch(self.get_cloudify.platform, 'linux_distribution',
+                   lambda **kwargs: ('', '', ''))
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _get_os_props(self, cache_path=None):
+        self.get_cloudify._os_props = None
+        return self.get_cloudify.get_os_props(cache_path)
+
+    def test_os_release(self):
+        self._write(self.os_release,
+                    'NAME="Debian GNU/Linux"\nID=debian\nVERSION_ID="8"\n')
+        self.assertEqual(('debian', '8'), self._get_os_props())
+        self._write(self.os_release, 'ID="rhel"\nVERSION_ID="7.2"\n')
+        self.assertEqual(('redhat', '7.2'), self._get_os_props())
+
+    def test_os_release_derivative(self):
+        self._write(self.os_release, 'ID=linuxmint\nID_LIKE="ubuntu debian"'
+                                     '\nVERSION_ID="17.2"\n')
+        self.assertEqual(('ubuntu', '17.2'), self._get_os_props())
+        self._write(self.os_release, 'ID=unknown\nVERSION_ID=1\n')
+        self.assertEqual(('unknown', '1'), self._get_os_props())
+
+    def test_fallbacks(self):
+        self._write(self.arch_release, '')
+        self.assertEqual(('arch', ''), self._get_os_props())
+        self._write(self.redhat_release, 'CentOS release 6.5 (Final)\n')
+        self.assertEqual(('centos', '6.5'), self._get_os_props())
+        self._write(self.lsb_release,
+                    'DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=14.04\n')
+        self.assertEqual(('ubuntu', '14.04'), self._get_os_props())
+        for path in (self.arch_release, self.redhat_release,
+                     self.lsb_release):
+            os.remove(path)
+        self.assertEqual(('', ''), self._get_os_props())
+
+    def test_cached_in_process(self):
+        self._write(self.os_release, 'ID=fedora\nVERSION_ID=22\n')
+        self.assertEqual(('fedora', '22'), self._get_os_props())
+        os.remove(self.os_release)
+        self.assertEqual(('fedora', '22'), self.get_cloudify.get_os_props())
+
+    def test_cached_on_disk(self):
+        cache_path = os.path.join(self.tempdir, 'os.json')
+        self._write(self.os_release, 'ID=fedora\nVERSION_ID=22\n')
+        os.utime(self.os_release, (1000000000, 1000000000))
+        self.assertEqual(('fedora', '22'), self._get_os_props(cache_path))
+        self.assertTrue(os.path.isfile(cache_path))
+        read_os_props = mock.MagicMock()
+        self.patch(self.get_cloudify, '_read_os_props', read_os_props)
+        self.assertEqual(('fedora', '22'), self._get_os_props(cache_path))
+        self.assertFalse(read_os_props.called)
+        # the cache is invalidated once the release file changes
+        read_os_props.return_value = (('fedora', '23'), self.os_release)
+        os.utime(self.os_release, None)
+        self.assertEqual(('fedora', '23'), self._get_os_props(cache_path))
+
+    def test_installer_skips_detection(self):
+        get_os_props = mock.MagicMock(return_value=('debian', '8'))
+        self.patch(self.get_cloudify, 'get_os_props', get_os_props)
+        self.patch(self.get_cloudify, 'IS_LINUX', True)
+        installer = self.get_cloudify.CloudifyInstaller(
+            os_distro='Ubuntu', os_release='14.04')
+        self.assertEqual(('ubuntu', '14.04'),
+                         (installer.distro, installer.release))
+        self.assertFalse(get_os_props.called)
+        self.patch(self.get_cloudify, 'IS_LINUX', False)
+        installer = self.get_cloudify.CloudifyInstaller()
+        self.assertEqual(('', ''), (installer.distro, installer.release))
+        self.assertFalse(get_os_props.called)
+        self.patch(self.get_cloudify, 'IS_LINUX', True)
+        installer = self.get_cloudify.CloudifyInstaller(os_distro='centos')
+        self.assertEqual(('centos', '8'),
+                         (installer.distro, installer.release))
+
+
+class SystemPackagesTests(testtools.TestCase):
+    def setUp(self):
+        super(SystemPackagesTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.run = mock.MagicMock(return_value=mock.Mock(
+            returncode=0, aggr_stdout='', aggr_stderr=''))
+        self.patch(self.get_cloudify, 'run', self.run)
+
+    def test_dpkg(self):
+        status = os.path.join(self.tempdir, 'status')
+        with open(status, 'w') as f:
+            f.write('Package: gcc\nStatus: install ok installed\n'
+                    'Description: compiler\n more description\n\n'
+                    'Package: python-dev\nStatus: deinstall ok config-files\n'
+                    '\n'
+                    'Package: python2.7-dev\nStatus: install ok installed\n'
+                    'Provides: python-dev (= 2.7), libpython-dev\n')
+        self.patch(self.get_cloudify, 'DPKG_STATUS_PATH', status)
+        self.assertEqual([], self.get_cloudify.get_missing_system_packages(
+            'apt', ['gcc', 'python-dev', 'libpython-dev']))
+        with open(status, 'w') as f:
+            f.write('Package: python-dev\nStatus: deinstall ok config-files\n')
+        self.assertEqual(
+            ['gcc', 'python-dev'],
+            self.get_cloudify.get_missing_system_packages(
+                'apt', ['gcc', 'python-dev']))
+
+    def test_pacman(self):
+        os.makedirs(os.path.join(self.tempdir, 'gcc-5.2.0-1'))
+        os.makedirs(os.path.join(self.tempdir, 'gcc-libs-5.2.0-1'))
+        self.patch(self.get_cloudify, 'PACMAN_LOCAL_DB_PATH', self.tempdir)
+        self.assertEqual(
+            ['make'], self.get_cloudify.get_missing_system_packages(
+                'pacman', ['gcc', 'make']))
+
+    def test_rpm(self):
+        self.run.return_value.aggr_stdout = \
+            'gcc-4.8.3-9.el7.x86_64\nno package provides python-devel\n'
+        self.assertEqual(
+            ['python-devel'], self.get_cloudify.get_missing_system_packages(
+                'yum', ['gcc', 'python-devel']))
+        self.run.assert_called_once_with(
+            'rpm -q --whatprovides gcc python-devel', suppress_errors=True)
+
+    def test_install_only_missing_packages(self):
+        get_missing = mock.MagicMock(return_value=[])
+        self.patch(self.get_cloudify, 'get_missing_system_packages',
+                   get_missing)
+        self.assertEqual([], self.get_cloudify.install_system_packages(
+            'apt', ['gcc', 'python-dev']))
+        self.assertFalse(self.run.called)
+        get_missing.return_value = ['gcc', 'python-dev']
+        self.assertEqual(['gcc', 'python-dev'],
+                         self.get_cloudify.install_system_packages(
+                             'apt', ['gcc', 'python-dev']))
+        self.run.assert_called_once_with(
+            'apt-get install -y gcc python-dev', retry=True)
+
+    def test_install_failure(self):
+        self.patch(self.get_cloudify, 'get_missing_system_packages',
+                   lambda manager, packages: packages)
+        self.run.return_value.returncode = 100
+        ex = self.assertRaises(
+            SystemExit, self.get_cloudify.install_system_packages,
+            'yum', ['gcc'])
+        self.assertEqual('Could not install system packages: gcc.',
+                         ex.message)
+
+    def test_install_pythondev_reports_packages(self):
+        self.patch(self.get_cloudify, 'get_missing_system_packages',
+                   lambda manager, packages: packages[1:])
+        installer = self.get_cloudify.CloudifyInstaller(
+            os_distro='centos', os_release='7')
+        self.assertEqual(['python-devel'],
+                         installer.install_pythondev('centos'))
+        self.assertEqual(['python-devel'], installer.installed_system_packages)
+        self.run.assert_called_once_with(
+            'yum -y install python-devel', retry=True)
+
+
+class DownloadCacheTests(testtools.TestCase):
+    def setUp(self):
+        super(DownloadCacheTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRY_BACKOFF', 0)
+        self.server = LocalHTTPServer({
+            '/get-pip.py': 'print "pip"\n',
+            '/other.py': 'print "other"\n',
+            '/large': 'x' * 1024 * 1024,
+        })
+        self.addCleanup(self.server.stop)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.cache = self.get_cloudify.DownloadCache(
+            os.path.join(self.tempdir, 'cache'))
+
+    def _fetch(self, path):
+        destination = os.path.join(self.tempdir, 'downloaded')
+        self.cache.fetch(self.server.url(path), destination)
+        with open(destination) as f:
+            return f.read()
+
+    def test_fetch_revalidates_cached_file(self):
+        self.assertEqual('print "pip"\n', self._fetch('/get-pip.py'))
+        self.assertEqual('print "pip"\n', self._fetch('/get-pip.py'))
+        self.assertEqual(
+            [('GET', '/get-pip.py', 200), ('GET', '/get-pip.py', 304)],
+            self.server.requests)
+        self.assertEqual({'hits': 1, 'misses': 1}, self.cache.stats)
+
+    def test_fetch_updates_changed_file(self):
+        self._fetch('/get-pip.py')
+        self.server.files['/get-pip.py'] = 'print "new pip"\n'
+        self.assertEqual('print "new pip"\n', self._fetch('/get-pip.py'))
+        self.assertEqual({'hits': 0, 'misses': 2}, self.cache.stats)
+
+    def test_index_is_persisted(self):
+        self._fetch('/get-pip.py')
+        cache = self.get_cloudify.DownloadCache(self.cache.path)
+        cache.fetch(self.server.url('/get-pip.py'),
+                    os.path.join(self.tempdir, 'again'))
+        self.assertEqual({'hits': 1, 'misses': 0}, cache.stats)
+
+    def test_least_recently_used_files_are_evicted(self):
+        self.cache.max_size = 1024 * 1024 + 20
+        self._fetch('/get-pip.py')
+        self._fetch('/other.py')
+        self._fetch('/get-pip.py')
+        self._fetch('/large')
+        self.assertEqual(2, len(os.listdir(self.cache.blobs_path)))
+        self.assertEqual(
+            set([self.server.url('/get-pip.py'), self.server.url('/large')]),
+            set(self.cache._index))
+
+    def test_file_larger_than_cache_is_kept_until_replaced(self):
+        self.cache.max_size = 1024
+        self._fetch('/get-pip.py')
+        path = self.cache.fetch(self.server.url('/large'))
+        self.assertTrue(os.path.isfile(path))
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(self.cache.blobs_path))
+        # it's the first to go once something else is fetched
+        self._fetch('/other.py')
+        self.assertFalse(os.path.isfile(path))
+
+    def test_network_errors_are_not_retried_without_cache(self):
+        self.patch(self.get_cloudify, 'download_cache', self.cache)
+        stream_download = mock.Mock(side_effect=socket.timeout('timed out'))
+        self.patch(self.get_cloudify, 'stream_download', stream_download)
+        self.assertRaises(
+            socket.timeout, self.get_cloudify.download_file,
+            self.server.url('/get-pip.py'),
+            os.path.join(self.tempdir, 'get-pip.py'))
+        self.assertEqual(1, stream_download.call_count)
+
+    def test_installer_cache_is_scoped(self):
+        self.patch(self.get_cloudify, 'download_cache', None)
+        installer = self.get_cloudify.CloudifyInstaller(cachedir=self.tempdir)
+        self.assertIsNone(self.get_cloudify.download_cache)
+        with installer._scope():
+            self.assertIs(installer.download_cache,
+                          self.get_cloudify.download_cache)
+        self.assertIsNone(self.get_cloudify.download_cache)
+
+    def test_fetch_resumes_interrupted_download(self):
+        self.server.drop_after['/large'] = 300000
+        self.assertEqual('x' * 1024 * 1024, self._fetch('/large'))
+        self.assertEqual(
+            [('GET', '/large', 200), ('GET', '/large', 206)],
+            self.server.requests)
+        self.assertEqual(
+            [hashlib.sha256('x' * 1024 * 1024).hexdigest()],
+            os.listdir(self.cache.blobs_path))
+
+    def test_fetch_missing_file(self):
+        self.assertRaises(
+            get_cloudify.urllib2.HTTPError, self._fetch, '/missing')
+        self.assertEqual([], os.listdir(self.cache.blobs_path))
+
+
+class StreamDownloadTests(testtools.TestCase):
+    def setUp(self):
+        super(StreamDownloadTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRY_BACKOFF', 0)
+        self.body = ''.join(chr(i) for i in range(256)) * 12 * 1024
+        self.server = LocalHTTPServer(
+            {'/archive.tar.gz': self.body},
+            redirects={'/latest': '/archive.tar.gz'})
+        self.addCleanup(self.server.stop)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.destination = os.path.join(self.tempdir, 'archive.tar.gz')
+
+    def _read(self):
+        with open(self.destination, 'rb') as f:
+            return f.read()
+
+    def test_redirect_followed_in_one_request(self):
+        _, sha256 = self.get_cloudify.stream_download(
+            self.server.url('/latest'), self.destination)
+        self.assertEqual(self.body, self._read())
+        self.assertEqual(hashlib.sha256(self.body).hexdigest(), sha256)
+        self.assertEqual(
+            [('GET', '/latest', 302), ('GET', '/archive.tar.gz', 200)],
+            self.server.requests)
+        self.assertEqual(['archive.tar.gz'], os.listdir(self.tempdir))
+
+    def test_interrupted_download_is_resumed(self):
+        self.server.drop_after['/archive.tar.gz'] = 1024 * 1024
+        _, sha256 = self.get_cloudify.stream_download(
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.assertEqual(self.body, self._read())
+        self.assertEqual(hashlib.sha256(self.body).hexdigest(), sha256)
+        self.assertEqual(
+            [('GET', '/archive.tar.gz', 200), ('GET', '/archive.tar.gz', 206)],
+            self.server.requests)
+
+    def test_partial_file_from_previous_run_is_resumed(self):
+        self.server.drop_after['/archive.tar.gz'] = 1024 * 1024
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.assertRaises(
+            Exception, self.get_cloudify.stream_download,
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.get_cloudify.stream_download(
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.assertEqual(self.body, self._read())
+        self.assertEqual(206, self.server.requests[-1][2])
+
+    def _leave_part(self, content, validator):
+        with open(self.destination + '.part', 'wb') as f:
+            f.write(content)
+        with open(self.destination + '.part.validator', 'w') as f:
+            f.write(validator)
+
+    def test_complete_file_from_previous_run_is_used(self):
+        self._leave_part(self.body, '"{0}"'.format(
+            hashlib.sha256(self.body).hexdigest()))
+        _, sha256 = self.get_cloudify.stream_download(
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.assertEqual(self.body, self._read())
+        self.assertEqual(hashlib.sha256(self.body).hexdigest(), sha256)
+        self.assertEqual([('GET', '/archive.tar.gz', 416)],
+                         self.server.requests)
+        self.assertEqual(['archive.tar.gz'], os.listdir(self.tempdir))
+
+    def test_unresumable_file_is_downloaded_again(self):
+        self.server.files['/archive.tar.gz'] = 'short'
+        self._leave_part(self.body, '"{0}"'.format(
+            hashlib.sha256('short').hexdigest()))
+        _, sha256 = self.get_cloudify.stream_download(
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.assertEqual('short', self._read())
+        self.assertEqual(hashlib.sha256('short').hexdigest(), sha256)
+        self.assertEqual(
+            [('GET', '/archive.tar.gz', 416), ('GET', '/archive.tar.gz', 200)],
+            self.server.requests)
+
+    def test_changed_file_is_downloaded_again(self):
+        self.server.drop_after['/archive.tar.gz'] = 1024 * 1024
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.assertRaises(
+            Exception, self.get_cloudify.stream_download,
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.server.files['/archive.tar.gz'] = 'new content'
+        self.get_cloudify.stream_download(
+            self.server.url('/archive.tar.gz'), self.destination)
+        self.assertEqual('new content', self._read())
+        self.assertEqual(200, self.server.requests[-1][2])
+
+
+class MirrorsTests(testtools.TestCase):
+    def setUp(self):
+        super(MirrorsTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.patch(self.get_cloudify, 'download_cache', None)
+        self.patch(self.get_cloudify, 'DOWNLOAD_RETRIES', 0)
+        self.body = 'print "pip"\n' * 10000
+        self.servers = []
+        for delay in (0.3, 0, 0.1):
+            self.servers.append(LocalHTTPServer({'/get-pip.py': self.body}))
+            self.servers[-1].delay = delay
+            self.addCleanup(self.servers[-1].stop)
+        self.slow, self.fast, self.medium = [
+            server.url('/get-pip.py') for server in self.servers]
+        dead = LocalHTTPServer({})
+        self.dead = dead.url('/get-pip.py')
+        dead.stop()
+
+    def test_probe_mirror(self):
+        connect, first_byte = self.get_cloudify.probe_mirror(self.slow)
+        self.assertGreaterEqual(first_byte, 0.3)
+        self.assertEqual(('GET', '/get-pip.py', 206),
+                         self.servers[0].requests[-1])
+        self.assertIsNone(self.get_cloudify.probe_mirror(
+            self.servers[1].url('/missing')))
+        self.assertIsNone(self.get_cloudify.probe_mirror(self.dead))
+        self.assertIsNone(self.get_cloudify.probe_mirror(
+            self.slow, timeout=0.1))
+
+    def test_rank(self):
+        mirrors = self.get_cloudify.Mirrors(
+            {'pip': [self.dead, self.slow, self.fast, self.medium]})
+        self.assertEqual([self.fast, self.medium, self.slow, self.dead],
+                         mirrors.rank('pip'))
+        # the ranking is reused
+        mirrors.rank('pip')
+        self.assertEqual([1, 1, 1], [len(server.requests)
+                                     for server in self.servers])
+
+    def test_single_mirror_is_not_probed(self):
+        probe_mirror = mock.Mock()
+        self.patch(self.get_cloudify, 'probe_mirror', probe_mirror)
+        mirrors = self.get_cloudify.Mirrors()
+        for component in self.get_cloudify.COMPONENT_MIRRORS:
+            self.assertEqual(
+                self.get_cloudify.COMPONENT_MIRRORS[component],
+                mirrors.rank(component))
+        self.assertFalse(probe_mirror.called)
+
+    def test_ranking_cache(self):
+        cache_path = os.path.join(self.tempdir, 'mirrors.json')
+        urls = [self.slow, self.fast]
+        self.get_cloudify.Mirrors({'pip': urls}, cache_path=cache_path).rank(
+            'pip')
+        self.assertEqual([self.fast, self.slow], self.get_cloudify.Mirrors(
+            {'pip': urls}, cache_path=cache_path).rank('pip'))
+        self.assertEqual(1, len(self.servers[1].requests))
+        # an expired ranking or a different list of mirrors is probed again
+        self.servers[1].delay = 0.5
+        self.assertEqual([self.slow, self.fast], self.get_cloudify.Mirrors(
+            {'pip': urls}, ttl=0, cache_path=cache_path).rank('pip'))
+        self.assertEqual([self.medium, self.slow], self.get_cloudify.Mirrors(
+            {'pip': [self.slow, self.medium]},
+            cache_path=cache_path).rank('pip'))
+
+    def test_download_fails_over(self):
+        cache_path = os.path.join(self.tempdir, 'mirrors.json')
+        mirrors = self.get_cloudify.Mirrors(
+            {'pip': [self.slow, self.fast]}, cache_path=cache_path)
+        self.assertEqual(self.fast, mirrors.rank('pip')[0])
+        self.servers[1].drop_after['/get-pip.py'] = 1000
+        destination = os.path.join(self.tempdir, 'get-pip.py')
+        self.assertEqual(self.slow, mirrors.download('pip', destination))
+        with open(destination) as f:
+            self.assertEqual(self.body, f.read())
+        with open(cache_path) as f:
+            self.assertEqual({}, json.load(f))
+
+    def test_installer_mirrors(self):
+        mirrors_path = os.path.join(self.tempdir, 'mirrors.json')
+        with open(mirrors_path, 'w') as f:
+            json.dump({'pip': [self.slow, self.fast]}, f)
+        installer = self.get_cloudify.CloudifyInstaller(
+            mirrors=mirrors_path, cachedir=self.tempdir)
+        self.assertEqual([self.slow, self.fast],
+                         installer.component_mirrors.mirrors['pip'])
+        self.assertEqual(os.path.join(self.tempdir, 'mirrors.json'),
+                         installer.component_mirrors.cache_path)
+        # other installers aren't affected
+        self.assertEqual(
+            self.get_cloudify.COMPONENT_MIRRORS['pip'],
+            self.get_cloudify.CloudifyInstaller().component_mirrors.mirrors[
+                'pip'])
+
+    def test_download_failure(self):
+        mirrors = self.get_cloudify.Mirrors(
+            {'pip': [self.servers[1].url('/missing'), self.dead]})
+        self.assertRaises(IOError, mirrors.download, 'pip',
+                          os.path.join(self.tempdir, 'get-pip.py'))
+
+
+class PrefetchTests(testtools.TestCase):
+    def setUp(self):
+        super(PrefetchTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.patch(self.get_cloudify, 'download_cache', None)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.server = LocalHTTPServer({
+            '/cloudify-3.2.tar.gz': 'source',
+            '/dev-requirements.txt': 'requests\n',
+            '/nested-requirements.txt': '-r requirements.txt\n',
+        })
+        self.addCleanup(self.server.stop)
+        self.local_requirements = os.path.join(self.tempdir, 'reqs.txt')
+        with open(self.local_requirements, 'w') as f:
+            f.write('requests\n')
+
+    def _prefetch(self, installer, names=None):
+        artifacts = installer._plan_prefetch('cloudify', self.tempdir)
+        if names is not None:
+            artifacts = [(name, func) for name, func in artifacts
+                         if name in names]
+        installer._prefetcher.start(artifacts)
+        self.addCleanup(installer._prefetcher.join)
+
+    def test_prefetcher(self):
+        fetched = []
+
+        def fail():
+            raise IOError('unreachable')
+
+        def wait():
+            fetched.append(prefetcher.get('first'))
+            return 'second'
+        prefetcher = self.get_cloudify.Prefetcher(workers=2)
+        prefetcher.start([('first', lambda: time.sleep(0.1) or 'first'),
+                          ('second', wait), ('failing', fail)])
+        self.assertEqual('second', prefetcher.get('second'))
+        self.assertEqual(['first'], fetched)
+        self.assertIsNone(prefetcher.get('failing'))
+        self.assertIsNone(prefetcher.get('missing'))
+        prefetcher.join()
+        self.assertEqual(set(['first', 'second', 'failing']),
+                         set(prefetcher.names))
+
+    def test_cancel(self):
+        self.patch(self.get_cloudify, '_commands_killed', threading.Event())
+        self.patch(self.get_cloudify, 'COMMAND_KILL_GRACE_PERIOD', 1)
+        started = threading.Event()
+        fetched = []
+
+        def sleep():
+            started.set()
+            return self.get_cloudify.run('sleep 30', retry=True)
+        prefetcher = self.get_cloudify.Prefetcher(workers=1)
+        prefetcher.start([('sleep', sleep),
+                          ('pending', lambda: fetched.append('pending'))])
+        started.wait(5)
+        time.sleep(0.2)
+        start = time.time()
+        prefetcher.cancel()
+        prefetcher.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertNotEqual(0, prefetcher.get('sleep').returncode)
+        self.assertIsNone(prefetcher.get('pending'))
+        self.assertEqual([], fetched)
+        # other threads may still run commands
+        self.assertEqual(0, self.get_cloudify.run('true').returncode)
+
+    def test_plan_prefetch(self):
+        def names(**kwargs):
+            kwargs.setdefault('wheelspath', self.tempdir + '/missing')
+            installer = self.get_cloudify.CloudifyInstaller(**kwargs)
+            self.patch(installer, 'find_pip', lambda: False)
+            return [name for name, _ in installer._plan_prefetch(
+                'cloudify', tempfile.mkdtemp(dir=self.tempdir))]
+
+        source = self.server.url('/cloudify-3.2.tar.gz')
+        requirements = self.server.url('/dev-requirements.txt')
+        self.assertEqual(['packages'], names())
+        self.assertEqual(['source', requirements, 'packages'], names(
+            source=source,
+            withrequirements=[requirements, self.local_requirements]))
+        self.assertEqual(['pip', 'source'], names(source=source,
+                                                  installpip=True))
+        # nothing is downloaded when building wheels, distributions aren't
+        # downloaded for an offline installation or a cloneable virtualenv
+        self.assertEqual([], names(source=source, buildwheels=True))
+        self.assertEqual([], names(wheelspath=self.tempdir))
+        self.assertEqual(['packages'], names(wheelspath=self.tempdir,
+                                             forceonline=True))
+        self.assertEqual(['source'], names(
+            source=source, virtualenv=os.path.join(self.tempdir, 'env'),
+            cachedir=os.path.join(self.tempdir, 'cache')))
+
+    def test_plan_prefetch_under_sudo(self):
+        if os.getuid() != 0:
+            self.skipTest('Requires root.')
+        self.patch(os, 'environ', dict(os.environ, SUDO_UID='12345',
+                                       SUDO_GID='12345'))
+        installer = self.get_cloudify.CloudifyInstaller(
+            source=self.server.url('/cloudify-3.2.tar.gz'),
+            virtualenv=os.path.join(self.tempdir, 'env'),
+            wheelspath=self.tempdir + '/missing')
+        # pip isn't run as root to download the distributions
+        artifacts = installer._plan_prefetch('cloudify', self.tempdir)
+        self.assertEqual(['source'], [name for name, _ in artifacts])
+        self.assertEqual(12345, os.stat(os.path.join(
+            self.tempdir, '0')).st_uid)
+        path = artifacts[0][1]()
+        self.assertEqual(12345, os.stat(path).st_uid)
+
+    def test_prefetched_source_and_requirements(self):
+        nested = self.server.url('/nested-requirements.txt')
+        installer = self.get_cloudify.CloudifyInstaller(
+            source=self.server.url('/cloudify-3.2.tar.gz'),
+            withrequirements=[self.server.url('/dev-requirements.txt'),
+                              nested],
+            wheelspath=self.tempdir + '/missing')
+        self._prefetch(installer, names=['source', nested, self.server.url(
+            '/dev-requirements.txt')])
+        install_module = mock.Mock()
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        installer._install('cloudify')
+        kwargs = install_module.call_args[1]
+        with open(kwargs['module']) as f:
+            self.assertEqual('source', f.read())
+        # files referring to other files are used from their url
+        local, url = kwargs['requirement_files']
+        with open(local) as f:
+            self.assertEqual('requests\n', f.read())
+        self.assertEqual(nested, url)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_prefetched_packages(self):
+        installer = self.get_cloudify.CloudifyInstaller(
+            wheelspath=self.tempdir + '/missing')
+        packages = os.path.join(self.tempdir, 'packages')
+        self.patch(installer, '_prefetched',
+                   lambda name: packages if name == 'packages' else None)
+        install_module = mock.Mock()
+        self.patch(self.get_cloudify, 'install_module', install_module)
+        installer._install_module('cloudify')
+        self.assertEqual(1, install_module.call_count)
+        self.assertEqual([packages],
+                         install_module.call_args[1]['wheelspath'])
+        # a failing installation from the prefetched distributions falls
+        # back to an online one
+        install_module.reset_mock()
+        install_module.side_effect = [SystemExit('failed'), None]
+        installer._install_module('cloudify')
+        self.assertEqual(2, install_module.call_count)
+        self.assertNotIn('wheelspath', install_module.call_args[1])
+
+    def test_download_packages(self):
+        installer = self.get_cloudify.CloudifyInstaller(
+            version='3.2', pre=True, withrequirements=[
+                self.local_requirements])
+        run = mock.Mock(return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'run', run)
+        self.assertEqual(self.tempdir, installer._download_packages(
+            'cloudify', self.tempdir))
+        self.assertEqual(
+            'pip download --dest {0} -r {1} cloudify==3.2 --pre'.format(
+                self.tempdir, self.local_requirements), run.call_args[0][0])
+        run.return_value.returncode = 1
+        self.assertRaises(IOError, installer._download_packages,
+                          'cloudify', self.tempdir)
+
+
+class RequirementLocksTests(testtools.TestCase):
+    def setUp(self):
+        super(RequirementLocksTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.requirements = os.path.join(self.tempdir, 'requirements.txt')
+        with open(self.requirements, 'w') as f:
+            f.write('requests==2.0\nrequests\n')
+        self.patch(self.get_cloudify, 'get_interpreter_id',
+                   lambda python_path: 'python')
+
+    def _download_requirements(self, requirements, destination, **kwargs):
+        make_wheel(destination, 'requests', '2.0')
+
+    def _installer(self, **kwargs):
+        installer = self.get_cloudify.CloudifyInstaller(
+            withrequirements=[self.requirements], **kwargs)
+        installer.requirement_locks = self.get_cloudify.RequirementLocks(
+            os.path.join(self.tempdir, 'locks'))
+        return installer
+
+    def test_merge_requirements(self):
+        self.assertEqual(
+            ['a==1.0', 'b[x,y]>=1,<2', 'Foo_Bar>1,<3',
+             'c; python_version<"3"', 'c'],
+            self.get_cloudify.merge_requirements([
+                'a==1.0', 'A', 'b[x] >= 1, <2', 'b[y]', 'Foo_Bar>1',
+                'c; python_version<"3"', 'c; python_version<"3"',
+                'foo-bar<3', 'c']))
+
+    def _source_archive(self, path, members):
+        with tarfile.open(path, 'w:gz') as tar:
+            for name, content in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, StringIO(content))
+        return path
+
+    def test_read_project_name(self):
+        def name(*members):
+            path = self._source_archive(
+                os.path.join(self.tempdir, 'source.tar.gz'), members)
+            with open(path, 'rb') as f:
+                return self.get_cloudify.read_project_name(f)
+
+        self.assertEqual('cloudify', name(
+            ('cli-master/setup.py', 'setup(\n    name="cloudify",\n)')))
+        self.assertEqual('cloudify', name(
+            ('cli-3.2/setup.py', "setup(name='cloudify-cli')"),
+            ('cli-3.2/PKG-INFO', 'Metadata-Version: 1.0\nName: cloudify\n')))
+        self.assertIsNone(name(('cli/docs/setup.py', "setup(name='x')")))
+
+    def test_lock_requirements(self):
+        download_dir = os.path.join(self.tempdir, 'download')
+        os.mkdir(download_dir)
+        wheel = make_wheel(download_dir, 'requests', '2.0')
+        make_wheel(download_dir, 'cloudify', '3.2')
+        with open(os.path.join(download_dir, 'py-yaml-3.1.tar.gz'), 'w') as f:
+            f.write('sdist')
+        self._source_archive(os.path.join(download_dir, 'master.tar.gz'), [
+            ('cli-master/setup.py', "setup(name='cloudify')")])
+        with open(wheel, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.assertEqual([
+            'py-yaml==3.1 --hash=sha256:{0}'.format(
+                hashlib.sha256('sdist').hexdigest()),
+            'requests==2.0 --hash=sha256:{0}'.format(digest)],
+            self.get_cloudify.lock_requirements(
+                download_dir, exclude=['Cloudify']))
+        self.assertRaises(ValueError, self.get_cloudify.lock_requirements,
+                          download_dir, exclude=['requests'])
+
+    def test_install_locked_source(self):
+        source = self._source_archive(
+            os.path.join(self.tempdir, 'master.tar.gz'),
+            [('cli-master/setup.py', "setup(name='cloudify')")])
+
+        def download_requirements(requirements, destination, **kwargs):
+            self._download_requirements(requirements, destination)
+            shutil.copy(source, destination)
+
+        install_lock = mock.Mock()
+        self.patch(self.get_cloudify, 'download_requirements',
+                   download_requirements)
+        self.patch(self.get_cloudify, 'install_lock', install_lock)
+        self.patch(self.get_cloudify, 'install_module', mock.Mock())
+        self.assertTrue(self._installer(source=source)._install_locked(
+            source))
+        with open(install_lock.call_args[0][0]) as f:
+            self.assertEqual(['requests'], [
+                line.split('==')[0] for line in f.read().splitlines()])
+
+    def test_install_locked(self):
+        download_requirements = mock.Mock(
+            side_effect=self._download_requirements)
+        install_lock = mock.Mock()
+        self.patch(self.get_cloudify, 'download_requirements',
+                   download_requirements)
+        self.patch(self.get_cloudify, 'install_lock', install_lock)
+        installer = self._installer(version='3.2')
+        self.assertTrue(installer._install_locked('cloudify'))
+        self.assertEqual(['requests==2.0', 'cloudify==3.2'],
+                         download_requirements.call_args[0][0])
+        lock_path = install_lock.call_args[0][0]
+        with open(lock_path) as f:
+            self.assertTrue(f.read().startswith('requests==2.0 --hash='))
+        # the lock is used by later installations with the same inputs
+        download_requirements.reset_mock()
+        self.assertTrue(self._installer(version='3.2')._install_locked(
+            'cloudify'))
+        self.assertFalse(download_requirements.called)
+        self.assertEqual(mock.call(lock_path, virtualenv_path='',
+                                   find_links=[]), install_lock.call_args)
+        # but not by ones with different inputs
+        self.assertTrue(self._installer(version='3.3')._install_locked(
+            'cloudify'))
+        self.assertTrue(download_requirements.called)
+        self.assertEqual(2, len(os.listdir(os.path.join(
+            self.tempdir, 'locks'))))
+        # a lock which cannot be installed is discarded
+        install_lock.side_effect = SystemExit('failed')
+        self.assertFalse(self._installer(version='3.2')._install_locked(
+            'cloudify'))
+        self.assertFalse(os.path.isfile(lock_path))
+
+    def test_unlockable_requirements(self):
+        with open(self.requirements, 'w') as f:
+            f.write('-r other-requirements.txt\n')
+        install_lock = mock.Mock()
+        self.patch(self.get_cloudify, 'install_lock', install_lock)
+        self.assertFalse(self._installer(version='3.2')._install_locked(
+            'cloudify'))
+        installer = self.get_cloudify.CloudifyInstaller(
+            version='3.2', withrequirements=[self.requirements])
+        self.assertFalse(installer._install_locked('cloudify'))
+        self.assertFalse(install_lock.called)
+
+    def test_unpinned_requirements_are_not_locked(self):
+        self.assertRaises(ValueError, self._installer()._find_lock,
+                          [self.requirements])
+        self.assertRaises(ValueError,
+                          self._installer(source=self.tempdir)._find_lock,
+                          [self.requirements])
+
+    def test_find_lock_once(self):
+        get_interpreter_id = mock.Mock(return_value='python')
+        self.patch(self.get_cloudify, 'get_interpreter_id',
+                   get_interpreter_id)
+        source = os.path.join(self.tempdir, 'cloudify.tar.gz')
+        with open(source, 'w') as f:
+            f.write('master')
+        installer = self._installer(source=source)
+        key, _, _ = installer._find_lock([self.requirements])
+        self.assertEqual((key, ['requests==2.0'], None),
+                         installer._find_lock([self.requirements]))
+        self.assertEqual(1, get_interpreter_id.call_count)
+        # the contents of the archive are part of the key
+        with open(source, 'w') as f:
+            f.write('changed')
+        installer = self._installer(source=source)
+        self.assertNotEqual(key, installer._find_lock(
+            [self.requirements])[0])
+
+    def test_download_locked_packages(self):
+        installer = self._installer(version='3.2')
+        key, _, _ = installer._find_lock([self.requirements])
+        lock_path = installer.requirement_locks.store(
+            key, ['requests==2.0 --hash=sha256:0'])
+        run = mock.Mock(return_value=mock.Mock(returncode=0))
+        self.patch(self.get_cloudify, 'run', run)
+        installer._download_packages('cloudify', self.tempdir)
+        self.assertEqual(
+            'pip download --dest {0} --require-hashes --no-deps -r '
+            '{1}'.format(self.tempdir, lock_path), run.call_args[0][0])
+        installer.upgrade = True
+        installer._download_packages('cloudify', self.tempdir)
+        self.assertEqual(
+            'pip download --dest {0} "requests==2.0" cloudify==3.2'.format(
+                self.tempdir), run.call_args[0][0])
+
+
+class VirtualenvTemplateCacheTests(testtools.TestCase):
+    def setUp(self):
+        super(VirtualenvTemplateCacheTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.patch(self.get_cloudify, 'IS_WIN', False)
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.templates = self.get_cloudify.VirtualenvTemplateCache(
+            os.path.join(self.tempdir, 'templates'))
+        self.origin = os.path.join(self.tempdir, 'origin')
+        self._write('bin/activate', 'VIRTUAL_ENV="{0}"\n'.format(
+            self.origin))
+        self._write('bin/cfy', '#!{0}/bin/python\n'.format(self.origin))
+        self._write('bin/python', '\0ELF {0}'.format(self.origin))
+        self._write('lib/python2.7/site-packages/cloudify_cli/cli.py',
+                    'import sys\n')
+        os.symlink(os.path.join(self.origin, 'bin'),
+                   os.path.join(self.origin, 'local'))
+        self.key = self.templates.key(version='3.2', requirements=[])
+
+    def _write(self, path, content):
+        path = os.path.join(self.origin, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def _read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_key_depends_on_inputs(self):
+        self.assertEqual(
+            self.key, self.templates.key(requirements=[], version='3.2'))
+        self.assertNotEqual(
+            self.key, self.templates.key(version='3.2', requirements=['x']))
+
+    def test_key_depends_on_source_contents(self):
+        self.patch(self.get_cloudify, 'get_interpreter_id',
+                   lambda python_path: 'cpython-2.7')
+        self.patch(self.get_cloudify, 'make_virtualenv', mock.Mock())
+        source = os.path.join(self.tempdir, 'cloudify.tar.gz')
+
+        def template_key(content):
+            with open(source, 'w') as f:
+                f.write(content)
+            installer = self.get_cloudify.CloudifyInstaller(source=source)
+            installer.virtualenv_templates = self.templates
+            installer.virtualenv = os.path.join(self.tempdir, 'env')
+            self.assertTrue(installer._is_exact())
+            installer._make_virtualenv()
+            return installer._template_key
+
+        self.assertEqual(template_key('master'), template_key('master'))
+        self.assertNotEqual(template_key('master'), template_key('changed'))
+        installer = self.get_cloudify.CloudifyInstaller(source=self.origin)
+        self.assertFalse(installer._is_exact())
+
+    def test_clone_missing_template(self):
+        self.assertFalse(self.templates.clone(
+            self.key, os.path.join(self.tempdir, 'clone')))
+
+    def test_clone_rewrites_paths(self):
+        self.templates.store(self.key, self.origin)
+        clone = os.path.join(self.tempdir, 'clone')
+        self.assertTrue(self.templates.clone(self.key, clone))
+        self.assertEqual('VIRTUAL_ENV="{0}"\n'.format(clone),
+                         self._read(os.path.join(clone, 'bin', 'activate')))
+        self.assertEqual('#!{0}/bin/python\n'.format(clone),
+                         self._read(os.path.join(clone, 'bin', 'cfy')))
+        # binaries are left untouched
+        self.assertEqual('\0ELF {0}'.format(self.origin),
+                         self._read(os.path.join(clone, 'bin', 'python')))
+        self.assertEqual(os.path.join(clone, 'bin'),
+                         os.readlink(os.path.join(clone, 'local')))
+        self.assertEqual('import sys\n', self._read(os.path.join(
+            clone, 'lib/python2.7/site-packages/cloudify_cli/cli.py')))
+
+    def test_clone_from_template_outlives_origin(self):
+        self.templates.store(self.key, self.origin)
+        shutil.rmtree(self.origin)
+        clone = os.path.join(self.tempdir, 'clone')
+        self.assertTrue(self.templates.clone(self.key, clone))
+        self.assertTrue(os.path.isfile(os.path.join(
+            clone, 'lib/python2.7/site-packages/cloudify_cli/cli.py')))
+
+    def test_store_existing_template(self):
+        self.templates.store(self.key, self.origin)
+        self._write('bin/cfy', 'changed')
+        self.templates.store(self.key, self.origin)
+        clone = os.path.join(self.tempdir, 'clone')
+        self.assertTrue(self.templates.clone(self.key, clone))
+        self.assertEqual('#!{0}/bin/python\n'.format(clone),
+                         self._read(os.path.join(clone, 'bin', 'cfy')))
+        self.assertEqual(['{0}'.format(self.key)], os.listdir(
+            os.path.join(self.tempdir, 'templates')))
+
+
+class TracerTests(testtools.TestCase):
+    def setUp(self):
+        super(TracerTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tracer = self.get_cloudify.Tracer()
+        self.patch(self.get_cloudify, 'tracer', self.tracer)
+
+    def test_trace_disabled(self):
+        self.patch(self.get_cloudify, 'tracer', None)
+        with self.get_cloudify.trace('phase', a=1) as span:
+            span['b'] = 2
+        self.assertEqual({'a': 1, 'b': 2}, span)
+        self.assertEqual([], self.tracer.events)
+
+    def test_run_span(self):
+        self.get_cloudify.run('echo hello; echo error >&2; exit 3')
+        event, = self.tracer.events
+        self.assertEqual('run echo', event['name'])
+        self.assertEqual('X', event['ph'])
+        self.assertEqual(os.getpid(), event['pid'])
+        self.assertEqual(3, event['args']['returncode'])
+        self.assertEqual(6, event['args']['stdout_bytes'])
+        self.assertEqual(6, event['args']['stderr_bytes'])
+
+    def test_task_graph_spans(self):
+        def fail():
+            raise RuntimeError('failed')
+        graph = self.get_cloudify.TaskGraph()
+        graph.add('a', lambda: None)
+        graph.add('b', fail, depends_on=['a'])
+        self.assertRaises(RuntimeError, graph.run)
+        a, b = sorted(self.tracer.events, key=lambda event: event['ts'])
+        self.assertEqual(('a', 'b'), (a['name'], b['name']))
+        self.assertGreaterEqual(b['ts'], a['ts'] + a['dur'])
+        self.assertEqual({'error': 'failed'}, b['args'])
+
+    def test_save(self):
+        with self.tracer.span('phase', version='3.2'):
+            pass
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'trace.json')
+        self.tracer.save(path)
+        with open(path) as f:
+            trace = json.load(f)
+        event, = trace['traceEvents']
+        self.assertEqual(('phase', {'version': '3.2'}),
+                         (event['name'], event['args']))
+
+
+def _fake_execute(installer):
+    if installer.virtualenv.endswith('bad'):
+        raise RuntimeError('failed')
+    os.makedirs(installer.virtualenv)
+    with open(os.path.join(installer.virtualenv, 'marker'), 'w') as f:
+        f.write('{0} {1}'.format(installer.version, os.getpid()))
+
+
+class FleetTests(testtools.TestCase):
+    def setUp(self):
+        super(FleetTests, self).setUp()
+        self.get_cloudify = get_cloudify
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.prerequisites = []
+        self.patch(self.get_cloudify.CloudifyInstaller, 'execute',
+                   _fake_execute)
+        self.patch(self.get_cloudify.CloudifyInstaller,
+                   'install_system_prerequisites',
+                   lambda installer: self.prerequisites.append(installer))
+
+    def _manifest(self, entries):
+        path = os.path.join(self.tempdir, 'manifest.json')
+        with open(path, 'w') as f:
+            json.dump(entries, f)
+        return path
+
+    def test_install_fleet(self):
+        good = os.path.join(self.tempdir, 'good')
+        bad = os.path.join(self.tempdir, 'bad')
+        other = os.path.join(self.tempdir, 'other')
+        results = self.get_cloudify.install_fleet(
+            self._manifest([{'virtualenv': good},
+                            {'virtualenv': bad},
+                            {'virtualenv': other, 'version': '3.1'}]),
+            workers=2, version='3.2', installpip=True)
+        self.assertEqual(1, len(self.prerequisites))
+        self.assertEqual([(good, True), (bad, False), (other, True)],
+                         [result[:2] for result in results])
+        self.assertEqual('failed', results[1][3])
+        with open(os.path.join(good, 'marker')) as f:
+            good_version, good_pid = f.read().split()
+        with open(os.path.join(other, 'marker')) as f:
+            other_version, other_pid = f.read().split()
+        self.assertEqual(('3.2', '3.1'), (good_version, other_version))
+        # every installation runs in its own process
+        self.assertNotEqual(good_pid, other_pid)
+        self.assertNotIn(str(os.getpid()), (good_pid, other_pid))
+
+    def test_install_fleet_shares_temporary_cache(self):
+        jobs = []
+        existed = []
+
+        class Pool(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def map(self, func, iterable, chunksize=None):
+                jobs.extend(iterable)
+                existed.extend(os.path.isdir(job['cachedir']) for job in jobs)
+                return [(job['virtualenv'], True, 0, None, [])
+                        for job in jobs]
+
+            close = join = lambda self: None
+
+        self.patch(self.get_cloudify.multiprocessing, 'Pool', Pool)
+        envs = [os.path.join(self.tempdir, env) for env in ('env1', 'env2')]
+        self.get_cloudify.install_fleet(
+            self._manifest([{'virtualenv': env} for env in envs]))
+        cache_dir, = set(job['cachedir'] for job in jobs)
+        self.assertEqual([True, True], existed)
+        self.assertEqual(cache_dir, self.prerequisites[0].cache_dir)
+        self.assertFalse(os.path.exists(cache_dir))
+
+    def test_install_fleet_trace(self):
+        tracer = self.get_cloudify.Tracer()
+        self.patch(self.get_cloudify, 'tracer', tracer)
+        envs = [os.path.join(self.tempdir, env) for env in ('env1', 'env2')]
+        self.get_cloudify.install_fleet(
+            self._manifest([{'virtualenv': env} for env in envs]))
+        installs = [event for event in tracer.events
+                    if event['cat'] == 'fleet']
+        self.assertEqual(envs, sorted(
+            event['args']['virtualenv'] for event in installs))
+        self.assertNotIn(os.getpid(), [event['pid'] for event in installs])
+
+    def test_install_fleet_invalid_manifest(self):
+        ex = self.assertRaises(
+            SystemExit, self.get_cloudify.install_fleet,
+            self._manifest([{'version': '3.2'}]))
+        self.assertIn('Manifest must be a list of objects', str(ex))
+
+
 class TestArgParser(testtools.TestCase):
     """Unit tests for functions in get_cloudify.py"""
 